@@ -1,46 +1,378 @@
 # ravensburg_rpg.py
+import argparse
+import array
+import asyncio
+import atexit
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
+import contextvars
+import difflib
+import functools
+import gc
+import hashlib
+import heapq
+import itertools
 import json
+import math
+import mmap
 import os
 import random
+import re
+import sqlite3
+import struct
 import sys
-from dataclasses import dataclass, field
-from typing import Dict, List, Optional, Tuple, Any
+import tempfile
+import time
+import zlib
+from dataclasses import MISSING, dataclass, field, fields, is_dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, TextIO, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # optional: batched dice fall back to pure Python
+    np = None
 
 SAVE_FILE = "rpg_save.json"
-SAVE_VERSION = 3  # bumped for chest schema
-HOF_FILE = "hall_of_fame.json"
+SAVE_FORMATS = ("json", "journal", "binary")
+SAVE_VERSION = 6  # bumped for the dungeon generator
+HOF_FILE = "hall_of_fame.json"  # legacy list, imported into HOF_DB on first use
+HOF_DB = "hall_of_fame.db"
+
+# --------------------------
+# Output events
+# --------------------------
+@dataclass
+class Event:
+    kind: str                       # "text" for narration; "mode", "fight", "quit", ... for state changes
+    text: str = ""
+    data: Optional[Dict[str, Any]] = None
+
+# list collecting events for the GameEngine.step() in progress; None means print directly
+_EVENT_SINK: contextvars.ContextVar = contextvars.ContextVar("ravensburg_event_sink", default=None)
+
+def say(text: str = "", kind: str = "text", **data):
+    """
+    Emit game output. Inside GameEngine.step() it becomes an Event; otherwise text is printed.
+    """
+    sink = _EVENT_SINK.get()
+    if sink is None:
+        if kind == "text":
+            print(text)
+        return
+    sink.append(Event(kind, text, data or None))
 
 # --------------------------
 # Dice utilities
 # --------------------------
-def roll(dice: str) -> int:
-    """
-    Roll dice notation like "1d8+2", "2d6-1", "d20", or a plain int string.
-    """
-    dice = dice.lower().strip()
-    if "d" not in dice:
-        return int(dice)
-    parts = dice.replace(" ", "").split("d")
-    n = parts[0]
-    tail = parts[1]
-    if n == "":
-        n = 1
-    n = int(n)
-    mod = 0
-    if "+" in tail:
-        sides, add = tail.split("+")
-        mod = int(add)
-    elif "-" in tail:
-        sides, sub = tail.split("-")
-        mod = -int(sub)
-    else:
-        sides = tail
-    sides = int(sides)
-    total = sum(random.randint(1, sides) for _ in range(n)) + mod
-    return total
+DICE_CACHE_SIZE = 1024
+
+_DICE_TERM = re.compile(r"([+-]?)(\d*)d(\d+)(?:(kh|kl|dh|dl|k)(\d+))?$|([+-]?)(\d+)$")
+
+def _keep_mean(n: int, sides: int, keep: int, highest: bool) -> float:
+    """
+    Mean of the `keep` highest (or lowest) of n dice, from order statistics:
+    the kept sum gains 1 at each face v for every kept die showing v or more,
+    and when j dice show v or more, min(j, keep) of them are kept. Exact
+    integer counting in O(n * sides), however large the pool.
+    """
+    if not highest:
+        # the lowest `keep` are everything minus the highest n - keep
+        return n * (sides + 1) / 2 - (_keep_mean(n, sides, n - keep, True) if keep < n else 0.0)
+    ways = 0
+    for v in range(1, sides + 1):
+        up, down = sides - v + 1, v - 1  # faces >= v and < v
+        ways += sum(min(j, keep) * math.comb(n, j) * up ** j * down ** (n - j) for j in range(1, n + 1))
+    return ways / sides ** n
+
+class Dice:
+    """
+    A compiled dice expression, e.g. "1d8+2", "4d6kh3" or "1d8+1d4+2".
+    Build these through compile_dice() so every notation is parsed only once.
+    """
+    __slots__ = ("expr", "terms", "const", "min", "max", "mean")
+
+    def __init__(self, expr: str, terms: List[Tuple[int, int, int, int]], const: int):
+        # each term is (sign, count, sides, keep); keep > 0 keeps highest, < 0 keeps lowest, 0 keeps all
+        self.expr = expr
+        self.terms = tuple(terms)
+        self.const = const
+        lo = hi = const
+        mean = float(const)
+        for sign, n, sides, keep in self.terms:
+            kept = abs(keep) if keep else n
+            if keep:
+                avg = _keep_mean(n, sides, kept, keep > 0)
+            else:
+                avg = n * (sides + 1) / 2
+            if sign > 0:
+                lo += kept; hi += kept * sides
+            else:
+                lo -= kept * sides; hi -= kept
+            mean += sign * avg
+        self.min = lo
+        self.max = hi
+        self.mean = mean
+
+    def roll(self, rng=random) -> int:
+        total = self.const
+        randint = rng.randint
+        for sign, n, sides, keep in self.terms:
+            if not keep:
+                if n == 1:
+                    total += sign * randint(1, sides)
+                else:
+                    total += sign * sum([randint(1, sides) for _ in range(n)])
+            else:
+                rolls = sorted([randint(1, sides) for _ in range(n)])
+                kept = rolls[n - keep:] if keep > 0 else rolls[:-keep]
+                total += sign * sum(kept)
+        return total
+
+    def __repr__(self) -> str:
+        return f"Dice({self.expr!r})"
+
+@functools.lru_cache(maxsize=DICE_CACHE_SIZE)
+def compile_dice(expr: str) -> Dice:
+    """
+    Parse dice notation into a reusable Dice. Results are memoized per string.
+    Supports "NdS", "dS", keep/drop suffixes (kh/kl/dh/dl), several terms and constants.
+    """
+    text = expr.lower().replace(" ", "")
+    if not text:
+        raise ValueError(f"Empty dice expression: {expr!r}")
+    terms: List[Tuple[int, int, int, int]] = []
+    const = 0
+    for tok in re.findall(r"[+-]?[^+-]+", text):
+        m = _DICE_TERM.match(tok)
+        if not m:
+            raise ValueError(f"Bad dice expression: {expr!r}")
+        if m.group(7) is not None:
+            const += -int(m.group(7)) if m.group(6) == "-" else int(m.group(7))
+            continue
+        sign = -1 if m.group(1) == "-" else 1
+        n = int(m.group(2) or 1)
+        sides = int(m.group(3))
+        if n < 1 or sides < 1:
+            raise ValueError(f"Bad dice expression: {expr!r}")
+        keep = 0
+        if m.group(4):
+            k = int(m.group(5))
+            mode = m.group(4)
+            if mode in ("dl", "dh"):
+                k = n - k
+                mode = "kh" if mode == "dl" else "kl"
+            if not 0 < k <= n:
+                raise ValueError(f"Bad keep count in dice expression: {expr!r}")
+            if k < n:
+                keep = -k if mode == "kl" else k
+        terms.append((sign, n, sides, keep))
+    return Dice(expr, terms, const)
+
+def roll(dice, rng=random) -> int:
+    """
+    Roll dice notation like "1d8+2", "2d6-1", "d20", "4d6kh3", or a plain int string.
+    Accepts a compiled Dice as well.
+    """
+    if isinstance(dice, Dice):
+        return dice.roll(rng)
+    return compile_dice(dice).roll(rng)
+
+def d20(rng=random):
+    return rng.randint(1, 20)
+
+def _numpy_rng(rng):
+    """
+    Turn None, an int seed, a random.Random or a numpy Generator into a numpy Generator.
+    """
+    if rng is None or isinstance(rng, int):
+        return np.random.default_rng(rng)
+    if isinstance(rng, np.random.Generator):
+        return rng
+    return np.random.default_rng(rng.getrandbits(64))
+
+def roll_many(dice, size: int, rng=None):
+    """
+    Roll a dice expression `size` times at once.
+    With NumPy every die of every sample comes from a single vectorized draw and an
+    int64 array is returned; without it, a list of ints rolled in pure Python.
+    """
+    d = dice if isinstance(dice, Dice) else compile_dice(dice)
+    if np is None:
+        if rng is None or isinstance(rng, int):
+            rng = random.Random(rng)
+        roll_one = d.roll
+        return [roll_one(rng) for _ in range(size)]
+    gen = _numpy_rng(rng)
+    out = np.full(size, d.const, dtype=np.int64)
+    if not d.terms:
+        return out
+    highs = np.concatenate([np.full(n, sides + 1, dtype=np.int64) for _, n, sides, _ in d.terms])
+    faces = gen.integers(1, highs, size=(size, len(highs)))
+    col = 0
+    for sign, n, sides, keep in d.terms:
+        block = faces[:, col:col + n]
+        col += n
+        if keep:
+            block = np.sort(block, axis=1)
+            block = block[:, n - keep:] if keep > 0 else block[:, :-keep]
+        out += sign * block.sum(axis=1)
+    return out
+
+def roll_4d6_drop_lowest_many(size: int, rng=None):
+    """Vectorized roll_4d6_drop_lowest(): `size` attribute scores at once."""
+    return roll_many("4d6kh3", size, rng)
+
+class AliasTable:
+    """
+    Vose alias table over integer weights. Kept in integers, so a draw picks
+    index i with probability exactly weights[i] / sum(weights): one uniform
+    integer below n * total selects a column and the threshold to test in it.
+    """
+    __slots__ = ("n", "total", "prob", "alias", "_arrays")
+
+    def __init__(self, weights: List[int]):
+        n, total = len(weights), sum(weights)
+        if not n or total <= 0 or any(w < 0 for w in weights):
+            raise ValueError(f"alias table needs non-negative weights with a positive sum, got {weights!r}")
+        scaled = [w * n for w in weights]  # column i holds scaled[i] / total of its own mass
+        prob, alias = [total] * n, list(range(n))
+        small = [i for i, s in enumerate(scaled) if s < total]
+        large = [i for i, s in enumerate(scaled) if s >= total]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s], alias[s] = scaled[s], l
+            scaled[l] -= total - scaled[s]
+            (small if scaled[l] < total else large).append(l)
+        self.n = n
+        self.total = total
+        self.prob = prob
+        self.alias = alias
+        self._arrays = None
+
+    def sample(self, rng=random) -> int:
+        i, r = divmod(rng.randrange(self.n * self.total), self.total)
+        return i if r < self.prob[i] else self.alias[i]
+
+    def sample_many(self, gen, size: int):
+        """`size` indices at once from a numpy Generator, as an int64 array."""
+        if self._arrays is None:
+            self._arrays = (np.array(self.prob, dtype=np.int64), np.array(self.alias, dtype=np.int64))
+        prob, alias = self._arrays
+        k = gen.integers(0, self.n * self.total, size=size, dtype=np.int64)
+        i, r = np.divmod(k, self.total)
+        return np.where(r < prob[i], i, alias[i])
+
+# --------------------------
+# Dice probabilities
+# --------------------------
+class Distribution:
+    """
+    Exact distribution of an integer roll: P(lo + k) = counts[k] / total. Counts
+    are integers, so probabilities are exact until they're read out as floats.
+    """
+    __slots__ = ("lo", "counts", "total", "mean", "_tail")
+
+    def __init__(self, lo: int, counts, total: int):
+        self.lo = lo
+        self.counts = tuple(counts)
+        self.total = total
+        tail = [0] * (len(self.counts) + 1)  # tail[k] = sum(counts[k:])
+        for k in range(len(self.counts) - 1, -1, -1):
+            tail[k] = tail[k + 1] + self.counts[k]
+        self._tail = tuple(tail)
+        self.mean = sum((lo + k) * n for k, n in enumerate(self.counts)) / total
+
+    @staticmethod
+    def from_counts(counts: Dict[int, int], total: int) -> "Distribution":
+        lo, hi = min(counts), max(counts)
+        return Distribution(lo, [counts.get(v, 0) for v in range(lo, hi + 1)], total)
+
+    @property
+    def hi(self) -> int:
+        return self.lo + len(self.counts) - 1
+
+    def prob(self, value: int) -> float:
+        k = value - self.lo
+        return self.counts[k] / self.total if 0 <= k < len(self.counts) else 0.0
+
+    def at_least(self, value: int) -> float:
+        k = min(max(value - self.lo, 0), len(self.counts))
+        return self._tail[k] / self.total
+
+    def items(self):
+        """(value, probability) pairs with non-zero probability."""
+        return [(self.lo + k, n / self.total) for k, n in enumerate(self.counts) if n]
+
+    def map(self, fn: Callable[[int], int]) -> "Distribution":
+        out: Dict[int, int] = collections.Counter()
+        for k, n in enumerate(self.counts):
+            if n:
+                out[fn(self.lo + k)] += n
+        return Distribution.from_counts(out, self.total)
+
+    def __add__(self, other: "Distribution") -> "Distribution":
+        counts = [0] * (len(self.counts) + len(other.counts) - 1)
+        for i, a in enumerate(self.counts):
+            if a:
+                for j, b in enumerate(other.counts):
+                    counts[i + j] += a * b
+        return Distribution(self.lo + other.lo, counts, self.total * other.total)
+
+    def __neg__(self) -> "Distribution":
+        return Distribution(-self.hi, reversed(self.counts), self.total)
+
+    def __repr__(self) -> str:
+        return f"Distribution({self.lo}..{self.hi}, mean={self.mean:.3f})"
+
+def _keep_distribution(n: int, sides: int, keep: int, highest: bool) -> Distribution:
+    """Sum of the best (or worst) `keep` of n dice, by counting how many dice show each face."""
+    states = {(0, 0, 0): 1}  # (dice placed, dice kept, kept sum) -> ways
+    for face in (range(sides, 0, -1) if highest else range(1, sides + 1)):
+        nxt: Dict[Tuple[int, int, int], int] = collections.Counter()
+        for (placed, kept, total), ways in states.items():
+            left = n - placed
+            for j in range(left + 1):
+                take = min(j, keep - kept)
+                nxt[(placed + j, kept + take, total + take * face)] += ways * math.comb(left, j)
+        states = nxt
+    counts: Dict[int, int] = collections.Counter()
+    for (placed, _, total), ways in states.items():
+        if placed == n:
+            counts[total] += ways
+    return Distribution.from_counts(counts, sides ** n)
 
-def d20():
-    return random.randint(1, 20)
+@functools.lru_cache(maxsize=DICE_CACHE_SIZE)
+def dice_distribution(dice) -> Distribution:
+    """Exact distribution of any roll() expression, by convolution; memoized per expression."""
+    d = dice if isinstance(dice, Dice) else compile_dice(dice)
+    dist = Distribution(d.const, [1], 1)
+    for sign, n, sides, keep in d.terms:
+        if keep:
+            term = _keep_distribution(n, sides, abs(keep), keep > 0)
+        else:
+            die = Distribution(1, [1] * sides, sides)
+            term = die
+            for _ in range(n - 1):
+                term = term + die
+        dist = dist + (term if sign > 0 else -term)
+    return dist
+
+@functools.lru_cache(maxsize=DICE_CACHE_SIZE)
+def damage_distribution(dice: str, *bonuses: int) -> Distribution:
+    """
+    Damage after adding each bonus in turn with a floor of 1, the way hits are
+    resolved: (attr mod, aim bonus) for weapons, (attr mod,) for spells.
+    """
+    dist = dice_distribution(dice)
+    for b in bonuses:
+        dist = dist.map(lambda v, b=b: max(1, v + b))
+    return dist
+
+def hit_chance(bonus: int, target: int) -> float:
+    """P(d20 + bonus >= target); attacks and saves have no automatic 1 or 20."""
+    return dice_distribution("1d20").at_least(target - bonus)
 
 # --------------------------
 # Core tables (items/spells)
@@ -66,6 +398,7 @@ POTIONS = {
     "Healing Potion": {"cost": 25, "effect": "heal_10"},
     "Greater Healing": {"cost": 80, "effect": "heal_25"},
 }
+POTION_HEALS = {"heal_10": 10, "heal_25": 25}  # potion effect -> HP restored
 
 SPELLS = {
     "Firebolt": {"cost": 50, "type": "attack", "damage": "1d8", "attr": "INT", "desc": "Hurl fire at a foe."},
@@ -105,25 +438,389 @@ MONSTER_TEMPLATES = [
 NECROMANCER = {"name":"Evil Necromancer", "hp":"6d8+12","ac":15,"atk_bonus":5,"dmg":"1d8+2","xp":50,"gold":"5d10"}
 
 ROOM_TYPES = ["monster", "trap", "treasure", "fountain", "empty"]
+ROOM_WEIGHTS = [35, 15, 20, 10, 20]
+FOUNTAIN_TYPES = ["heal", "buff", "poison"]
+TRAP_DAMAGE = "1d6+2"
+TRAP_DC = (12, 16)  # inclusive range for trap rooms
+
+CHEST_GOLD = "2d6+6"
+CHEST_POTIONS = [None, "Healing Potion", "Greater Healing", None]
+CHEST_TRAP_CHANCE = 0.55
+CHEST_LOCK_CHANCE = 0.75
+CHEST_TRAP_DC = (11, 17)
+CHEST_LOCK_DC = (12, 18)
+
+ROOM_ALIAS = AliasTable(ROOM_WEIGHTS)
+FOUNTAIN_ALIAS = AliasTable([1] * len(FOUNTAIN_TYPES))
+
+# --------------------------
+# Content packs
+# --------------------------
+CONTENT_CACHE_FILE = "content_index.json"
+CONTENT_FORMAT = 1
+CONTENT_TABLES = {"weapons": WEAPONS, "armors": ARMORS, "potions": POTIONS, "spells": SPELLS,
+                  "races": RACES, "classes": CLASSES}  # "monsters" are MONSTER_TEMPLATES, a list
+SHOP_KINDS = ("weapons", "armors", "potions", "spells")
+MONSTER_TIER_XP = 10  # XP per difficulty tier: tier = 1 + xp // MONSTER_TIER_XP
+MAX_MONSTERS = 256  # packed grids and map files store a room's monster index in one byte
+
+class ContentError(ValueError):
+    """A content pack that can't be loaded; the message names the file and entry."""
+
+def monster_tier(template: Dict[str, Any]) -> int:
+    return 1 + template["xp"] // MONSTER_TIER_XP
+
+def _check_dice(value) -> bool:
+    try:
+        compile_dice(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+_FIELD_CHECKS = {
+    "int": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "int?": lambda v: v is None or (isinstance(v, int) and not isinstance(v, bool)),
+    "str": lambda v: isinstance(v, str) and bool(v),
+    "dice": _check_dice,
+    "attr": lambda v: v in ATTRS,
+}
+
+_CONTENT_SCHEMA = {
+    "weapons": {"cost": "int", "damage": "dice", "attr": "attr"},
+    "armors": {"cost": "int", "base_ac": "int", "dex_cap": "int?"},
+    "potions": {"cost": "int", "effect": "str"},
+    "spells": {"cost": "int", "type": "str", "desc": "str"},
+    "races": {"bonuses": None},
+    "classes": {"hp_die": "int", "fav": "attr", "start": None},
+    "monsters": {"name": "str", "hp": "dice", "ac": "int", "atk_bonus": "int", "dmg": "dice", "xp": "int",
+                 "gold": "dice"},
+}
+
+_SPELL_SCHEMA = {
+    "attack": {"damage": "dice", "attr": "attr"},
+    "attack_auto": {"damage": "dice", "attr": "attr"},
+    "heal": {"amount": "dice", "attr": "attr"},
+    "buff_ac": {"bonus": "int", "turns": "int"},
+}
+
+def _validate_entry(kind: str, name: str, entry, tables: Dict[str, Dict[str, Any]]):
+    """Raise ContentError unless `entry` is a usable `kind` record; `tables` resolve references."""
+    def fail(problem: str):
+        raise ContentError(f"{kind} {name!r}: {problem}")
+
+    if not isinstance(entry, dict):
+        fail("must be an object")
+    schema = dict(_CONTENT_SCHEMA[kind])
+    if kind == "spells":
+        if entry.get("type") not in _SPELL_SCHEMA:
+            fail(f"type must be one of {', '.join(_SPELL_SCHEMA)}")
+        schema.update(_SPELL_SCHEMA[entry["type"]])
+    for field_name, check in schema.items():
+        if field_name not in entry:
+            fail(f"missing {field_name!r}")
+        if check is not None and not _FIELD_CHECKS[check](entry[field_name]):
+            fail(f"bad {field_name!r}: {entry[field_name]!r}")
+    if kind == "potions" and entry["effect"] not in POTION_HEALS:
+        fail(f"unknown effect {entry['effect']!r}")
+    if kind == "races":
+        bonuses = entry["bonuses"]
+        if not isinstance(bonuses, dict) or any(a not in ATTRS and a != "ANY" or not _FIELD_CHECKS["int"](v)
+                                                for a, v in bonuses.items()):
+            fail("bonuses must map attributes (or ANY) to integers")
+    if kind == "classes":
+        start = entry["start"]
+        if not isinstance(start, dict):
+            fail("start must be an object")
+        if start.get("weapon") not in tables["weapons"] or start.get("armor") not in tables["armors"]:
+            fail("start weapon/armor must exist")
+        if not _FIELD_CHECKS["int"](start.get("gold")):
+            fail("start gold must be an integer")
+        if any(sp not in tables["spells"] for sp in start.get("spells", [])):
+            fail("start spells must exist")
+
+def _trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class ContentRegistry:
+    """
+    Indexes over the content tables, built once per set of packs: names
+    (case-insensitive exact, prefix by bisect over the sorted names, fuzzy via a
+    trigram shortlist), shop items by cost, monsters by tier and anything with
+    an attribute by that attribute. build_index() is plain JSON so it can be
+    cached on disk.
+    """
+    def __init__(self):
+        self.load_index(self.build_index())
+
+    @staticmethod
+    def build_index() -> Dict[str, Any]:
+        names = sorted([name.lower(), kind, name] for kind, table in CONTENT_TABLES.items() for name in table)
+        names += [[t["name"].lower(), "monsters", t["name"]] for t in MONSTER_TEMPLATES]
+        names.sort()
+        attrs: Dict[str, List[str]] = {}
+        for kind, table in CONTENT_TABLES.items():
+            for name, entry in table.items():
+                attr = entry.get("attr") or entry.get("fav")
+                if attr:
+                    attrs.setdefault(f"{kind}:{attr}", []).append(name)
+        tiers: Dict[str, List[int]] = {}
+        for i, t in enumerate(MONSTER_TEMPLATES):
+            tiers.setdefault(str(monster_tier(t)), []).append(i)
+        return {
+            "names": names,
+            "cost": {kind: sorted([entry["cost"], name] for name, entry in CONTENT_TABLES[kind].items())
+                     for kind in SHOP_KINDS},
+            "attrs": attrs,
+            "tiers": tiers,
+            "monsters": {t["name"]: i for i, t in enumerate(MONSTER_TEMPLATES)},
+        }
+
+    def load_index(self, index: Dict[str, Any]):
+        self.keys = [key for key, _, _ in index["names"]]
+        self.entries = [(kind, name) for _, kind, name in index["names"]]
+        self.exact: Dict[str, List[Tuple[str, str]]] = {}
+        self.grams: Dict[str, List[int]] = {}
+        for i, key in enumerate(self.keys):
+            self.exact.setdefault(key, []).append(self.entries[i])
+            for g in _trigrams(key):
+                self.grams.setdefault(g, []).append(i)
+        self.costs = {kind: ([c for c, _ in pairs], [n for _, n in pairs]) for kind, pairs in index["cost"].items()}
+        self.attrs = index["attrs"]
+        self.tiers = {int(t): ids for t, ids in index["tiers"].items()}
+        self.monster_ids: Dict[str, int] = index["monsters"]
+
+    def find(self, text: str, kinds: Optional[Iterable[str]] = None,
+             names: Optional[Iterable[str]] = None) -> List[Tuple[str, str]]:
+        """
+        (kind, name) for a case-insensitive exact match, else every name that
+        starts with text. Only entries of `kinds` and among `names` (if given) count.
+        """
+        key = " ".join(text.lower().split())
+        if not key:
+            return []
+        kinds = set(kinds) if kinds is not None else None
+        names = set(names) if names is not None else None
+        def wanted(e: Tuple[str, str]) -> bool:
+            return (kinds is None or e[0] in kinds) and (names is None or e[1] in names)
+        hits = [e for e in self.exact.get(key, ()) if wanted(e)]
+        if hits:
+            return hits
+        i = bisect.bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i].startswith(key):
+            if wanted(self.entries[i]):
+                hits.append(self.entries[i])
+            i += 1
+        return hits
+
+    def suggest(self, text: str, kinds: Optional[Iterable[str]] = None, limit: int = 3,
+                names: Optional[Iterable[str]] = None) -> List[str]:
+        """Names spelled like text: trigram overlap picks candidates, difflib ranks them."""
+        key = " ".join(text.lower().split())
+        kinds = set(kinds) if kinds is not None else None
+        names = set(names) if names is not None else None
+        shared: Dict[int, int] = collections.Counter()
+        for g in _trigrams(key):
+            for i in self.grams.get(g, ()):
+                kind, name = self.entries[i]
+                if (kinds is None or kind in kinds) and (names is None or name in names):
+                    shared[i] += 1
+        candidates = {self.keys[i]: self.entries[i][1] for i, _ in shared.most_common(50)}
+        return [candidates[k] for k in difflib.get_close_matches(key, list(candidates), n=limit, cutoff=0.6)]
+
+    def by_cost(self, kind: str, lo: int = 0, hi: Optional[int] = None) -> List[str]:
+        """Names of `kind` costing lo..hi gold, cheapest first."""
+        costs, names = self.costs[kind]
+        a = bisect.bisect_left(costs, lo)
+        b = len(costs) if hi is None else bisect.bisect_right(costs, hi)
+        return names[a:b]
+
+    def by_attr(self, kind: str, attr: str) -> List[str]:
+        """Weapons/spells keyed on attr, or classes favouring it."""
+        return self.attrs.get(f"{kind}:{attr.upper()}", [])
+
+    def monsters_in_tier(self, lo: int, hi: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Monster templates whose tier is lo..hi (just lo when hi is None)."""
+        hi = lo if hi is None else hi
+        return [MONSTER_TEMPLATES[i] for t in range(lo, hi + 1) for i in self.tiers.get(t, ())]
+
+    def monster_index(self, template: Dict[str, Any]) -> int:
+        """Position of template in MONSTER_TEMPLATES; ValueError for unregistered monsters."""
+        i = self.monster_ids.get(template.get("name"))
+        if i is None or MONSTER_TEMPLATES[i] != template:
+            raise ValueError(f"unregistered monster {template.get('name')!r}")
+        return i
+
+CONTENT = ContentRegistry()
+
+def _content_files(paths: Iterable[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".json"))
+        else:
+            files.append(path)
+    return files
+
+def _read_pack(path: str, raw: bytes, tables: Dict[str, Any]) -> Dict[str, Any]:
+    """Parse and validate one pack against `tables` (the content so far), merging it into them."""
+    try:
+        pack = json.loads(raw)
+    except ValueError as e:
+        raise ContentError(f"{path}: not valid JSON ({e})") from None
+    if not isinstance(pack, dict):
+        raise ContentError(f"{path}: a pack is an object of tables")
+    unknown = set(pack) - set(_CONTENT_SCHEMA) - {"name"}
+    if unknown:
+        raise ContentError(f"{path}: unknown tables {', '.join(sorted(unknown))}")
+    try:
+        for kind in CONTENT_TABLES:
+            entries = pack.get(kind, {})
+            if not isinstance(entries, dict):
+                raise ContentError(f"{kind} must map names to entries")
+            tables[kind].update(entries)
+        for kind in CONTENT_TABLES:  # after the merge, so classes can use this pack's gear
+            for name, entry in pack.get(kind, {}).items():
+                _validate_entry(kind, name, entry, tables)
+        monsters = pack.get("monsters", [])
+        if not isinstance(monsters, list):
+            raise ContentError("monsters must be a list")
+        for t in monsters:
+            _validate_entry("monsters", t.get("name") if isinstance(t, dict) else "?", t, tables)
+            tables["monsters"][t["name"]] = t
+    except ContentError as e:
+        raise ContentError(f"{path}: {e}") from None
+    return tables
+
+def load_content(paths: Iterable[str], cache_path: Optional[str] = CONTENT_CACHE_FILE) -> int:
+    """
+    Merge content packs (JSON files, or directories of them) into the game
+    tables and re-index CONTENT. Entries replace same-named ones; new monsters
+    are appended so existing template indexes stay put. The validated tables
+    and index are cached at cache_path under a hash of the packs, so an
+    unchanged set loads without re-validating. Returns the entries added.
+    """
+    files = _content_files(paths)
+    digest = hashlib.sha256(f"{CONTENT_FORMAT}".encode())
+    digest.update(json.dumps([CONTENT_TABLES, MONSTER_TEMPLATES], sort_keys=True).encode())
+    blobs = []
+    for path in files:
+        with open(path, "rb") as f:
+            raw = f.read()
+        digest.update(hashlib.sha256(raw).digest())
+        blobs.append((path, raw))
+    key = digest.hexdigest()
+    before = sum(len(t) for t in CONTENT_TABLES.values()) + len(MONSTER_TEMPLATES)
+
+    cached = None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = None
+        if not isinstance(cached, dict) or cached.get("key") != key:
+            cached = None
+    if cached is not None:
+        content, index = cached["content"], cached["index"]
+    else:
+        tables = {kind: dict(table) for kind, table in CONTENT_TABLES.items()}
+        tables["monsters"] = {t["name"]: t for t in MONSTER_TEMPLATES}
+        for path, raw in blobs:
+            _read_pack(path, raw, tables)
+        content = {kind: table for kind, table in tables.items() if kind != "monsters"}
+        content["monsters"] = list(tables["monsters"].values())
+        index = None
+    if len(content["monsters"]) > MAX_MONSTERS:
+        raise ContentError(f"{len(content['monsters'])} monsters in all; dungeon maps hold at most {MAX_MONSTERS}")
+
+    for kind, table in CONTENT_TABLES.items():
+        table.update(content[kind])
+    known = {t["name"]: i for i, t in enumerate(MONSTER_TEMPLATES)}
+    for t in content["monsters"]:
+        if t["name"] in known:
+            if MONSTER_TEMPLATES[known[t["name"]]] != t:
+                MONSTER_TEMPLATES[known[t["name"]]] = t
+        else:
+            known[t["name"]] = len(MONSTER_TEMPLATES)
+            MONSTER_TEMPLATES.append(t)
+    if index is None:
+        index = ContentRegistry.build_index()
+        if cache_path:
+            _atomic_write_json(cache_path, {"format": CONTENT_FORMAT, "key": key, "files": files,
+                                            "content": content, "index": index})
+    CONTENT.load_index(index)
+    return sum(len(t) for t in CONTENT_TABLES.values()) + len(MONSTER_TEMPLATES) - before
 
 # --------------------------
 # Data classes
 # --------------------------
-@dataclass
+def _int_map(d: Dict[str, Any]) -> Dict[str, int]:
+    return {k: int(v) for k, v in d.items()}
+
+def _dataclass_codec(cls, **coerce: Callable[[Any], Any]):
+    """
+    Compile straight-line codecs for a dataclass from its fields, the way
+    @dataclass compiles __init__: to_dict() / from_dict(), to_dicts() /
+    from_dicts() for whole lists in one comprehension, and replace_state(other)
+    to take on another instance's state in place. `coerce` maps a field to the
+    function that cleans its loaded value; a dataclass there is stored through
+    its own codec. Fields with a default may be missing from the dict, and a
+    class whose fields all have defaults decodes a non-dict as cls().
+    """
+    ns: Dict[str, Any] = {"cls": cls}
+    enc, dec, assign = [], [], []
+    all_default = True
+    for f in fields(cls):
+        n = f.name
+        conv = coerce.get(n)
+        nested = is_dataclass(conv)
+        enc.append(f"{n!r}: o.{n}.to_dict()" if nested else f"{n!r}: o.{n}")
+        if f.default is not MISSING or f.default_factory is not MISSING:
+            if f.default is MISSING and conv is None:
+                raise TypeError(f"{cls.__name__}.{n}: a default_factory field needs a coerce function")
+            # a factory's empty value is shared: the coerce function builds the real one
+            ns[f"_d_{n}"] = {} if nested else f.default if f.default is not MISSING else f.default_factory()
+            value = f"d.get({n!r}, _d_{n})"
+        else:
+            all_default = False
+            value = f"d[{n!r}]"
+        if conv is not None:
+            ns[f"_c_{n}"] = conv.from_dict if nested else conv
+            value = f"_c_{n}({value})"
+        dec.append(value)
+        assign.append(f"self.{n} = other.{n}")
+    record = "{" + ", ".join(enc) + "}"
+    src = "\n".join([
+        "def to_dict(o):",
+        f"    return {record}",
+        "def to_dicts(objs):",
+        f"    return [{record} for o in objs]",
+        "def from_dict(d):",
+        "    if not isinstance(d, dict): return cls()" if all_default else "",
+        f"    return cls({', '.join(dec)})",
+        "def from_dicts(ds):",
+        f"    return [cls({', '.join(dec)}) for d in ds]",
+        "def replace_state(self, other):",
+        *("    " + line for line in assign),
+    ])
+    exec(src, ns)
+    for name in ("to_dict", "replace_state"):
+        ns[name].__qualname__ = f"{cls.__name__}.{name}"
+        setattr(cls, name, ns[name])
+    for name in ("to_dicts", "from_dict", "from_dicts"):
+        ns[name].__qualname__ = f"{cls.__name__}.{name}"
+        setattr(cls, name, staticmethod(ns[name]))
+    return cls
+
+@dataclass(slots=True)
 class Effects:
     ac_buff: int = 0
     ac_turns: int = 0
 
-    def to_dict(self) -> Dict[str, Any]:
-        return {"ac_buff": self.ac_buff, "ac_turns": self.ac_turns}
-
-    @staticmethod
-    def from_dict(d: Dict[str, Any]) -> "Effects":
-        if not isinstance(d, dict):
-            return Effects()
-        return Effects(ac_buff=int(d.get("ac_buff", 0)), ac_turns=int(d.get("ac_turns", 0)))
+_dataclass_codec(Effects, ac_buff=int, ac_turns=int)
 
-@dataclass
+@dataclass(slots=True)
 class Character:
     name: str
     race: str
@@ -139,12 +836,13 @@ class Character:
     potions: Dict[str, int] = field(default_factory=dict)
     spells: List[str] = field(default_factory=list)
     effects: Effects = field(default_factory=Effects)
+    turns: int = 0  # commands taken in the dungeon
 
     def mod(self, attr: str) -> int:
         return (self.attrs.get(attr, 10) - 10) // 2
 
-    def calc_ac(self) -> int:
-        armor = ARMORS.get(self.armor, ARMORS["Clothes"])
+    def calc_ac(self, armor: Optional[str] = None) -> int:
+        armor = ARMORS.get(armor or self.armor, ARMORS["Clothes"])
         base = armor["base_ac"]
         dex_mod = self.mod("DEX")
         if armor["dex_cap"] is None:
@@ -153,15 +851,15 @@ class Character:
             dex_add = min(dex_mod, armor["dex_cap"])
         return base + max(0, dex_add) + self.effects.ac_buff
 
-    def attack_bonus(self) -> int:
+    def attack_bonus(self, weapon: Optional[str] = None) -> int:
         prof = 2 + (self.level - 1) // 4
-        weapon = WEAPONS.get(self.weapon, WEAPONS["Dagger"])
+        weapon = WEAPONS.get(weapon or self.weapon, WEAPONS["Dagger"])
         attr = weapon["attr"]
         return prof + self.mod(attr)
 
-    def damage_roll(self) -> int:
+    def damage_roll(self, rng=random) -> int:
         weapon = WEAPONS.get(self.weapon, WEAPONS["Dagger"])
-        base = roll(weapon["damage"])
+        base = roll(weapon["damage"], rng)
         return max(1, base + self.mod(weapon["attr"]))
 
     def learn_spell(self, name: str):
@@ -171,61 +869,25 @@ class Character:
     def add_potion(self, name: str, qty: int = 1):
         self.potions[name] = self.potions.get(name, 0) + qty
 
-    def level_up_if_ready(self):
+    def level_up_if_ready(self, rng=random):
         needed = 25 * self.level
         leveled = False
         while self.xp >= needed:
             self.level += 1
-            hp_gain = max(1, roll(f"1d{CLASSES[self.char_class]['hp_die']}") + self.mod("CON"))
+            hp_gain = max(1, roll(f"1d{CLASSES[self.char_class]['hp_die']}", rng) + self.mod("CON"))
             self.max_hp += hp_gain
             self.hp = self.max_hp
             fav = CLASSES[self.char_class]["fav"]
             self.attrs[fav] += 1
-            print(f"\n*** LEVEL UP! You are now level {self.level}. +{hp_gain} HP, +1 {fav}. ***")
+            say(f"\n*** LEVEL UP! You are now level {self.level}. +{hp_gain} HP, +1 {fav}. ***")
             leveled = True
             needed = 25 * self.level
         return leveled
 
-    # ---- Serialization ----
-    def to_dict(self) -> Dict[str, Any]:
-        return {
-            "name": self.name,
-            "race": self.race,
-            "char_class": self.char_class,
-            "attrs": self.attrs,
-            "level": self.level,
-            "xp": self.xp,
-            "gold": self.gold,
-            "max_hp": self.max_hp,
-            "hp": self.hp,
-            "weapon": self.weapon,
-            "armor": self.armor,
-            "potions": self.potions,
-            "spells": self.spells,
-            "effects": self.effects.to_dict(),
-        }
-
-    @staticmethod
-    def from_dict(d: Dict[str, Any]) -> "Character":
-        eff = Effects.from_dict(d.get("effects", {}))
-        return Character(
-            name=d["name"],
-            race=d["race"],
-            char_class=d["char_class"],
-            attrs={k:int(v) for k,v in d["attrs"].items()},
-            level=int(d.get("level", 1)),
-            xp=int(d.get("xp", 0)),
-            gold=int(d.get("gold", 0)),
-            max_hp=int(d.get("max_hp", 1)),
-            hp=int(d.get("hp", 1)),
-            weapon=d.get("weapon", "Dagger"),
-            armor=d.get("armor", "Clothes"),
-            potions={k:int(v) for k,v in d.get("potions", {}).items()},
-            spells=list(d.get("spells", [])),
-            effects=eff,
-        )
+_dataclass_codec(Character, attrs=_int_map, level=int, xp=int, gold=int, max_hp=int, hp=int,
+                 potions=_int_map, spells=list, effects=Effects, turns=int)
 
-@dataclass
+@dataclass(slots=True)
 class Monster:
     name: str
     hp: int
@@ -235,18 +897,21 @@ class Monster:
     xp: int
     gold: int
 
+_dataclass_codec(Monster, hp=int, ac=int, atk_bonus=int, xp=int, gold=int)
+
 @dataclass
+class Fight:
+    monster: Monster
+    boss: bool = False
+    turn: str = "player"
+
+@dataclass(slots=True)
 class Room:
     visited: bool = False
     kind: str = "empty"
     content: Optional[Dict[str, Any]] = None  # monster/trap/chest/fountain/boss
 
-    def to_dict(self) -> Dict[str, Any]:
-        return {"visited": self.visited, "kind": self.kind, "content": self.content}
-
-    @staticmethod
-    def from_dict(d: Dict[str, Any]) -> "Room":
-        return Room(bool(d.get("visited", False)), d.get("kind", "empty"), d.get("content"))
+_dataclass_codec(Room, visited=bool)
 
 @dataclass
 class Dungeon:
@@ -255,6 +920,19 @@ class Dungeon:
     grid: List[List[Room]]
     player_pos: Tuple[int, int]
     boss_pos: Tuple[int, int]
+    seed: Optional[int] = None
+    depth: int = 1          # floor number; monsters scale with it (floor_template)
+    cleared: bool = False   # boss beaten, so the stairs down are open
+    generator: Optional[str] = None  # which generate_dungeon path laid out `seed` (see dungeon_generator)
+    # rooms modified since the last journaled save
+    changed: set = field(default_factory=set, repr=False, compare=False)
+    view_cache: Optional["MapView"] = field(default=None, repr=False, compare=False)
+    # bumped whenever a room is explored; cached distance fields are keyed on it
+    version: int = field(default=0, repr=False, compare=False)
+    path_cache: "collections.OrderedDict[Tuple[int, int], PathField]" = field(
+        default_factory=collections.OrderedDict, repr=False, compare=False)
+    # unexplored rooms bordering explored ones (x * cols + y); built on first use, then kept by visit()
+    frontier: Optional[set] = field(default=None, repr=False, compare=False)
 
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -262,34 +940,96 @@ class Dungeon:
             "cols": self.cols,
             "player_pos": list(self.player_pos),
             "boss_pos": list(self.boss_pos),
-            "grid": [[cell.to_dict() for cell in row] for row in self.grid],
+            "seed": self.seed,
+            "depth": self.depth,
+            "cleared": self.cleared,
+            "generator": self.generator,
+            **self._grid_dict(),
         }
 
+    def _grid_dict(self) -> Dict[str, Any]:
+        if isinstance(self.grid, LazyGrid):
+            return {"lazy_grid": self.grid.to_dict()}
+        if isinstance(self.grid, MmapGrid):
+            return {"mmap_grid": self.grid.to_dict()}
+        if isinstance(self.grid, list):
+            return {"grid": [Room.to_dicts(row) for row in self.grid], "compact": False}
+        return {"grid": [[cell.to_dict() for cell in row] for row in self.grid], "compact": True}
+
     @staticmethod
     def from_dict(d: Dict[str, Any]) -> "Dungeon":
         rows = int(d["rows"]); cols = int(d["cols"])
-        grid = [[Room.from_dict(c) for c in row] for row in d["grid"]]
+        if "lazy_grid" in d:
+            grid = LazyGrid.from_dict(d["lazy_grid"], rows, cols)
+        elif "mmap_grid" in d:
+            grid = MmapGrid.from_dict(d["mmap_grid"])
+        else:
+            grid = [Room.from_dicts(row) for row in d["grid"]]
+            if d.get("compact"):
+                grid = CompactGrid.from_rooms(rows, cols, grid)
         ppos = tuple(d.get("player_pos", [0,0]))
         bpos = tuple(d.get("boss_pos", [rows-1, cols-1]))
-        return Dungeon(rows, cols, grid, ppos, bpos)
+        return Dungeon(rows, cols, grid, ppos, bpos, d.get("seed"), int(d.get("depth", 1)), bool(d.get("cleared")),
+                       d.get("generator"))
+
+    def replace_state(self, other: "Dungeon"):
+        """Take on another Dungeon's floor in place (LOAD), dropping caches of the old one."""
+        self.rows, self.cols, self.grid = other.rows, other.cols, other.grid
+        self.player_pos, self.boss_pos, self.seed = other.player_pos, other.boss_pos, other.seed
+        self.depth, self.cleared, self.generator = other.depth, other.cleared, other.generator
+        self.changed.clear()
+        self.view_cache = None
+        self.path_cache.clear()
+        self.frontier = None
+        self.version += 1
+
+    def mark_changed(self, x: int, y: int):
+        self.changed.add((x, y))
+        if self.view_cache is not None:
+            self.view_cache.invalidate(x, y)
+
+    def visit(self, x: int, y: int) -> Room:
+        """Mark the room at (x, y) visited, keeping the map counters in step."""
+        room = self.grid[x][y]
+        if not room.visited:
+            room.visited = True
+            if isinstance(self.grid, LazyGrid):
+                self.grid.visited_count += 1
+            self.version += 1
+            if self.view_cache is not None:
+                self.view_cache.note_visit(x, y)
+            if self.frontier is not None:
+                _grow_frontier(self, x * self.cols + y)
+        self.mark_changed(x, y)
+        return room
+
+    def map_view(self, size: Tuple[int, int]) -> "MapView":
+        if self.view_cache is None or self.view_cache.size != size:
+            self.view_cache = MapView(self, size)
+        return self.view_cache
+
+    def explored_count(self) -> int:
+        """Number of visited rooms (O(1) for packed and lazy grids)."""
+        if isinstance(self.grid, list):
+            return sum(room.visited for row in self.grid for room in row)
+        return self.grid.visited_count
 
 # --------------------------
 # Generation helpers
 # --------------------------
-def roll_4d6_drop_lowest() -> int:
-    rolls = sorted([random.randint(1, 6) for _ in range(4)], reverse=True)
-    return sum(rolls[:3])
+def roll_4d6_drop_lowest(rng=random) -> int:
+    return roll("4d6kh3", rng)
 
-def generate_attributes() -> Dict[str, int]:
-    vals = [roll_4d6_drop_lowest() for _ in ATTRS]
-    random.shuffle(vals)
+def generate_attributes(rng=random) -> Dict[str, int]:
+    vals = [roll_4d6_drop_lowest(rng) for _ in ATTRS]
+    rng.shuffle(vals)
     return {attr: vals[i] for i, attr in enumerate(ATTRS)}
 
-def apply_race_bonuses(attrs: Dict[str, int], race: str) -> Dict[str, int]:
+def apply_race_bonuses(attrs: Dict[str, int], race: str, rng=random) -> Dict[str, int]:
     bonuses = RACES[race]["bonuses"]
     out = dict(attrs)
     if "ANY" in bonuses:
-        choice = random.choice(ATTRS)
+        choice = rng.choice(ATTRS)
         out[choice] += bonuses["ANY"]
     for k, v in bonuses.items():
         if k == "ANY": continue
@@ -300,909 +1040,4516 @@ def starting_hp(attrs: Dict[str, int], char_class: str) -> int:
     die = CLASSES[char_class]["hp_die"]
     return max(1, die + max(0, (attrs["CON"] - 10)//2))
 
-def new_character() -> Character:
-    print("\n--- Welcome to Dungeon Adventure: Ravensburg ---")
-    name = input("CALL ME (character name): ").strip() or "Hero"
-    print("Choose race:", ", ".join(RACES.keys()))
-    race = ""
-    while race not in RACES:
-        race = input("Race: ").title().strip()
-    print("Choose class:", ", ".join(CLASSES.keys()))
-    char_class = ""
-    while char_class not in CLASSES:
-        char_class = input("Class: ").title().strip()
-
-    base_attrs = generate_attributes()
-    base_attrs = apply_race_bonuses(base_attrs, race)
-
-    print("\nRolled attributes:")
-    for a in ATTRS:
-        print(f"  {a}: {base_attrs[a]}")
-    swap = input("Do you want to swap two attributes once? (y/n): ").lower().startswith("y")
-    if swap:
-        a = input("Swap FROM (e.g., STR): ").upper().strip()
-        b = input("Swap TO (e.g., DEX): ").upper().strip()
-        if a in ATTRS and b in ATTRS:
-            base_attrs[a], base_attrs[b] = base_attrs[b], base_attrs[a]
-            print("Swapped.")
-        else:
-            print("Invalid swap; keeping original values.")
-
-    hp = starting_hp(base_attrs, char_class)
+def create_character(name: str, race: str, char_class: str, attrs: Dict[str, int]) -> Character:
+    """
+    Build a level-1 character with the class starting kit.
+    """
+    hp = starting_hp(attrs, char_class)
     start = CLASSES[char_class]["start"]
-    weapon = start["weapon"]
-    armor = start["armor"]
-    gold = start.get("gold", 50)
-    spells = start.get("spells", [])
-    c = Character(
+    return Character(
         name=name,
         race=race,
         char_class=char_class,
-        attrs=base_attrs,
+        attrs=attrs,
         level=1,
         xp=0,
-        gold=gold,
+        gold=start.get("gold", 50),
         max_hp=hp,
         hp=hp,
-        weapon=weapon,
-        armor=armor,
+        weapon=start["weapon"],
+        armor=start["armor"],
         potions={"Healing Potion": 1},
-        spells=spells[:],
+        spells=start.get("spells", [])[:],
     )
-    print("\n--- CHARACTER CREATED ---")
-    print_character(c)
-    return c
 
 def print_character(c: Character):
-    print(f"\n{c.name} — Level {c.level} {c.race} {c.char_class}")
-    print("Attributes: " + ", ".join([f"{a} {c.attrs[a]} ({c.mod(a):+d})" for a in ATTRS]))
-    print(f"HP: {c.hp}/{c.max_hp}   AC: {c.calc_ac()}   XP: {c.xp}   Gold: {c.gold}")
-    print(f"Weapon: {c.weapon}   Armor: {c.armor}")
+    say(f"\n{c.name} — Level {c.level} {c.race} {c.char_class}")
+    say("Attributes: " + ", ".join([f"{a} {c.attrs[a]} ({c.mod(a):+d})" for a in ATTRS]))
+    say(f"HP: {c.hp}/{c.max_hp}   AC: {c.calc_ac()}   XP: {c.xp}   Gold: {c.gold}")
+    say(f"Weapon: {c.weapon}   Armor: {c.armor}")
     if c.potions:
         p = ", ".join([f"{k} x{v}" for k, v in c.potions.items()])
-        print(f"Potions: {p}")
+        say(f"Potions: {p}")
     if c.spells:
-        print("Spells: " + ", ".join(c.spells))
+        say("Spells: " + ", ".join(c.spells))
 
-def chest_payload() -> Dict[str, Any]:
-    """
-    Build a chest with trap + lock + loot.
-    """
-    gold_amt = roll("2d6+6")
-    potion = random.choice([None, "Healing Potion", "Greater Healing", None])
-    has_trap = random.random() < 0.55
-    has_lock = random.random() < 0.75
-    trap_dc = 11 + random.randint(0, 6)
-    lock_dc = 12 + random.randint(0, 6)
+def make_chest(gold: int, potion: Optional[str], trapped: bool, locked: bool,
+               trap_dc: int, lock_dc: int) -> Dict[str, Any]:
+    """The chest content dict, unopened and with its trap still unknown."""
     return {
         "type": "chest",
         "opened": False,
-        "locked": has_lock,
+        "locked": locked,
         "lock_jammed": False,
         "lock_dc": lock_dc,
         "trap": {
-            "armed": has_trap,
+            "armed": trapped,
             "dc": trap_dc,
             "known": False,        # set True after a successful EXAMINE
             "disarmed": False
         },
         "loot": {
-            "gold": gold_amt,
+            "gold": gold,
             "potion": potion
         }
     }
 
-def generate_dungeon(rows=10, cols=10) -> Dungeon:
+def chest_payload(rng=random) -> Dict[str, Any]:
+    """
+    Build a chest with trap + lock + loot.
+    """
+    gold_amt = roll(CHEST_GOLD, rng)
+    potion = rng.choice(CHEST_POTIONS)
+    has_trap = rng.random() < CHEST_TRAP_CHANCE
+    has_lock = rng.random() < CHEST_LOCK_CHANCE
+    trap_dc = rng.randint(*CHEST_TRAP_DC)
+    lock_dc = rng.randint(*CHEST_LOCK_DC)
+    return make_chest(gold_amt, potion, has_trap, has_lock, trap_dc, lock_dc)
+
+GRID_BACKENDS = ("list", "lazy", "compact", "mmap")
+
+def generate_dungeon(rows=10, cols=10, seed: Optional[int] = None, rng=None, backend: str = "list",
+                     path: Optional[str] = None) -> Dungeon:
+    """
+    Build a rows x cols dungeon. The same seed always yields the same dungeon
+    from the same generator (see dungeon_generator): list, compact and mmap
+    grids sample the whole grid in one batch (see _batch_rooms), and NumPy
+    and pure-Python batches draw different streams, so a seed lays out a
+    different map on a host without NumPy. Lazy grids are the same everywhere.
+    Without a seed a fresh one is drawn; both are recorded on the Dungeon.
+    backend picks the grid: "list" of Rooms, "lazy" (LazyGrid, rooms made on demand),
+    "compact" (CompactGrid, packed byte arrays) or "mmap" (MmapGrid, the packed
+    records written to `path`, default MMAP_DUNGEON_FILE).
+    """
+    if rng is None:
+        if seed is None:
+            seed = random.getrandbits(32)
+        rng = random.Random(seed)
+    if backend not in GRID_BACKENDS:
+        raise ValueError(f"Unknown grid backend: {backend!r}")
+    if backend == "lazy":
+        if seed is None:
+            seed = rng.getrandbits(32)
+        grid = LazyGrid(seed, rows, cols)
+        return Dungeon(rows, cols, grid, (0, 0), grid.boss_pos, seed, generator=dungeon_generator(backend))
+    arrays, other = _batch_rooms(rows * cols, rng)
+    if backend == "compact":
+        grid = CompactGrid.from_arrays(rows, cols, arrays, other)
+    elif backend == "mmap":
+        if other:
+            i = min(other)
+            raise ValueError(f"room {i // cols},{i % cols} ({other[i].kind}) doesn't fit a dungeon map record")
+        grid = MmapGrid.create(path or MMAP_DUNGEON_FILE, rows, cols, seed)
+        for name, data in zip(CompactGrid.FIELDS, arrays):
+            getattr(grid, name)[:] = data
+    else:
+        grid = _rooms_from_arrays(rows, cols, arrays, other)
+    boss_pos = (rng.randint(rows//2, rows-1), rng.randint(cols//2, cols-1))
+    grid[boss_pos[0]][boss_pos[1]] = Room(False, "boss", {"monster": NECROMANCER})
+    return Dungeon(rows, cols, grid, (0, 0), boss_pos, seed, generator=dungeon_generator(backend))
+
+def dungeon_generator(backend: str = "list") -> str:
+    """
+    Name of the stream generate_dungeon() lays `backend` out from on this host:
+    "numpy" or "python" for batched grids, "lazy" for per-room seeds. A seed
+    reproduces its dungeon only under the same generator.
+    """
+    if backend == "lazy":
+        return "lazy"
+    return "python" if np is None else "numpy"
+
+def random_room(rng=random) -> Room:
+    """One room on its own; LazyGrid rooms are made this way from their room_seed."""
+    kind = rng.choices(ROOM_TYPES, weights=ROOM_WEIGHTS)[0]
+    content = None
+    if kind == "monster":
+        content = {"monster": rng.choice(MONSTER_TEMPLATES)}
+    elif kind == "trap":
+        content = {"dc": rng.randint(*TRAP_DC), "dmg": TRAP_DAMAGE}
+    elif kind == "treasure":
+        content = chest_payload(rng)
+    elif kind == "fountain":
+        content = {"type": rng.choice(FOUNTAIN_TYPES)}
+    return Room(False, kind, content)
+
+@functools.lru_cache(maxsize=4)
+def _monster_alias(count: int) -> AliasTable:
+    return AliasTable([1] * count)
+
+def _batch_rooms(n: int, rng) -> Tuple[List[bytes], Dict[int, Room]]:
+    """
+    Sample n rooms at once, with the same distributions as random_room(), as
+    CompactGrid field arrays (in FIELDS order) plus the rooms that don't pack.
+    Kinds, monsters and fountains come from alias tables; with NumPy every
+    field is one vectorized draw, including all chest payloads.
+    """
+    monsters = _monster_alias(len(MONSTER_TEMPLATES))
+    if np is None:
+        return _batch_rooms_py(n, rng, monsters)
+    gen = _numpy_rng(rng)
+    kind = ROOM_ALIAS.sample_many(gen, n)
+    at = {name: np.flatnonzero(kind == t) for t, name in enumerate(ROOM_TYPES)}
+    fields = {name: np.zeros(n, dtype=np.uint8) for name in CompactGrid.FIELDS}
+    fields["kinds"][:] = np.array([_KIND_CODE[name] for name in ROOM_TYPES], dtype=np.uint8)[kind]
+
+    aux = np.zeros(n, dtype=np.int64)
+    aux[at["monster"]] = monsters.sample_many(gen, len(at["monster"]))
+    aux[at["trap"]] = gen.integers(TRAP_DC[0], TRAP_DC[1] + 1, size=len(at["trap"]))
+    aux[at["fountain"]] = FOUNTAIN_ALIAS.sample_many(gen, len(at["fountain"]))
+    other: Dict[int, Room] = {}
+    for i in at["monster"][aux[at["monster"]] > 0xFF].tolist():
+        other[i] = Room(False, "monster", {"monster": MONSTER_TEMPLATES[aux[i]]})
+        fields["kinds"][i] = _KIND_OTHER
+        aux[i] = 0
+    fields["aux"][:] = aux
+
+    chests, count = at["treasure"], len(at["treasure"])
+    fields["gold"][chests] = roll_many(CHEST_GOLD, count, gen)
+    potion_codes = np.array([POTION_CODES.index(p) for p in CHEST_POTIONS], dtype=np.uint8)
+    fields["potion"][chests] = potion_codes[gen.integers(0, len(CHEST_POTIONS), size=count)]
+    trapped = gen.random(count) < CHEST_TRAP_CHANCE
+    locked = gen.random(count) < CHEST_LOCK_CHANCE
+    fields["chest_flags"][chests] = trapped * CHEST_FLAG_BITS["trap_armed"] + locked * CHEST_FLAG_BITS["locked"]
+    fields["trap_dc"][chests] = gen.integers(CHEST_TRAP_DC[0], CHEST_TRAP_DC[1] + 1, size=count)
+    fields["lock_dc"][chests] = gen.integers(CHEST_LOCK_DC[0], CHEST_LOCK_DC[1] + 1, size=count)
+    return [fields[name].tobytes() for name in CompactGrid.FIELDS], other
+
+def _batch_rooms_py(n: int, rng, monsters: AliasTable) -> Tuple[List[bytes], Dict[int, Room]]:
+    """_batch_rooms() without NumPy: one alias draw per room, fields filled in place."""
+    kinds, aux = bytearray(n), bytearray(n)
+    chest_flags, lock_dc, trap_dc, gold, potion = (bytearray(n) for _ in range(5))
+    other: Dict[int, Room] = {}
+    codes = [_KIND_CODE[name] for name in ROOM_TYPES]
+    monster, trap, treasure, fountain = (ROOM_TYPES.index(name) for name in ("monster", "trap", "treasure", "fountain"))
+    potion_codes = [POTION_CODES.index(p) for p in CHEST_POTIONS]
+    trap_bit, lock_bit = CHEST_FLAG_BITS["trap_armed"], CHEST_FLAG_BITS["locked"]
+    room_kind, monster_kind, fountain_kind = ROOM_ALIAS.sample, monsters.sample, FOUNTAIN_ALIAS.sample
+    chest_gold = compile_dice(CHEST_GOLD).roll
+    randint, rand = rng.randint, rng.random
+    for i in range(n):
+        t = room_kind(rng)
+        kinds[i] = codes[t]
+        if t == monster:
+            m = monster_kind(rng)
+            if m > 0xFF:
+                other[i] = Room(False, "monster", {"monster": MONSTER_TEMPLATES[m]})
+                kinds[i] = _KIND_OTHER
+            else:
+                aux[i] = m
+        elif t == trap:
+            aux[i] = randint(*TRAP_DC)
+        elif t == fountain:
+            aux[i] = fountain_kind(rng)
+        elif t == treasure:
+            gold[i] = chest_gold(rng)
+            potion[i] = potion_codes[rng.randrange(len(potion_codes))]
+            chest_flags[i] = (trap_bit if rand() < CHEST_TRAP_CHANCE else 0) | (lock_bit if rand() < CHEST_LOCK_CHANCE else 0)
+            trap_dc[i] = randint(*CHEST_TRAP_DC)
+            lock_dc[i] = randint(*CHEST_LOCK_DC)
+    return [kinds, bytearray(n), aux, chest_flags, lock_dc, trap_dc, gold, potion], other
+
+def _rooms_from_arrays(rows: int, cols: int, arrays: List[bytes], other: Dict[int, Room]) -> List[List[Room]]:
+    """Unpack _batch_rooms() output into the list-of-Rooms grid."""
+    kinds, _, aux, chest_flags, lock_dc, trap_dc, gold, potion = arrays
+    monster, trap, treasure, fountain = (_KIND_CODE[name] for name in ("monster", "trap", "treasure", "fountain"))
+    trap_bit, lock_bit = CHEST_FLAG_BITS["trap_armed"], CHEST_FLAG_BITS["locked"]
     grid: List[List[Room]] = []
-    for i in range(rows):
+    for x in range(rows):
         row: List[Room] = []
-        for j in range(cols):
-            kind = random.choices(ROOM_TYPES, weights=[35, 15, 20, 10, 20])[0]
-            content = None
-            if kind == "monster":
-                content = {"monster": random.choice(MONSTER_TEMPLATES)}
-            elif kind == "trap":
-                content = {"dc": 12 + random.randint(0, 4), "dmg": "1d6+2"}
-            elif kind == "treasure":
-                content = chest_payload()
-            elif kind == "fountain":
-                content = {"type": random.choice(["heal", "buff", "poison"])}
-            row.append(Room(False, kind, content))
+        for i in range(x * cols, (x + 1) * cols):
+            code = kinds[i]
+            if code == monster:
+                room = Room(False, "monster", {"monster": MONSTER_TEMPLATES[aux[i]]})
+            elif code == trap:
+                room = Room(False, "trap", {"dc": aux[i], "dmg": TRAP_DAMAGE})
+            elif code == treasure:
+                flags = chest_flags[i]
+                room = Room(False, "treasure", make_chest(gold[i], POTION_CODES[potion[i]], bool(flags & trap_bit),
+                                                          bool(flags & lock_bit), trap_dc[i], lock_dc[i]))
+            elif code == fountain:
+                room = Room(False, "fountain", {"type": FOUNTAIN_TYPES[aux[i]]})
+            elif code == _KIND_OTHER:
+                room = other[i]
+            else:
+                room = Room(False, ROOM_KINDS[code], None)
+            row.append(room)
         grid.append(row)
-    boss_pos = (random.randint(rows//2, rows-1), random.randint(cols//2, cols-1))
-    grid[boss_pos[0]][boss_pos[1]] = Room(False, "boss", {"monster": NECROMANCER})
-    return Dungeon(rows, cols, grid, (0, 0), boss_pos)
+    return grid
 
 # --------------------------
-# Persistence (robust)
+# Lazy dungeons (huge maps)
 # --------------------------
-def _atomic_write_json(path: str, data: Dict[str, Any]):
-    tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
-    os.replace(tmp, path)
+LAZY_CHUNK = 32          # chunks are LAZY_CHUNK x LAZY_CHUNK rooms
+LAZY_MAX_CHUNKS = 256    # resident chunks kept before the least recently used is dropped
 
-def save_game(c: Character, d: Dungeon):
-    data = {
-        "version": SAVE_VERSION,
-        "character": c.to_dict(),
-        "dungeon": d.to_dict(),
-    }
-    try:
-        _atomic_write_json(SAVE_FILE, data)
-        print(f"\n[SAVED] Game saved to {SAVE_FILE}")
-    except Exception as e:
-        print(f"[SAVE ERROR] {e}")
+_MASK64 = (1 << 64) - 1
 
-def load_game() -> Tuple[Optional[Character], Optional[Dungeon]]:
-    if not os.path.exists(SAVE_FILE):
-        print("No save file found.")
-        return None, None
-    try:
-        with open(SAVE_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        version = int(data.get("version", 1))
-        ch = data["character"]
-        dg = data["dungeon"]
-        c = Character.from_dict(ch)
-        d = Dungeon.from_dict(dg)
-        if version != SAVE_VERSION:
-            print(f"[Loaded save version {version}] Converted to current format.")
-        print("[LOADED] Save loaded.")
-        return c, d
-    except Exception as e:
-        print(f"[LOAD ERROR] {e}")
-        return None, None
+def _mix64(z: int) -> int:
+    """splitmix64 finalizer: a cheap, well-distributed 64-bit hash."""
+    z = (z + 0x9E3779B97F4A7C15) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
 
-def add_to_hof(name: str):
-    hof = []
-    if os.path.exists(HOF_FILE):
-        try:
-            with open(HOF_FILE, "r", encoding="utf-8") as f:
-                hof = json.load(f)
-        except Exception:
-            hof = []
-    hof.append({"name": name, "title": "Slayer of the Necromancer"})
-    try:
-        _atomic_write_json(HOF_FILE, hof)
-        print("\n*** Your name has been etched into the HALL OF FAME! ***")
-    except Exception as e:
-        print(f"[HOF SAVE ERROR] {e}")
+def room_seed(seed: int, x: int, y: int) -> int:
+    return _mix64(_mix64(_mix64(seed) ^ x) ^ y)
 
-def show_hof():
-    if not os.path.exists(HOF_FILE):
-        print("The Hall of Fame is empty… for now.")
-        return
-    try:
-        with open(HOF_FILE, "r", encoding="utf-8") as f:
-            hof = json.load(f)
-        print("\n--- HALL OF FAME ---")
-        for i, entry in enumerate(hof, 1):
-            print(f"{i}. {entry['name']} — {entry['title']}")
-    except Exception as e:
-        print(f"[HOF LOAD ERROR] {e}")
+class GridRow:
+    """One row of a non-list grid, so `grid[x][y]` keeps working for callers."""
+    __slots__ = ("grid", "x")
 
-# --------------------------
-# Town / Shop
-# --------------------------
-def town_menu(c: Character, d: Dungeon):
-    print(
-        "\nRavensburg needs your help! Monsters spill from the dungeon. "
-        "Prepare in town, then venture forth to find and slay the Evil Necromancer."
-    )
-    while True:
-        print("\n--- TOWN ---")
-        print("Commands: LIST, PURCHASE <item>, SELL <item>, REST, TRAIN, ENTER DUNGEON, SAVE, LOAD, HOF, STATUS, INVENTORY, EQUIP <weapon>, WEAR <armor>, HELP, QUIT")
-        cmd = input("> ").strip()
-        if not cmd:
-            continue
-        low = cmd.lower()
-        if low == "help":
-            print_town_help()
-        elif low == "list":
-            list_shop()
-        elif low.startswith("purchase "):
-            item = cmd[9:].strip()
-            purchase(c, item)
-        elif low.startswith("sell "):
-            item = cmd[5:].strip()
-            sell(c, item)
-        elif low == "rest":
-            rest(c)
-        elif low == "train":
-            train(c)
-        elif low == "status":
-            print_character(c)
-        elif low == "inventory":
-            show_inventory(c)
-        elif low.startswith("equip "):
-            item = cmd[6:].strip()
-            equip_weapon(c, item)
-        elif low.startswith("wear "):
-            item = cmd[5:].strip()
-            wear_armor(c, item)
-        elif low == "enter dungeon":
-            explore_loop(c, d)
-            if c.hp <= 0:
-                print("You limp back to town… or rather, are carried. (Game over if HP is 0.)")
-                return
-        elif low == "save":
-            save_game(c, d)
-        elif low == "load":
-            cc, dd = load_game()
-            if cc and dd:
-                c.__dict__.update(cc.__dict__)
-                d.rows = dd.rows; d.cols = dd.cols; d.grid = dd.grid; d.player_pos = dd.player_pos; d.boss_pos = dd.boss_pos
-        elif low == "hof":
-            show_hof()
-        elif low == "quit":
-            print("Farewell, hero.")
-            sys.exit(0)
-        else:
-            print("Unknown command. Type HELP.")
+    def __init__(self, grid, x: int):
+        self.grid = grid
+        self.x = x
 
-def print_town_help():
-    print("""
-TOWN COMMANDS:
-  LIST                             – List items for sale
-  PURCHASE <item>                  – Buy an item (weapon/armor/potion/spell)
-  SELL <item>                      – Sell an item you own
-  REST                             – Fully heal
-  TRAIN                            – Small stat training (costs gold)
-  ENTER DUNGEON                    – Venture into the dungeon
-  STATUS / INVENTORY               – Show your character / items
-  EQUIP <weapon> / WEAR <armor>    – Change your loadout
-  SAVE / LOAD                      – Save or load your game
-  HOF                              – Show Hall of Fame
-  QUIT                             – Exit game
-    """)
+    def __getitem__(self, y: int) -> Room:
+        return self.grid.room(self.x, y)
 
-def list_shop():
-    print("\n--- SHOP (Weapons) ---")
-    for k, v in WEAPONS.items():
-        print(f"  {k:<12} {v['cost']:>4}g  dmg {v['damage']} ({v['attr']})")
-    print("\n--- SHOP (Armors) ---")
-    for k, v in ARMORS.items():
-        cap = v['dex_cap'] if v['dex_cap'] is not None else '—'
-        print(f"  {k:<12} {v['cost']:>4}g  base AC {v['base_ac']}  dex cap: {cap}")
-    print("\n--- SHOP (Potions) ---")
-    for k, v in POTIONS.items():
-        print(f"  {k:<16} {v['cost']:>4}g")
-    print("\n--- SHOP (Spells) ---")
-    for k, v in SPELLS.items():
-        print(f"  {k:<16} {v['cost']:>4}g  – {v['desc']}")
+    def __setitem__(self, y: int, room: Room):
+        self.grid.set_room(self.x, y, room)
 
-def purchase(c: Character, item: str):
-    item_title = item.title()
-    if item_title in WEAPONS:
-        cost = WEAPONS[item_title]["cost"]
-        if c.gold >= cost:
-            c.gold -= cost
-            print(f"Purchased {item_title}. Use 'EQUIP {item_title}' to wield it.")
-        else:
-            print("Not enough gold.")
-    elif item_title in ARMORS:
-        cost = ARMORS[item_title]["cost"]
-        if c.gold >= cost:
-            c.gold -= cost
-            print(f"Purchased {item_title}. Use 'WEAR {item_title}' to don it.")
-        else:
-            print("Not enough gold.")
-    elif item_title in POTIONS:
-        cost = POTIONS[item_title]["cost"]
-        if c.gold >= cost:
-            c.gold -= cost
-            c.add_potion(item_title, 1)
-            print(f"Purchased {item_title}.")
-        else:
-            print("Not enough gold.")
-    elif item_title in SPELLS:
-        cost = SPELLS[item_title]["cost"]
-        if item_title in c.spells:
-            print("You already know that spell.")
-            return
-        if c.gold >= cost:
-            c.gold -= cost
-            c.learn_spell(item_title)
-            print(f"Learned spell {item_title}.")
-        else:
-            print("Not enough gold.")
-    else:
-        print("Item not found.")
+    def __len__(self) -> int:
+        return self.grid.cols
 
-def sell(c: Character, item: str):
-    item_title = item.title()
-    if item_title == c.weapon:
-        price = WEAPONS.get(item_title, {}).get("cost", 0)//2
-        c.gold += price
-        c.weapon = "Dagger"
-        print(f"Sold {item_title} for {price}g. You equip a Dagger.")
-    elif item_title == c.armor:
-        price = ARMORS.get(item_title, {}).get("cost", 0)//2
-        c.gold += price
-        c.armor = "Clothes"
-        print(f"Sold {item_title} for {price}g. You wear Clothes.")
-    elif item_title in c.potions and c.potions[item_title] > 0:
-        price = POTIONS.get(item_title, {}).get("cost", 0)//2
-        c.potions[item_title] -= 1
-        if c.potions[item_title] <= 0:
-            del c.potions[item_title]
-        c.gold += price
-        print(f"Sold 1x {item_title} for {price}g.")
-    elif item_title in c.spells:
-        print("You cannot sell knowledge once learned.")
-    else:
-        print("You don't have that item equipped/owned.")
+    def __iter__(self):
+        return (self.grid.room(self.x, y) for y in range(self.grid.cols))
 
-def rest(c: Character):
-    c.hp = c.max_hp
-    c.effects = Effects()
-    print("You rest at the inn. Fully healed and refreshed.")
+class LazyGrid:
+    """
+    Room grid whose rooms are derived from hash(seed, x, y) when first looked at.
+    Untouched rooms live only in a bounded LRU of chunks and are regenerated
+    identically if needed again; visited or replaced rooms are kept for good and
+    are all that gets saved, so memory follows the explored area, not the map size.
+    """
+    def __init__(self, seed: int, rows: int, cols: int, rooms: Optional[Dict[Tuple[int, int], Room]] = None):
+        self.seed = seed
+        self.rows = rows
+        self.cols = cols
+        brng = random.Random(seed)
+        self.boss_pos = (brng.randint(rows//2, rows-1), brng.randint(cols//2, cols-1))
+        self.kept: Dict[Tuple[int, int], Room] = dict(rooms or {})
+        self.chunks: "collections.OrderedDict[Tuple[int, int], Dict[Tuple[int, int], Room]]" = collections.OrderedDict()
+        # Rooms here are plain objects, so Dungeon.visit() and set_room() keep this in step
+        self.visited_count = sum(1 for r in self.kept.values() if r.visited)
 
-def train(c: Character):
-    cost = 40
-    print(f"Training costs {cost}g and gives +1 to a chosen attribute.")
-    if c.gold < cost:
-        print("Not enough gold.")
-        return
-    choice = input("Train which attribute (STR/DEX/INT/CON/WIS/CHA/PER)? ").upper().strip()
+    def generate(self, x: int, y: int) -> Room:
+        if (x, y) == self.boss_pos:
+            return Room(False, "boss", {"monster": NECROMANCER})
+        return random_room(random.Random(room_seed(self.seed, x, y)))
+
+    def room(self, x: int, y: int) -> Room:
+        pos = (x, y)
+        r = self.kept.get(pos)
+        if r is not None:
+            return r
+        key = (x // LAZY_CHUNK, y // LAZY_CHUNK)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = {}
+            if len(self.chunks) > LAZY_MAX_CHUNKS:
+                self._evict()
+        else:
+            self.chunks.move_to_end(key)
+        r = chunk.get(pos)
+        if r is None:
+            r = chunk[pos] = self.generate(x, y)
+        return r
+
+    def set_room(self, x: int, y: int, room: Room):
+        old = self.peek(x, y)
+        self.visited_count += room.visited - (old is not None and old.visited)
+        chunk = self.chunks.get((x // LAZY_CHUNK, y // LAZY_CHUNK))
+        if chunk is not None:
+            chunk.pop((x, y), None)
+        self.kept[(x, y)] = room
+
+    def peek(self, x: int, y: int) -> Optional[Room]:
+        """The room at (x, y) if it is resident, without generating it (unvisited if None)."""
+        r = self.kept.get((x, y))
+        if r is None:
+            chunk = self.chunks.get((x // LAZY_CHUNK, y // LAZY_CHUNK))
+            if chunk is not None:
+                r = chunk.get((x, y))
+        return r
+
+    def _evict(self):
+        _, chunk = self.chunks.popitem(last=False)
+        for pos, r in chunk.items():
+            if r.visited:
+                self.kept[pos] = r
+
+    def touched(self) -> Dict[Tuple[int, int], Room]:
+        """Every room that differs from what the seed would generate."""
+        out = dict(self.kept)
+        for chunk in self.chunks.values():
+            for pos, r in chunk.items():
+                if r.visited:
+                    out[pos] = r
+        return out
+
+    def __getitem__(self, x: int) -> GridRow:
+        return GridRow(self, x)
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def __iter__(self):
+        return (GridRow(self, x) for x in range(self.rows))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "seed": self.seed,
+            "rooms": [[x, y, r.to_dict()] for (x, y), r in self.touched().items()],
+        }
+
+    @staticmethod
+    def from_dict(d: Dict[str, Any], rows: int, cols: int) -> "LazyGrid":
+        rooms = {(int(x), int(y)): Room.from_dict(r) for x, y, r in d.get("rooms", [])}
+        return LazyGrid(int(d["seed"]), rows, cols, rooms)
+
+# --------------------------
+# Compact dungeons (struct-of-arrays)
+# --------------------------
+ROOM_KINDS = ROOM_TYPES + ["boss"]
+_KIND_CODE = {k: i for i, k in enumerate(ROOM_KINDS)}
+_KIND_OTHER = 255  # room that doesn't fit the packed schema; kept whole in CompactGrid.other
+POTION_CODES = [None, "Healing Potion", "Greater Healing"]
+
+# chest booleans packed into one flags byte per room
+CHEST_FLAG_BITS = {"opened": 1, "locked": 2, "lock_jammed": 4, "trap_armed": 8, "trap_known": 16, "trap_disarmed": 32}
+CHEST_BYTE_FIELDS = ("lock_dc", "trap_dc", "gold", "potion")
+
+# fog-of-war glyphs by visited byte, in latin-1 so rows render with bytes.translate
+_FOG_TABLE = bytes([0x20, 0xB7]) + b" " * 254
+
+class _ChestPart(collections.abc.MutableMapping):
+    """The "trap" or "loot" sub-dict of a packed chest."""
+    __slots__ = ("grid", "i", "fields")
+
+    def __init__(self, grid, i: int, fields: Dict[str, str]):
+        self.grid = grid
+        self.i = i
+        self.fields = fields
+
+    def __getitem__(self, key):
+        return self.grid.chest_get(self.i, self.fields[key])
+
+    def __setitem__(self, key, value):
+        self.grid.chest_set(self.i, self.fields[key], value)
+
+    def __delitem__(self, key):
+        raise TypeError("packed chest fields cannot be removed")
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+class ChestView(collections.abc.MutableMapping):
+    """
+    A packed chest that reads and writes like the dict chest_payload() builds,
+    so the chest_* actions work on it unchanged.
+    """
+    __slots__ = ("grid", "i")
+    _TOP = {"opened": "opened", "locked": "locked", "lock_jammed": "lock_jammed", "lock_dc": "lock_dc"}
+    _TRAP = {"armed": "trap_armed", "dc": "trap_dc", "known": "trap_known", "disarmed": "trap_disarmed"}
+    _LOOT = {"gold": "gold", "potion": "potion"}
+    _KEYS = ("type", "opened", "locked", "lock_jammed", "lock_dc", "trap", "loot")
+
+    def __init__(self, grid, i: int):
+        self.grid = grid
+        self.i = i
+
+    def __getitem__(self, key):
+        if key == "type":
+            return "chest"
+        if key == "trap":
+            return _ChestPart(self.grid, self.i, self._TRAP)
+        if key == "loot":
+            return _ChestPart(self.grid, self.i, self._LOOT)
+        return self.grid.chest_get(self.i, self._TOP[key])
+
+    def __setitem__(self, key, value):
+        if key not in self._TOP:
+            raise KeyError(key)
+        self.grid.chest_set(self.i, self._TOP[key], value)
+
+    def __delitem__(self, key):
+        raise TypeError("packed chest fields cannot be removed")
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self) -> int:
+        return len(self._KEYS)
+
+    def to_dict(self) -> Dict[str, Any]:
+        out = dict(self)
+        out["trap"] = dict(out["trap"])
+        out["loot"] = dict(out["loot"])
+        return out
+
+class RoomView:
+    """Room-compatible handle on one cell of a packed grid."""
+    __slots__ = ("grid", "i")
+
+    def __init__(self, grid, i: int):
+        self.grid = grid
+        self.i = i
+
+    @property
+    def visited(self) -> bool:
+        return self.grid.is_visited(self.i)
+
+    @visited.setter
+    def visited(self, value: bool):
+        self.grid.set_visited(self.i, value)
+
+    @property
+    def kind(self) -> str:
+        return ROOM_KINDS[self.grid.kind_code(self.i)]
+
+    @property
+    def content(self) -> Optional[Dict[str, Any]]:
+        return self.grid.content(self.i)
+
+    def to_dict(self) -> Dict[str, Any]:
+        content = self.content
+        if isinstance(content, ChestView):
+            content = content.to_dict()
+        return {"visited": self.visited, "kind": self.kind, "content": content}
+
+class CompactGrid:
+    """
+    Room grid stored as parallel byte arrays, about 8 bytes per room instead of a
+    Room object with nested dicts. kinds/visited are one byte per room; `aux` holds
+    the monster template index, trap DC or fountain type; chests use the chest_*
+    arrays. Rooms that don't fit (custom monsters, odd content) go in `other`.
+    """
+    FIELDS = ("kinds", "visited", "aux", "chest_flags", "lock_dc", "trap_dc", "gold", "potion")
+
+    def __init__(self, rows: int, cols: int):
+        n = rows * cols
+        self.rows = rows
+        self.cols = cols
+        self.kinds = bytearray([_KIND_CODE["empty"]]) * n
+        self.visited = bytearray(n)
+        self.aux = bytearray(n)
+        self.chest_flags = bytearray(n)
+        self.lock_dc = bytearray(n)
+        self.trap_dc = bytearray(n)
+        self.gold = bytearray(n)
+        self.potion = bytearray(n)
+        self.other: Dict[int, Room] = {}
+        self.bosses: set = set()
+        self.visited_count = 0
+
+    @staticmethod
+    def from_rooms(rows: int, cols: int, grid) -> "CompactGrid":
+        cg = CompactGrid(rows, cols)
+        for x, row in enumerate(grid):
+            for y, room in enumerate(row):
+                cg.set_room(x, y, room)
+        return cg
+
+    @staticmethod
+    def from_arrays(rows: int, cols: int, arrays: List[bytes], other: Optional[Dict[int, Room]] = None) -> "CompactGrid":
+        """Adopt raw field arrays (in FIELDS order), e.g. straight from a save file."""
+        cg = CompactGrid.__new__(CompactGrid)
+        cg.rows = rows
+        cg.cols = cols
+        for name, data in zip(CompactGrid.FIELDS, arrays):
+            if len(data) != rows * cols:
+                raise ValueError(f"grid field {name} has {len(data)} bytes, expected {rows * cols}")
+            setattr(cg, name, bytearray(data))
+        cg.other = dict(other or {})
+        cg.visited_count = cg.visited.count(1)
+        boss = _KIND_CODE["boss"]
+        cg.bosses = set()
+        i = cg.kinds.find(boss)
+        while i != -1:
+            cg.bosses.add(i)
+            i = cg.kinds.find(boss, i + 1)
+        return cg
+
+    # ---- Room-compatible access ----
+    def room(self, x: int, y: int):
+        i = x * self.cols + y
+        if self.kinds[i] == _KIND_OTHER:
+            return self.other[i]
+        return RoomView(self, i)
+
+    def set_room(self, x: int, y: int, room):
+        i = x * self.cols + y
+        self.other.pop(i, None)
+        self.set_visited(i, room.visited)
+        if self._pack(i, room.kind, room.content):
+            self._mark_boss(i, room.kind)
+        else:
+            self.bosses.discard(i)
+            self.kinds[i] = _KIND_OTHER
+            self.other[i] = Room(room.visited, room.kind, room.content)
+
+    def _mark_boss(self, i: int, kind: str):
+        if kind == "boss":
+            self.bosses.add(i)
+        else:
+            self.bosses.discard(i)
+
+    def __getitem__(self, x: int) -> GridRow:
+        return GridRow(self, x)
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def __iter__(self):
+        return (GridRow(self, x) for x in range(self.rows))
+
+    # ---- field access used by RoomView / ChestView ----
+    def kind_code(self, i: int) -> int:
+        return self.kinds[i]
+
+    def is_visited(self, i: int) -> bool:
+        return bool(self.visited[i])
+
+    def set_visited(self, i: int, value: bool):
+        value = 1 if value else 0
+        if self.visited[i] != value:
+            self.visited[i] = value
+            self.visited_count += 1 if value else -1
+            if i in self.other:
+                self.other[i].visited = bool(value)
+
+    def content(self, i: int) -> Optional[Dict[str, Any]]:
+        kind = self.kinds[i]
+        if kind == _KIND_CODE["monster"]:
+            return {"monster": MONSTER_TEMPLATES[self.aux[i]]}
+        if kind == _KIND_CODE["trap"]:
+            return {"dc": self.aux[i], "dmg": TRAP_DAMAGE}
+        if kind == _KIND_CODE["treasure"]:
+            return ChestView(self, i)
+        if kind == _KIND_CODE["fountain"]:
+            return {"type": FOUNTAIN_TYPES[self.aux[i]]}
+        if kind == _KIND_CODE["boss"]:
+            return {"monster": NECROMANCER}
+        return None
+
+    def chest_get(self, i: int, field: str):
+        bit = CHEST_FLAG_BITS.get(field)
+        if bit is not None:
+            return bool(self.chest_flags[i] & bit)
+        if field == "potion":
+            return POTION_CODES[self.potion[i]]
+        return getattr(self, field)[i]
+
+    def chest_set(self, i: int, field: str, value):
+        bit = CHEST_FLAG_BITS.get(field)
+        if bit is not None:
+            if value:
+                self.chest_flags[i] |= bit
+            else:
+                self.chest_flags[i] &= ~bit & 0xFF
+        elif field == "potion":
+            self.potion[i] = POTION_CODES.index(value)
+        else:
+            getattr(self, field)[i] = value
+
+    def _pack(self, i: int, kind: str, content: Optional[Dict[str, Any]]) -> bool:
+        """
+        Store a room in the arrays; False if it doesn't fit the packed schema.
+        Every field is checked before any is written, so a room that doesn't
+        fit leaves the record as it was.
+        """
+        values: Dict[str, int] = {}
+        try:
+            if kind == "empty" and content is None:
+                pass
+            elif kind == "monster":
+                values["aux"] = CONTENT.monster_index(content["monster"])
+            elif kind == "trap":
+                if content.get("dmg") != TRAP_DAMAGE:
+                    return False
+                values["aux"] = content["dc"]
+            elif kind == "fountain":
+                values["aux"] = FOUNTAIN_TYPES.index(content["type"])
+            elif kind == "boss":
+                if content.get("monster") != NECROMANCER:
+                    return False
+            elif kind == "treasure":
+                trap, loot = content["trap"], content["loot"]
+                flags = 0
+                for name, value in (("opened", content["opened"]), ("locked", content["locked"]),
+                                    ("lock_jammed", content["lock_jammed"]), ("trap_armed", trap["armed"]),
+                                    ("trap_known", trap["known"]), ("trap_disarmed", trap["disarmed"])):
+                    if value:
+                        flags |= CHEST_FLAG_BITS[name]
+                values.update(chest_flags=flags, lock_dc=content["lock_dc"], trap_dc=trap["dc"],
+                              gold=loot["gold"], potion=POTION_CODES.index(loot["potion"]))
+            else:
+                return False
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return False
+        if not all(type(v) is int and 0 <= v <= 0xFF for v in values.values()):
+            return False
+        for name, value in values.items():
+            getattr(self, name)[i] = value
+        self.kinds[i] = _KIND_CODE[kind]
+        return True
+
+    # ---- whole-grid scans ----
+    def render_row(self, x: int, y0: int = 0, y1: Optional[int] = None) -> str:
+        """Fog-of-war glyphs for columns y0..y1-1 of row x (no player marker)."""
+        base = x * self.cols
+        start, stop = base + y0, base + (self.cols if y1 is None else y1)
+        line = bytes(self.visited[start:stop]).translate(_FOG_TABLE).decode("latin-1")
+        for i in self.bosses:
+            if start <= i < stop and self.visited[i]:
+                y = i - start
+                line = line[:y] + "B" + line[y + 1:]
+        for i, room in self.other.items():
+            if start <= i < stop and room.visited and room.kind == "boss":
+                y = i - start
+                line = line[:y] + "B" + line[y + 1:]
+        return line
+
+    def nbytes(self) -> int:
+        return sum(len(getattr(self, name)) for name in self.FIELDS)
+
+# --------------------------
+# Memory-mapped dungeons
+# --------------------------
+MMAP_DUNGEON_FILE = "rpg_dungeon.map"
+_MMAP_MAGIC = b"RVMD"
+_MMAP_VERSION = 1
+_MMAP_HEADER = struct.Struct("<4sHHIIIIQQ")  # magic, version, flags, rows, cols, boss x, boss y, dungeon seed, visited count
+_MMAP_HEADER_SIZE = 64  # room records start on a cache line
+_MMAP_HAS_SEED = 1
+_MMAP_VISITED = struct.Struct("<Q")
+_MMAP_VISITED_AT = _MMAP_HEADER.size - _MMAP_VISITED.size
+_MMAP_BOSS = struct.Struct("<II")
+_MMAP_BOSS_AT = struct.calcsize("<4sHHII")
+
+class MmapGrid(CompactGrid):
+    """
+    CompactGrid kept in a memory-mapped file: a 64-byte header, then one fixed
+    record per room holding the CompactGrid FIELDS in order. Each field is a
+    strided memoryview over the map, so a room read or write touches one page and
+    opening a map of any size is O(1). Rooms are written through to the file;
+    readonly maps use ACCESS_READ so reader processes share the page cache.
+    Rooms that don't fit a record are rejected instead of kept in `other`.
+    """
+    RECORD = len(CompactGrid.FIELDS)
+
+    def __init__(self, path: str, readonly: bool = False):
+        with open(path, "rb" if readonly else "r+b") as f:
+            head = f.read(_MMAP_HEADER_SIZE)
+            if len(head) < _MMAP_HEADER.size:
+                raise ValueError("truncated dungeon map header")
+            magic, version, flags, rows, cols, bx, by, seed, _ = _MMAP_HEADER.unpack_from(head)
+            if magic != _MMAP_MAGIC:
+                raise ValueError("not a Ravensburg dungeon map")
+            if version != _MMAP_VERSION:
+                raise ValueError(f"unsupported dungeon map version {version}")
+            size = os.fstat(f.fileno()).st_size
+            if size != _MMAP_HEADER_SIZE + rows * cols * self.RECORD:
+                raise ValueError(f"dungeon map is {size} bytes, expected {_MMAP_HEADER_SIZE + rows * cols * self.RECORD}")
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        self.path = path
+        self.readonly = readonly
+        self.rows = rows
+        self.cols = cols
+        self.seed = seed if flags & _MMAP_HAS_SEED else None
+        self.boss_pos = (bx, by)
+        self._views = [memoryview(self.mm)[_MMAP_HEADER_SIZE + k::self.RECORD] for k in range(self.RECORD)]
+        for name, view in zip(self.FIELDS, self._views):
+            setattr(self, name, view)
+        self.other = {}
+        self.bosses = set()
+        if rows and cols and self.kinds[bx * cols + by] == _KIND_CODE["boss"]:
+            self.bosses.add(bx * cols + by)
+
+    @staticmethod
+    def create(path: str, rows: int, cols: int, seed: Optional[int] = None) -> "MmapGrid":
+        """Write a map file of empty rooms and open it for writing."""
+        flags = _MMAP_HAS_SEED if seed is not None else 0
+        head = _MMAP_HEADER.pack(_MMAP_MAGIC, _MMAP_VERSION, flags, rows, cols, 0, 0, (seed or 0) & _MASK64, 0)
+        with open(path, "wb") as f:
+            f.write(head.ljust(_MMAP_HEADER_SIZE, b"\0"))
+            f.truncate(_MMAP_HEADER_SIZE + rows * cols * MmapGrid.RECORD)
+        grid = MmapGrid(path)
+        grid.kinds[:] = bytes([_KIND_CODE["empty"]]) * (rows * cols)
+        return grid
+
+    @staticmethod
+    def from_dict(d: Dict[str, Any]) -> "MmapGrid":
+        return MmapGrid(d["path"])
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Saves only reference the map file, which already holds every room."""
+        self.flush()
+        return {"path": os.path.abspath(self.path)}
+
+    @property
+    def visited_count(self) -> int:
+        return _MMAP_VISITED.unpack_from(self.mm, _MMAP_VISITED_AT)[0]
+
+    @visited_count.setter
+    def visited_count(self, value: int):
+        _MMAP_VISITED.pack_into(self.mm, _MMAP_VISITED_AT, value)
+
+    def set_room(self, x: int, y: int, room):
+        i = x * self.cols + y
+        if not self._pack(i, room.kind, room.content):
+            raise ValueError(f"room {x},{y} ({room.kind}) doesn't fit a dungeon map record")
+        self._mark_boss(i, room.kind)
+        self.set_visited(i, room.visited)
+        if room.kind == "boss":
+            self.boss_pos = (x, y)
+            _MMAP_BOSS.pack_into(self.mm, _MMAP_BOSS_AT, x, y)
+
+    def flush(self):
+        if not self.readonly:
+            self.mm.flush()
+
+    def close(self):
+        """Unmap the file; the grid is unusable afterwards."""
+        for name in self.FIELDS:
+            setattr(self, name, None)
+        for view in self._views:
+            view.release()
+        self._views = []
+        self.flush()
+        self.mm.close()
+
+def save_dungeon_map(d: Dungeon, path: str = MMAP_DUNGEON_FILE) -> Dungeon:
+    """Write any dungeon out as a map file and return a copy backed by it."""
+    grid = MmapGrid.create(path, d.rows, d.cols, d.seed)
+    for x in range(d.rows):
+        row = d.grid[x]
+        for y in range(d.cols):
+            grid.set_room(x, y, row[y])
+    grid.flush()
+    return Dungeon(d.rows, d.cols, grid, d.player_pos, d.boss_pos, d.seed, d.depth, d.cleared, d.generator)
+
+def open_dungeon_map(path: str = MMAP_DUNGEON_FILE, readonly: bool = False,
+                     player_pos: Tuple[int, int] = (0, 0)) -> Dungeon:
+    """Open a map file as a Dungeon without reading any rooms."""
+    grid = MmapGrid(path, readonly)
+    return Dungeon(grid.rows, grid.cols, grid, player_pos, grid.boss_pos, grid.seed)
+
+# --------------------------
+# Dungeon floors
+# --------------------------
+FLOOR_WORKERS = 2  # background threads, shared by every session, that build the next floor
+
+_FLOOR_POOL: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+def floor_template(template: Dict[str, Any], depth: int) -> Dict[str, Any]:
+    """
+    A monster template as it appears on floor `depth`. Floor 1 is the template
+    itself; each floor below adds 3 HP, +1 to hit, 50% more XP and 2 gold, and
+    every second floor +1 AC and +1 damage. Rooms keep the base template so
+    packed grids still store it by index.
+    """
+    k = depth - 1
+    if k <= 0:
+        return template
+    out = dict(template)
+    out["hp"] = f"{template['hp']}+{3 * k}"
+    out["ac"] = template["ac"] + k // 2
+    out["atk_bonus"] = template["atk_bonus"] + k
+    if k // 2:
+        out["dmg"] = f"{template['dmg']}+{k // 2}"
+    out["xp"] = template["xp"] + template["xp"] * k // 2
+    out["gold"] = f"{template['gold']}+{2 * k}"
+    return out
+
+def floor_seed(seed: Optional[int], depth: int) -> int:
+    """Seed of floor `depth`, derived from the seed of the floor above it."""
+    return _mix64((seed or 0) ^ (depth << 32)) & 0xFFFFFFFF
+
+def floor_map_path(path: str, depth: int) -> str:
+    """
+    Map file of floor `depth` in the same series as the map file `path` (of any
+    floor): "run.map" -> "run.floor3.map". Floor 1 is the series' own name.
+    """
+    root, ext = os.path.splitext(path)
+    root = re.sub(r"\.floor\d+$", "", root)
+    return root + ext if depth <= 1 else f"{root}.floor{depth}{ext}"
+
+def grid_backend(grid) -> str:
+    """The GRID_BACKENDS name of a dungeon grid."""
+    if isinstance(grid, LazyGrid):
+        return "lazy"
+    if isinstance(grid, MmapGrid):
+        return "mmap"
+    if isinstance(grid, CompactGrid):
+        return "compact"
+    return "list"
+
+def generate_floor(depth: int, rows: int, cols: int, seed: int, backend: str = "list",
+                   path: Optional[str] = None) -> Dungeon:
+    """generate_dungeon() for floor `depth`; mmap floors go to floor_map_path(path, depth)."""
+    if backend == "mmap":
+        path = floor_map_path(path or MMAP_DUNGEON_FILE, depth)
+    d = generate_dungeon(rows, cols, seed=seed, backend=backend, path=path)
+    d.depth = depth
+    return d
+
+def _build_floor(key: Tuple[Any, ...], serialize: bool) -> Tuple[Dungeon, Optional[str]]:
+    seed, depth, rows, cols, backend, path = key
+    d = generate_floor(depth, rows, cols, seed, backend, path)
+    return d, json.dumps(d.to_dict(), separators=(",", ":")) if serialize else None
+
+def _floor_pool() -> concurrent.futures.ThreadPoolExecutor:
+    global _FLOOR_POOL
+    if _FLOOR_POOL is None:
+        _FLOOR_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=FLOOR_WORKERS,
+                                                            thread_name_prefix="floor")
+    return _FLOOR_POOL
+
+class FloorPrefetch:
+    """
+    The floor below the current one, built on a background thread while the
+    player explores, so DESCEND only swaps it in. With `serialize` the worker
+    also encodes the fresh floor as save JSON (for SaveJournal.rebase). Stairs
+    lead down only, so the current floor and this one are all a session keeps;
+    a prefetch that no longer matches the current floor (after LOAD) is dropped.
+    """
+    def __init__(self, serialize: bool = False):
+        self.serialize = serialize
+        self.key: Optional[Tuple[Any, ...]] = None
+        self.future: Optional[concurrent.futures.Future] = None
+
+    @staticmethod
+    def _key(d: Dungeon) -> Tuple[Any, ...]:
+        backend = grid_backend(d.grid)
+        path = d.grid.path if backend == "mmap" else None
+        return (floor_seed(d.seed, d.depth + 1), d.depth + 1, d.rows, d.cols, backend, path)
+
+    def start(self, d: Dungeon):
+        """Begin building the floor below `d`, unless that is already under way."""
+        key = self._key(d)
+        if key == self.key:
+            return
+        self.cancel()
+        self.key = key
+        self.future = _floor_pool().submit(_build_floor, key, self.serialize)
+
+    def pending(self, d: Dungeon) -> Optional[concurrent.futures.Future]:
+        """The future to wait on before take(d) can return at once, or None if it's ready."""
+        self.start(d)
+        return None if self.future.done() else self.future
+
+    def take(self, d: Dungeon) -> Tuple[Dungeon, Optional[str]]:
+        """The floor below `d` and its save JSON (if serializing); waits only if it is still being built."""
+        self.start(d)
+        future = self.future
+        self.key = self.future = None
+        return future.result()
+
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+        self.key = self.future = None
+
+# --------------------------
+# Persistence (robust)
+# --------------------------
+def _atomic_write_json(path: str, data: Dict[str, Any]):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+def save_game(c: Character, d: Dungeon, seed: Optional[int] = None):
+    """
+    Write the save file. `seed` is the session RNG seed to resume from on load.
+    """
+    data = {
+        "version": SAVE_VERSION,
+        "seed": seed,
+        "character": c.to_dict(),
+        "dungeon": d.to_dict(),
+    }
+    try:
+        _atomic_write_json(SAVE_FILE, data)
+        say(f"\n[SAVED] Game saved to {SAVE_FILE}")
+    except Exception as e:
+        say(f"[SAVE ERROR] {e}")
+
+def load_game() -> Tuple[Optional[Character], Optional[Dungeon], Optional[int]]:
+    """
+    Read the save file. Returns (character, dungeon, session seed), all None on failure.
+    """
+    if not os.path.exists(SAVE_FILE):
+        say("No save file found.")
+        return None, None, None
+    try:
+        with open(SAVE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return _state_from_save(data)
+    except Exception as e:
+        say(f"[LOAD ERROR] {e}")
+        return None, None, None
+
+def _state_from_save(data: Dict[str, Any]) -> Tuple[Character, Dungeon, Optional[int]]:
+    version = int(data.get("version", 1))
+    data = migrate_save(data)
+    ch = data["character"]
+    dg = data["dungeon"]
+    c = Character.from_dict(ch)
+    d = Dungeon.from_dict(dg)
+    if version != SAVE_VERSION:
+        say(f"[Loaded save version {version}] Converted to current format.")
+    say("[LOADED] Save loaded.")
+    return c, d, data.get("seed")
+
+# --------------------------
+# Hall of Fame
+# --------------------------
+HOF_PAGE_SIZE = 10
+HOF_TITLE = "Slayer of the Necromancer"
+
+class HallOfFame:
+    """
+    Hall of Fame in SQLite. WAL mode lets readers run alongside a writer, and each
+    victory is a single INSERT, so concurrent processes never lose entries.
+    Rankings (level, then gold, then fewest turns) are served from indexes, so
+    top-N and paged queries stay fast with millions of rows, overall or per
+    class/race. Triggers keep a running count per class and race, so totals never
+    scan the table. The old JSON list is imported once when the database is created.
+    """
+    SCHEMA_VERSION = 2
+    ORDER = "level DESC, gold DESC, turns ASC, id ASC"
+    COLUMNS = ("id", "name", "title", "race", "char_class", "level", "gold", "turns", "date")
+
+    def __init__(self, path: str = HOF_DB, legacy_json: Optional[str] = HOF_FILE):
+        self.path = path
+        # autocommit; multi-statement work takes an explicit BEGIN IMMEDIATE
+        # GameServer runs Hall of Fame work on its own worker thread (see _hof_pool)
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate(legacy_json)
+
+    def _migrate(self, legacy_json: Optional[str]):
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] >= self.SCHEMA_VERSION:
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            # re-check under the write lock: another process may have just done it
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < 1:
+                for stmt in (
+                    "CREATE TABLE IF NOT EXISTS hof (id INTEGER PRIMARY KEY, name TEXT NOT NULL, title TEXT NOT NULL,"
+                    " race TEXT, char_class TEXT, level INTEGER NOT NULL DEFAULT 0, gold INTEGER NOT NULL DEFAULT 0,"
+                    " turns INTEGER NOT NULL DEFAULT 0, date TEXT)",
+                    "CREATE INDEX IF NOT EXISTS hof_rank ON hof (level DESC, gold DESC, turns, id)",
+                    "CREATE INDEX IF NOT EXISTS hof_class_rank ON hof (char_class, level DESC, gold DESC, turns, id)",
+                    "CREATE INDEX IF NOT EXISTS hof_race_rank ON hof (race, level DESC, gold DESC, turns, id)",
+                ):
+                    self.conn.execute(stmt)
+                if legacy_json and os.path.exists(legacy_json):
+                    self._import_json(legacy_json)
+            if version < 2:
+                # entries per (class, race); '' stands for a missing class or race
+                for stmt in (
+                    "CREATE TABLE IF NOT EXISTS hof_counts (char_class TEXT NOT NULL, race TEXT NOT NULL,"
+                    " n INTEGER NOT NULL, PRIMARY KEY (char_class, race))",
+                    "CREATE TRIGGER IF NOT EXISTS hof_count_add AFTER INSERT ON hof BEGIN"
+                    " INSERT INTO hof_counts VALUES (IFNULL(NEW.char_class, ''), IFNULL(NEW.race, ''), 1)"
+                    " ON CONFLICT (char_class, race) DO UPDATE SET n = n + 1; END",
+                    "CREATE TRIGGER IF NOT EXISTS hof_count_remove AFTER DELETE ON hof BEGIN"
+                    " UPDATE hof_counts SET n = n - 1"
+                    " WHERE char_class = IFNULL(OLD.char_class, '') AND race = IFNULL(OLD.race, ''); END",
+                    "DELETE FROM hof_counts",
+                    "INSERT INTO hof_counts SELECT IFNULL(char_class, ''), IFNULL(race, ''), COUNT(*) FROM hof GROUP BY 1, 2",
+                ):
+                    self.conn.execute(stmt)
+            self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def _import_json(self, path: str):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.conn.executemany(
+            "INSERT INTO hof (name, title, race, char_class, level, gold, turns, date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(e.get("name", "?"), e.get("title", HOF_TITLE), e.get("race"), e.get("char_class"),
+              int(e.get("level", 0)), int(e.get("gold", 0)), int(e.get("turns", 0)), e.get("date"))
+             for e in entries if isinstance(e, dict)])
+
+    def add(self, c: Character, title: str = HOF_TITLE) -> int:
+        """Record a victory; returns the new entry id."""
+        cur = self.conn.execute(
+            "INSERT INTO hof (name, title, race, char_class, level, gold, turns, date) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (c.name, title, c.race, c.char_class, c.level, c.gold, c.turns,
+             time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())))
+        return cur.lastrowid
+
+    @staticmethod
+    def _where(char_class: Optional[str], race: Optional[str]) -> Tuple[str, List[Any]]:
+        terms, args = [], []
+        if char_class:
+            terms.append("char_class = ?"); args.append(char_class)
+        if race:
+            terms.append("race = ?"); args.append(race)
+        return (" WHERE " + " AND ".join(terms) if terms else ""), args
+
+    def top(self, n: int = HOF_PAGE_SIZE, offset: int = 0, char_class: Optional[str] = None,
+            race: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Best n entries after skipping `offset`, optionally for one class and/or race."""
+        where, args = self._where(char_class, race)
+        rows = self.conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM hof{where} ORDER BY {self.ORDER} LIMIT ? OFFSET ?",
+                                 args + [n, offset]).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def page(self, number: int = 1, size: int = HOF_PAGE_SIZE, **filters) -> List[Dict[str, Any]]:
+        return self.top(size, (max(1, number) - 1) * size, **filters)
+
+    def count(self, char_class: Optional[str] = None, race: Optional[str] = None) -> int:
+        """Entries overall or for one class and/or race, from the running counts."""
+        where, args = self._where(char_class, race)
+        return self.conn.execute(f"SELECT IFNULL(SUM(n), 0) FROM hof_counts{where}", args).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+_HOF_STORES: Dict[str, HallOfFame] = {}
+_HOF_POOL: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+def _hof_pool() -> concurrent.futures.ThreadPoolExecutor:
+    """One thread that a server runs every Hall of Fame query and victory on, off its event loop."""
+    global _HOF_POOL
+    if _HOF_POOL is None:
+        _HOF_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="hof")
+    return _HOF_POOL
+
+def hall_of_fame(path: str = HOF_DB) -> HallOfFame:
+    """The process-wide HallOfFame for `path`, opened on first use."""
+    store = _HOF_STORES.get(path)
+    if store is None:
+        store = _HOF_STORES[path] = HallOfFame(path)
+    return store
+
+def add_to_hof(c: Character):
+    try:
+        hall_of_fame().add(c)
+        say("\n*** Your name has been etched into the HALL OF FAME! ***")
+    except sqlite3.Error as e:
+        say(f"[HOF SAVE ERROR] {e}")
+
+def parse_hof_args(args: str) -> Dict[str, Any]:
+    """
+    Arguments of the HOF command: an optional page number, TOP <n>,
+    CLASS <class> and RACE <race>, in any order.
+    """
+    out: Dict[str, Any] = {}
+    words = args.split()
+    i = 0
+    while i < len(words):
+        word = words[i].lower()
+        nxt = words[i + 1] if i + 1 < len(words) else None
+        if word.isdigit():
+            out["page"] = int(word)
+        elif word == "top" and nxt and nxt.isdigit():
+            out["top"] = int(nxt); i += 1
+        elif word == "class" and nxt:
+            out["char_class"] = nxt.title(); i += 1
+        elif word == "race" and nxt:
+            out["race"] = nxt.title(); i += 1
+        else:
+            raise ValueError(f"Unknown HOF option: {words[i]}")
+        i += 1
+    return out
+
+def show_hof(page: int = 1, top: Optional[int] = None, char_class: Optional[str] = None, race: Optional[str] = None):
+    try:
+        hof = hall_of_fame()
+        total = hof.count(char_class, race)
+        if total == 0:
+            say("The Hall of Fame is empty… for now.")
+            return
+        if top is not None:
+            page, offset, entries = 1, 0, hof.top(top, char_class=char_class, race=race)
+        else:
+            offset = (max(1, page) - 1) * HOF_PAGE_SIZE
+            entries = hof.top(HOF_PAGE_SIZE, offset, char_class=char_class, race=race)
+        scope = " / ".join(x for x in (char_class, race) if x)
+        say("\n--- HALL OF FAME ---" + (f" ({scope})" if scope else ""))
+        for i, entry in enumerate(entries, offset + 1):
+            line = f"{i}. {entry['name']} — {entry['title']}"
+            if entry["char_class"]:
+                line += f"  (Lv {entry['level']} {entry['race']} {entry['char_class']}, {entry['gold']} gold, {entry['turns']} turns, {entry['date']})"
+            say(line)
+        if top is None:
+            pages = (total + HOF_PAGE_SIZE - 1) // HOF_PAGE_SIZE
+            say(f"Page {max(1, page)}/{pages} — HOF <page>, HOF TOP <n>, HOF CLASS <class>, HOF RACE <race>")
+    except sqlite3.Error as e:
+        say(f"[HOF LOAD ERROR] {e}")
+
+# --------------------------
+# Journaled saves
+# --------------------------
+JOURNAL_FSYNC_EVERY = 8       # records appended between fsyncs
+JOURNAL_COMPACT_EVERY = 64    # records per journal segment before it is folded into the snapshot
+
+def _set_room_in_save(dg: Dict[str, Any], x: int, y: int, room: Dict[str, Any]):
+    """Replace one room inside a serialized dungeon dict (list, compact, lazy or mmap form)."""
+    if "mmap_grid" in dg:
+        return  # rooms are written straight to the map file
+    if "lazy_grid" in dg:
+        rooms = dg["lazy_grid"].setdefault("rooms", [])
+        for entry in rooms:
+            if entry[0] == x and entry[1] == y:
+                entry[2] = room
+                return
+        rooms.append([x, y, room])
+    else:
+        dg["grid"][x][y] = room
+
+def apply_journal_record(data: Dict[str, Any], rec: Dict[str, Any]):
+    """Fold one journal record into a save dict in place."""
+    if "seed" in rec:
+        data["seed"] = rec["seed"]
+    data["character"].update(rec.get("character", {}))
+    dg = data["dungeon"]
+    if "player_pos" in rec:
+        dg["player_pos"] = rec["player_pos"]
+    if "cleared" in rec:
+        dg["cleared"] = rec["cleared"]
+    for x, y, room in rec.get("rooms", []):
+        _set_room_in_save(dg, x, y, room)
+    data["journal_seq"] = rec["seq"]
+
+class SaveJournal:
+    """
+    Append-only saves. The first SAVE writes a full snapshot; later ones append a
+    single JSON line holding only the character fields and rooms that changed, so
+    a save costs O(changes). Lines are fsynced in batches, and full segments are
+    folded into a fresh snapshot on a background thread. load() replays the
+    snapshot plus whatever journal tail it does not yet cover.
+    """
+    def __init__(self, path: str = SAVE_FILE,
+                 fsync_every: int = JOURNAL_FSYNC_EVERY, compact_every: int = JOURNAL_COMPACT_EVERY):
+        self.snapshot_path = path + ".snapshot"
+        self.journal_prefix = path + ".journal."
+        self.fsync_every = fsync_every
+        self.compact_every = compact_every
+        self.seq = 0
+        self._segment = 0
+        self._file = None
+        self._in_segment = 0
+        self._unsynced = 0
+        self._last_char: Optional[Dict[str, Any]] = None  # None: next save is a full snapshot
+        self._base: Optional[str] = None  # pre-serialized dungeon JSON for that snapshot (see rebase)
+        self._compactor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._compacting: Optional[concurrent.futures.Future] = None
+
+    # ---- files ----
+    def _segments(self) -> List[Tuple[int, str]]:
+        folder = os.path.dirname(self.journal_prefix) or "."
+        base = os.path.basename(self.journal_prefix)
+        out = []
+        for name in os.listdir(folder):
+            if name.startswith(base) and name[len(base):].isdigit():
+                out.append((int(name[len(base):]), os.path.join(folder, name)))
+        return sorted(out)
+
+    def _read_state(self, upto: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Snapshot plus journal records (from segments <= upto, if given)."""
+        if not os.path.exists(self.snapshot_path):
+            return None
+        with open(self.snapshot_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        done = data.get("journal_seq", 0)
+        for seg, path in self._segments():
+            if upto is not None and seg > upto:
+                break
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # torn final write; everything before it is intact
+                    rec = json.loads(line)
+                    if rec["seq"] > done:
+                        apply_journal_record(data, rec)
+                        done = rec["seq"]
+        return data
+
+    def _open_segment(self):
+        self._close_segment()
+        self._segment += 1
+        self._file = open(f"{self.journal_prefix}{self._segment:06d}", "a", encoding="utf-8")
+        self._in_segment = 0
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+            self._unsynced = 0
+
+    def _compact(self, upto: int):
+        data = self._read_state(upto)
+        if data is None:
+            return
+        _atomic_write_json(self.snapshot_path, data)
+        for seg, path in self._segments():
+            if seg <= upto:
+                os.remove(path)
+
+    def _wait(self):
+        if self._compacting is not None:
+            self._compacting.result()
+            self._compacting = None
+
+    # ---- public API ----
+    def reset(self):
+        """Forget the baseline (new game): the next save writes a full snapshot."""
+        self._last_char = None
+        self._base = None
+
+    def rebase(self, dungeon_json: str):
+        """
+        A new floor, already serialized as it was generated: the next save writes
+        that text as the snapshot's dungeon and journals the rooms changed since,
+        instead of serializing the whole floor again.
+        """
+        self._last_char = None
+        self._base = dungeon_json
+
+    def save(self, c: Character, d: Dungeon, seed: Optional[int] = None):
+        try:
+            if self._last_char is None:
+                self._write_snapshot(c, d, seed)
+            else:
+                self._append(c, d, seed)
+            say(f"\n[SAVED] Game saved to {self.snapshot_path} (+journal)")
+        except Exception as e:
+            say(f"[SAVE ERROR] {e}")
+
+    def _write_snapshot(self, c: Character, d: Dungeon, seed: Optional[int]):
+        self._wait()
+        self._close_segment()
+        for _, path in self._segments():
+            os.remove(path)
+        data = {
+            "version": SAVE_VERSION,
+            "seed": seed,
+            "character": c.to_dict(),
+            "journal_seq": self.seq,
+        }
+        base, self._base = self._base, None
+        if base is None:
+            data["dungeon"] = d.to_dict()
+            _atomic_write_json(self.snapshot_path, data)
+        else:
+            head = json.dumps(data, indent=2)
+            _atomic_write_bytes(self.snapshot_path, (head[:-2] + ',\n  "dungeon": ' + base + "\n}").encode("utf-8"))
+        self._last_char = json.loads(json.dumps(data["character"]))
+        if base is None:
+            d.changed.clear()
+        else:
+            self._append(c, d, seed)  # rooms explored on the floor since it was generated
+
+    def _append(self, c: Character, d: Dungeon, seed: Optional[int]):
+        char = json.loads(json.dumps(c.to_dict()))
+        delta = {k: v for k, v in char.items() if self._last_char.get(k) != v}
+        self.seq += 1
+        rec = {
+            "seq": self.seq,
+            "seed": seed,
+            "player_pos": list(d.player_pos),
+            "cleared": d.cleared,
+            "character": delta,
+            "rooms": [[x, y, d.grid[x][y].to_dict()] for x, y in sorted(d.changed)],
+        }
+        if self._file is None:
+            self._open_segment()
+        self._file.write(json.dumps(rec, separators=(",", ":")) + "\n")
+        self._file.flush()
+        self._in_segment += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._last_char = char
+        d.changed.clear()
+        if self._in_segment >= self.compact_every:
+            full = self._segment
+            self._open_segment()
+            self._wait()
+            self._compacting = self._compactor.submit(self._compact, full)
+
+    def load(self) -> Tuple[Optional[Character], Optional[Dungeon], Optional[int]]:
+        self._wait()
+        self._close_segment()
+        try:
+            data = self._read_state()
+            if data is None:
+                say("No save file found.")
+                return None, None, None
+            c, d, seed = _state_from_save(data)
+        except Exception as e:
+            say(f"[LOAD ERROR] {e}")
+            return None, None, None
+        self.seq = data.get("journal_seq", 0)
+        segs = self._segments()
+        self._segment = segs[-1][0] if segs else 0
+        self._last_char = json.loads(json.dumps(data["character"]))
+        return c, d, seed
+
+    def close(self):
+        self._wait()
+        self._close_segment()
+        self._compactor.shutdown()
+
+# --------------------------
+# Save migrations & binary saves
+# --------------------------
+def _migrate_v2_to_v3(data: Dict[str, Any]) -> Dict[str, Any]:
+    """v3 gave chests locks and traps; older chests open freely."""
+    for row in data["dungeon"].get("grid", []):
+        for room in row:
+            chest = room.get("content")
+            if room.get("kind") != "treasure" or not isinstance(chest, dict):
+                continue
+            chest.setdefault("type", "chest")
+            chest.setdefault("opened", False)
+            chest.setdefault("locked", False)
+            chest.setdefault("lock_jammed", False)
+            chest.setdefault("lock_dc", 12)
+            chest.setdefault("trap", {"armed": False, "dc": 11, "known": False, "disarmed": False})
+            chest.setdefault("loot", {"gold": chest.pop("gold", 0), "potion": chest.pop("potion", None)})
+    return data
+
+def _migrate_v3_to_v4(data: Dict[str, Any]) -> Dict[str, Any]:
+    """v4 records the session and dungeon seeds."""
+    data.setdefault("seed", None)
+    data["dungeon"].setdefault("seed", None)
+    return data
+
+def _migrate_v4_to_v5(data: Dict[str, Any]) -> Dict[str, Any]:
+    """v5 added dungeon floors; older saves are on an uncleared first floor."""
+    data["dungeon"].setdefault("depth", 1)
+    data["dungeon"].setdefault("cleared", False)
+    return data
+
+def _migrate_v5_to_v6(data: Dict[str, Any]) -> Dict[str, Any]:
+    """v6 records which generator laid out the dungeon seed; older saves didn't."""
+    data["dungeon"].setdefault("generator", None)
+    return data
+
+# from-version -> function producing the next version; v1 and v2 share a layout
+SAVE_MIGRATIONS = {
+    1: lambda data: data,
+    2: _migrate_v2_to_v3,
+    3: _migrate_v3_to_v4,
+    4: _migrate_v4_to_v5,
+    5: _migrate_v5_to_v6,
+}
+
+def migrate_save(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Bring a save dict (JSON or binary metadata) up to SAVE_VERSION."""
+    version = int(data.get("version", 1))
+    if version > SAVE_VERSION:
+        raise ValueError(f"save version {version} is newer than this game (version {SAVE_VERSION})")
+    while version < SAVE_VERSION:
+        data = SAVE_MIGRATIONS[version](data)
+        version += 1
+        data["version"] = version
+    return data
+
+BINARY_SAVE_FILE = "rpg_save.bin"
+_BIN_MAGIC = b"RVSB"
+_BIN_HEADER = struct.Struct("<4sHHQII")  # magic, version, flags, session seed, crc32, payload length
+_BIN_ZLIB = 1
+_BIN_HAS_SEED = 2
+_BIN_META = struct.Struct("<I")
+
+def encode_save(c: Character, d: Dungeon, seed: Optional[int] = None, compress: bool = True) -> bytes:
+    """
+    Pack a game into the binary save format: a fixed header (version, seed, crc32)
+    followed by a small JSON metadata block and the CompactGrid arrays verbatim.
+    """
+    meta = {
+        "version": SAVE_VERSION,
+        "character": c.to_dict(),
+        "dungeon": {
+            "rows": d.rows,
+            "cols": d.cols,
+            "player_pos": list(d.player_pos),
+            "boss_pos": list(d.boss_pos),
+            "seed": d.seed,
+            "depth": d.depth,
+            "cleared": d.cleared,
+            "generator": d.generator,
+        },
+    }
+    arrays: List[bytes] = []
+    if isinstance(d.grid, LazyGrid):
+        meta["dungeon"]["lazy_grid"] = d.grid.to_dict()
+    elif isinstance(d.grid, MmapGrid):
+        meta["dungeon"]["mmap_grid"] = d.grid.to_dict()
+    else:
+        grid = d.grid if isinstance(d.grid, CompactGrid) else CompactGrid.from_rooms(d.rows, d.cols, d.grid)
+        meta["dungeon"]["other"] = [[i, r.to_dict()] for i, r in grid.other.items()]
+        arrays = [bytes(getattr(grid, name)) for name in CompactGrid.FIELDS]
+    blob = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+    payload = b"".join([_BIN_META.pack(len(blob)), blob] + arrays)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, 6)
+        flags |= _BIN_ZLIB
+    if seed is not None:
+        flags |= _BIN_HAS_SEED
+    header = _BIN_HEADER.pack(_BIN_MAGIC, SAVE_VERSION, flags, (seed or 0) & _MASK64,
+                              zlib.crc32(payload), len(payload))
+    return header + payload
+
+def decode_save(blob: bytes) -> Tuple[Character, Dungeon, Optional[int]]:
+    """
+    Inverse of encode_save(). Grids come back as CompactGrids built straight from
+    the stored arrays, with no per-room objects.
+    """
+    if len(blob) < _BIN_HEADER.size:
+        raise ValueError("truncated save header")
+    magic, version, flags, seed, crc, length = _BIN_HEADER.unpack_from(blob)
+    if magic != _BIN_MAGIC:
+        raise ValueError("not a Ravensburg binary save")
+    payload = blob[_BIN_HEADER.size:_BIN_HEADER.size + length]
+    if len(payload) != length or zlib.crc32(payload) != crc:
+        raise ValueError("save file is corrupt (checksum mismatch)")
+    if flags & _BIN_ZLIB:
+        payload = zlib.decompress(payload)
+    (meta_len,) = _BIN_META.unpack_from(payload)
+    offset = _BIN_META.size
+    meta = json.loads(payload[offset:offset + meta_len].decode("utf-8"))
+    offset += meta_len
+    meta["version"] = version
+    meta = migrate_save(meta)
+    dg = meta["dungeon"]
+    rows, cols = int(dg["rows"]), int(dg["cols"])
+    if "lazy_grid" in dg:
+        grid = LazyGrid.from_dict(dg["lazy_grid"], rows, cols)
+    elif "mmap_grid" in dg:
+        grid = MmapGrid.from_dict(dg["mmap_grid"])
+    else:
+        n = rows * cols
+        arrays = []
+        for _ in CompactGrid.FIELDS:
+            arrays.append(payload[offset:offset + n])
+            offset += n
+        other = {int(i): Room.from_dict(r) for i, r in dg.get("other", [])}
+        grid = CompactGrid.from_arrays(rows, cols, arrays, other)
+    d = Dungeon(rows, cols, grid, tuple(dg["player_pos"]), tuple(dg["boss_pos"]), dg.get("seed"),
+                int(dg["depth"]), bool(dg["cleared"]), dg["generator"])
+    c = Character.from_dict(meta["character"])
+    return c, d, (seed if flags & _BIN_HAS_SEED else None)
+
+def _atomic_write_bytes(path: str, data: bytes):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def save_game_binary(c: Character, d: Dungeon, seed: Optional[int] = None, path: str = BINARY_SAVE_FILE):
+    try:
+        _atomic_write_bytes(path, encode_save(c, d, seed))
+        say(f"\n[SAVED] Game saved to {path}")
+    except Exception as e:
+        say(f"[SAVE ERROR] {e}")
+
+def load_game_binary(path: str = BINARY_SAVE_FILE) -> Tuple[Optional[Character], Optional[Dungeon], Optional[int]]:
+    if not os.path.exists(path):
+        say("No save file found.")
+        return None, None, None
+    try:
+        with open(path, "rb") as f:
+            c, d, seed = decode_save(f.read())
+        say("[LOADED] Save loaded.")
+        return c, d, seed
+    except Exception as e:
+        say(f"[LOAD ERROR] {e}")
+        return None, None, None
+
+def bench_save_formats(rows: int = 200, cols: int = 200, seed: int = 1, repeat: int = 3) -> Dict[str, Any]:
+    """
+    Time and size the JSON save path (_atomic_write_json) against the binary codec
+    on one seeded dungeon. Returns seconds per save/load and bytes on disk.
+    """
+    d = generate_dungeon(rows, cols, seed=seed)
+    c = create_character("Bench", "Human", "Warrior", {a: 12 for a in ATTRS})
+    out: Dict[str, Any] = {"rooms": rows * cols}
+    with tempfile.TemporaryDirectory() as tmp:
+        jpath = os.path.join(tmp, "save.json")
+        bpath = os.path.join(tmp, "save.bin")
+        data = {"version": SAVE_VERSION, "seed": seed, "character": c.to_dict(), "dungeon": d.to_dict()}
+
+        def best(fn) -> float:
+            times = []
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                fn()
+                times.append(time.perf_counter() - t0)
+            return min(times)
+
+        def json_load():
+            with open(jpath, "r", encoding="utf-8") as f:
+                _state_from_save(json.load(f))
+
+        def bin_load():
+            with open(bpath, "rb") as f:
+                decode_save(f.read())
+
+        out["json_save_s"] = best(lambda: _atomic_write_json(jpath, {**data, "dungeon": d.to_dict()}))
+        out["binary_save_s"] = best(lambda: _atomic_write_bytes(bpath, encode_save(c, d, seed)))
+        token = _EVENT_SINK.set([])  # keep the "[LOADED]" chatter out of the results
+        try:
+            out["json_load_s"] = best(json_load)
+            out["binary_load_s"] = best(bin_load)
+        finally:
+            _EVENT_SINK.reset(token)
+        out["json_bytes"] = os.path.getsize(jpath)
+        out["binary_bytes"] = os.path.getsize(bpath)
+    return out
+
+# --------------------------
+# Town / Shop
+# --------------------------
+def print_town_help():
+    say("""
+TOWN COMMANDS:
+  LIST [kind] [gold|AFFORDABLE]    – List items for sale (e.g. LIST WEAPONS 30, LIST SPELLS INT)
+  PURCHASE <item>                  – Buy an item (weapon/armor/potion/spell)
+  SELL <item>                      – Sell an item you own
+  REST                             – Fully heal
+  TRAIN                            – Small stat training (costs gold)
+  ENTER DUNGEON                    – Venture into the dungeon
+  STATUS / INVENTORY               – Show your character / items
+  EQUIP <weapon> / WEAR <armor>    – Change your loadout
+  ODDS                             – Exact win chances against each monster
+  SAVE / LOAD                      – Save or load your game
+  HOF [page|TOP n|CLASS c|RACE r]  – Show Hall of Fame (paged/filtered)
+  QUIT                             – Exit game
+Any word may be shortened while it stays unique (e.g. ENT D, PUR Dagger).
+    """)
+
+def _shop_line(kind: str, k: str, c: Optional[Character]) -> str:
+    v = CONTENT_TABLES[kind][k]
+    if kind == "weapons":
+        line = f"  {k:<12} {v['cost']:>4}g  dmg {v['damage']} ({v['attr']})"
+        if c is not None:
+            p, dmg = weapon_odds(c, k, ODDS_REFERENCE_AC)
+            line += f"  vs AC {ODDS_REFERENCE_AC}: {p:.0%} hit, {dmg:.1f}/round"
+    elif kind == "armors":
+        cap = v['dex_cap'] if v['dex_cap'] is not None else '—'
+        line = f"  {k:<12} {v['cost']:>4}g  base AC {v['base_ac']}  dex cap: {cap}"
+        if c is not None:
+            ac = c.calc_ac(k)
+            line += f"  your AC {ac}, +{ODDS_REFERENCE_ATTACK} foe hits {hit_chance(ODDS_REFERENCE_ATTACK, ac):.0%}"
+    elif kind == "potions":
+        line = f"  {k:<16} {v['cost']:>4}g"
+    else:
+        line = f"  {k:<16} {v['cost']:>4}g  – {v['desc']}"
+        if c is not None:
+            odds = spell_odds(c, k, ODDS_REFERENCE_AC)
+            if odds is not None:
+                p, amount = odds
+                line += f" ({p:.0%}, {amount:.1f} avg)" if p < 1 else f" ({amount:.1f} avg)"
+    return line
+
+def list_shop(c: Optional[Character] = None, kinds: Iterable[str] = SHOP_KINDS,
+              max_cost: Optional[int] = None, attr: Optional[str] = None):
+    """
+    Shop listing; with a character, each item shows its exact odds against a typical foe.
+    A cost cap lists cheapest first from the cost index; `attr` keeps items keyed on it.
+    """
+    for kind in kinds:
+        if max_cost is None:
+            names = list(CONTENT_TABLES[kind])
+        else:
+            names = CONTENT.by_cost(kind, 0, max_cost)
+        if attr is not None:
+            keyed = set(CONTENT.by_attr(kind, attr))
+            names = [n for n in names if n in keyed]
+        if max_cost is not None or attr is not None:
+            if not names:
+                continue
+        say(f"\n--- SHOP ({kind.title()}) ---")
+        for k in names:
+            say(_shop_line(kind, k, c))
+
+def parse_list_args(arg: str) -> Dict[str, Any]:
+    """LIST [WEAPONS|ARMORS|POTIONS|SPELLS ...] [<max gold>|AFFORDABLE] [<attribute>]"""
+    opts: Dict[str, Any] = {}
+    kinds = []
+    for word in arg.lower().split():
+        if word.isdigit():
+            opts["max_cost"] = int(word)
+        elif word == "affordable":
+            opts["max_cost"] = "gold"
+        elif word.upper() in ATTRS:
+            opts["attr"] = word.upper()
+        else:
+            kind = next((k for k in SHOP_KINDS if k.startswith(word)), None)
+            if kind is None:
+                raise ValueError
+            kinds.append(kind)
+    if kinds:
+        opts["kinds"] = kinds
+    return opts
+
+def _shop_item(item: str, kinds: Iterable[str] = SHOP_KINDS,
+               owned: Optional[Iterable[str]] = None) -> Optional[Tuple[str, str]]:
+    """
+    Resolve a typed item name to (kind, name): exact (any case) or a unique
+    prefix, among `owned` names if given. Explains misses to the player.
+    """
+    hits = CONTENT.find(item, kinds, owned)
+    if len(hits) == 1:
+        return hits[0]
+    if hits:
+        say(f"Which one: {', '.join(name for _, name in hits[:8])}{', …' if len(hits) > 8 else ''}?")
+        return None
+    close = CONTENT.suggest(item, kinds, names=owned)
+    if owned is None:
+        say("Item not found." + (f" Did you mean {' or '.join(close)}?" if close else ""))
+    else:
+        say("You don't have that item equipped/owned." + (f" Did you mean {' or '.join(close)}?" if close else ""))
+    return None
+
+def purchase(c: Character, item: str):
+    found = _shop_item(item)
+    if found is None:
+        return
+    kind, item_title = found
+    cost = CONTENT_TABLES[kind][item_title]["cost"]
+    if kind == "spells" and item_title in c.spells:
+        say("You already know that spell.")
+        return
+    if c.gold < cost:
+        say("Not enough gold.")
+        return
+    c.gold -= cost
+    if kind == "weapons":
+        say(f"Purchased {item_title}. Use 'EQUIP {item_title}' to wield it.")
+    elif kind == "armors":
+        say(f"Purchased {item_title}. Use 'WEAR {item_title}' to don it.")
+    elif kind == "potions":
+        c.add_potion(item_title, 1)
+        say(f"Purchased {item_title}.")
+    else:
+        c.learn_spell(item_title)
+        say(f"Learned spell {item_title}.")
+
+def sell(c: Character, item: str):
+    owned = [c.weapon, c.armor] + [p for p, n in c.potions.items() if n > 0] + list(c.spells)
+    found = _shop_item(item, owned=owned)
+    if found is None:
+        return
+    kind, item_title = found
+    if kind == "weapons" and item_title == c.weapon:
+        price = WEAPONS.get(item_title, {}).get("cost", 0)//2
+        c.gold += price
+        c.weapon = "Dagger"
+        say(f"Sold {item_title} for {price}g. You equip a Dagger.")
+    elif kind == "armors" and item_title == c.armor:
+        price = ARMORS.get(item_title, {}).get("cost", 0)//2
+        c.gold += price
+        c.armor = "Clothes"
+        say(f"Sold {item_title} for {price}g. You wear Clothes.")
+    elif kind == "potions":
+        price = POTIONS.get(item_title, {}).get("cost", 0)//2
+        c.potions[item_title] -= 1
+        if c.potions[item_title] <= 0:
+            del c.potions[item_title]
+        c.gold += price
+        say(f"Sold 1x {item_title} for {price}g.")
+    elif kind == "spells":
+        say("You cannot sell knowledge once learned.")
+    else:
+        say("You don't have that item equipped/owned.")
+
+def rest(c: Character):
+    c.hp = c.max_hp
+    c.effects = Effects()
+    say("You rest at the inn. Fully healed and refreshed.")
+
+TRAIN_COST = 40
+
+def train(c: Character) -> bool:
+    """
+    Announce training; True if the character can afford it and should pick an attribute.
+    """
+    say(f"Training costs {TRAIN_COST}g and gives +1 to a chosen attribute.")
+    if c.gold < TRAIN_COST:
+        say("Not enough gold.")
+        return False
+    return True
+
+def train_attribute(c: Character, choice: str):
     if choice not in ATTRS:
-        print("Invalid attribute.")
+        say("Invalid attribute.")
+        return
+    c.gold -= TRAIN_COST
+    c.attrs[choice] += 1
+    say(f"Training complete. {choice} is now {c.attrs[choice]}.")
+
+def show_inventory(c: Character):
+    say("\n--- INVENTORY ---")
+    say(f"Gold: {c.gold}")
+    say(f"Weapon: {c.weapon}")
+    say(f"Armor : {c.armor}")
+    if c.potions:
+        for k, v in c.potions.items():
+            say(f"Potion: {k} x{v}")
+    if c.spells:
+        say("Spells: " + ", ".join(c.spells))
+
+def equip_weapon(c: Character, item: str):
+    hits = CONTENT.find(item, ("weapons",))
+    if len(hits) == 1:
+        item_title = hits[0][1]
+        say(f"You equip {item_title}.")
+        c.weapon = item_title
+    else:
+        say("That is not a valid weapon.")
+
+def wear_armor(c: Character, item: str):
+    hits = CONTENT.find(item, ("armors",))
+    if len(hits) == 1:
+        item_title = hits[0][1]
+        say(f"You wear {item_title}.")
+        c.armor = item_title
+    else:
+        say("That is not a valid armor.")
+
+# --------------------------
+# Dungeon exploration & combat
+# --------------------------
+def print_dungeon_help():
+    say("""
+DUNGEON COMMANDS:
+  LOOK / WHERE AM I            – Describe current room
+  MAP [ROWSxCOLS]              – Show the map around you (fog of war)
+  MAP OVERVIEW                 – Zoomed-out map of the whole dungeon
+  MOVE N/E/S/W                 – Move to adjacent room (if possible)
+  GOTO <row,col>               – Walk there through explored rooms
+  GOTO NEAREST UNEXPLORED      – Walk to the closest unexplored room
+  GOTO BOSS / RETURN ENTRANCE  – Walk back to the lair or the entrance
+  DESCEND                      – Take the stairs in the lair once its boss falls
+  STATUS / INVENTORY           – View character or inventory
+  DRINK <potion name>          – Drink a potion
+  CAST <spell name>            – Cast a non-combat spell (e.g., Heal)
+  ODDS                         – Exact win chances against each monster
+  EXAMINE CHEST FOR TRAPS      – Inspect the chest (treasure rooms)
+  DISARM CHEST TRAP            – Attempt to disable the trap
+  PICK CHEST LOCK              – Attempt to pick the lock
+  PRY CHEST LOCK               – Force the lock open
+  OPEN CHEST                   – Open (beware armed traps/locks)
+  SAVE / LOAD                  – Save or load game
+  RETURN TOWN                  – Exit to town
+Any word may be shortened while it stays unique (e.g. MO N, OP CH).
+    """)
+
+def move_player(d: Dungeon, dirc: str):
+    x, y = d.player_pos
+    if dirc == "N" and x > 0:
+        d.player_pos = (x-1, y)
+    elif dirc == "S" and x < d.rows-1:
+        d.player_pos = (x+1, y)
+    elif dirc == "W" and y > 0:
+        d.player_pos = (x, y-1)
+    elif dirc == "E" and y < d.cols-1:
+        d.player_pos = (x, y+1)
+    else:
+        say("You cannot move that way.")
+
+MAP_VIEW = (21, 61)  # default map window, rows x cols
+MAP_RAMP = " .:+#"   # overview glyphs, by explored fraction of a block
+
+def _fog_cells(d: Dungeon, x: int, y0: int, y1: int) -> str:
+    """Fog-of-war glyphs for columns y0..y1-1 of row x, touching only those rooms."""
+    g = d.grid
+    if isinstance(g, CompactGrid):
+        return g.render_row(x, y0, y1)
+    lazy = isinstance(g, LazyGrid)
+    row = None if lazy else g[x]
+    out = []
+    for y in range(y0, y1):
+        # lazy maps: rooms that aren't resident are unvisited, so don't generate them
+        room = g.peek(x, y) if lazy else row[y]
+        if room is None or not room.visited:
+            out.append(" ")
+        else:
+            out.append("B" if room.kind == "boss" else "·")
+    return "".join(out)
+
+class MapView:
+    """
+    Map render cache for one dungeon and window size. Window rows are kept as
+    strings and dropped only when a room in that row changes (Dungeon.mark_changed);
+    the overview keeps an explored count per block, bumped by Dungeon.visit. Either
+    way a MAP costs O(window), whatever the size of the dungeon.
+    """
+    def __init__(self, d: Dungeon, size: Tuple[int, int]):
+        self.d = d
+        self.size = size
+        self.block = (max(1, -(-d.rows // size[0])), max(1, -(-d.cols // size[1])))
+        self.rows: Dict[int, Tuple[int, int, str]] = {}
+        self.explored: Optional[Dict[Tuple[int, int], int]] = None  # counted on first overview
+
+    def invalidate(self, x: int, y: int):
+        self.rows.pop(x, None)
+
+    def note_visit(self, x: int, y: int):
+        if self.explored is not None:
+            key = (x // self.block[0], y // self.block[1])
+            self.explored[key] = self.explored.get(key, 0) + 1
+
+    def window(self) -> Tuple[int, int, int, int]:
+        """Rows x0..x1-1 and columns y0..y1-1 shown, centred on the player where possible."""
+        h, w = self.size
+        px, py = self.d.player_pos
+        x0 = max(0, min(px - h // 2, self.d.rows - h))
+        y0 = max(0, min(py - w // 2, self.d.cols - w))
+        return x0, min(self.d.rows, x0 + h), y0, min(self.d.cols, y0 + w)
+
+    def row(self, x: int, y0: int, y1: int) -> str:
+        hit = self.rows.get(x)
+        if hit is not None and hit[0] == y0 and hit[1] == y1:
+            return hit[2]
+        line = _fog_cells(self.d, x, y0, y1)
+        if len(self.rows) >= 4 * self.size[0]:
+            self.rows.clear()  # the window moved on; start over rather than grow with the map
+        self.rows[x] = (y0, y1, line)
+        return line
+
+    def _count_explored(self) -> Dict[Tuple[int, int], int]:
+        """One full pass to seed the per-block counters; later visits update them."""
+        bx, by = self.block
+        counts: Dict[Tuple[int, int], int] = collections.Counter()
+        g = self.d.grid
+        if isinstance(g, LazyGrid):
+            for (x, y), room in g.touched().items():
+                if room.visited:
+                    counts[(x // bx, y // by)] += 1
+        elif isinstance(g, CompactGrid):
+            for x in range(self.d.rows):
+                line = bytes(g.visited[x * g.cols:(x + 1) * g.cols])
+                for b in range(0, g.cols, by):
+                    n = line.count(1, b, b + by)
+                    if n:
+                        counts[(x // bx, b // by)] += n
+        else:
+            for x, row in enumerate(g):
+                for y, room in enumerate(row):
+                    if room.visited:
+                        counts[(x // bx, y // by)] += 1
+        return dict(counts)
+
+    def overview(self) -> List[str]:
+        if self.explored is None:
+            self.explored = self._count_explored()
+        bx, by = self.block
+        rows, cols = self.d.rows, self.d.cols
+        px, py = self.d.player_pos
+        boss_x, boss_y = self.d.boss_pos
+        boss_seen = self.d.grid[boss_x][boss_y].visited
+        lines = []
+        for i in range(-(-rows // bx)):
+            h = min(rows, (i + 1) * bx) - i * bx
+            chars = []
+            for j in range(-(-cols // by)):
+                if (i, j) == (px // bx, py // by):
+                    chars.append("@")
+                elif boss_seen and (i, j) == (boss_x // bx, boss_y // by):
+                    chars.append("B")
+                else:
+                    n = self.explored.get((i, j), 0)
+                    cells = h * (min(cols, (j + 1) * by) - j * by)
+                    # any exploration shows; only a fully explored block gets the last glyph
+                    k = 0 if n == 0 else min(len(MAP_RAMP) - 1, 1 + (len(MAP_RAMP) - 2) * n // cells)
+                    chars.append(MAP_RAMP[k])
+            lines.append("".join(chars))
+        return lines
+
+def ascii_map(d: Dungeon, size: Optional[Tuple[int, int]] = None) -> str:
+    """
+    Render the map window (size rows x cols, default MAP_VIEW) around the player
+    with fog of war. Small dungeons are drawn whole.
+    """
+    view = d.map_view(size or MAP_VIEW)
+    x0, x1, y0, y1 = view.window()
+    px, py = d.player_pos
+    border = "+" + "-" * (y1 - y0) + "+"
+    lines = [border]
+    for x in range(x0, x1):
+        line = view.row(x, y0, y1)
+        if x == px:
+            j = py - y0
+            line = line[:j] + "@" + line[j + 1:]
+        lines.append("|" + line + "|")
+    lines.append(border)
+    if (x1 - x0, y1 - y0) != (d.rows, d.cols):
+        lines.append(f"Rows {x0}-{x1 - 1}, cols {y0}-{y1 - 1} of {d.rows}x{d.cols}")
+    legend = "\nLegend: @=You  ·=Explored  space=Unexplored  B=Boss (discovered)"
+    return "\n".join(lines) + legend
+
+def overview_map(d: Dungeon, size: Optional[Tuple[int, int]] = None) -> str:
+    """Whole dungeon downsampled to fit the map window, one glyph per block of rooms."""
+    view = d.map_view(size or MAP_VIEW)
+    body = view.overview()
+    border = "+" + "-" * len(body[0]) + "+"
+    legend = (f"\nOverview: each cell is {view.block[0]}x{view.block[1]} rooms. "
+              f"Explored: ' '=none '.' ':' '+' '#'=all  @=You  B=Boss (discovered)")
+    return "\n".join([border] + ["|" + line + "|" for line in body] + [border]) + legend
+
+# --------------------------
+# Pathfinding
+# --------------------------
+PATH_CACHE_SIZE = 4  # distance fields kept per dungeon
+NEAREST_TRIES = 8  # A* searches nearest_unexplored() tries before one full breadth-first field
+
+def _explored_test(d: Dungeon) -> Callable[[int], bool]:
+    """Fast `is room i explored` for the dungeon's grid backend (i = x * cols + y)."""
+    g, cols = d.grid, d.cols
+    if isinstance(g, CompactGrid):
+        return g.visited.__getitem__
+    if isinstance(g, LazyGrid):
+        def explored(i: int) -> bool:
+            room = g.peek(*divmod(i, cols))
+            return room is not None and room.visited
+        return explored
+    return lambda i: g[i // cols][i % cols].visited
+
+def _neighbours(i: int, rows: int, cols: int) -> List[int]:
+    x, y = divmod(i, cols)
+    out = []
+    if x > 0:
+        out.append(i - cols)
+    if x < rows - 1:
+        out.append(i + cols)
+    if y > 0:
+        out.append(i - 1)
+    if y < cols - 1:
+        out.append(i + 1)
+    return out
+
+def _explored_rooms(d: Dungeon) -> Iterable[int]:
+    g, cols = d.grid, d.cols
+    if isinstance(g, CompactGrid):
+        return (i for i, v in enumerate(bytes(g.visited)) if v)
+    if isinstance(g, LazyGrid):
+        return [x * cols + y for (x, y), room in g.touched().items() if room.visited]
+    return [x * cols + y for x, row in enumerate(g) for y, room in enumerate(row) if room.visited]
+
+def frontier_rooms(d: Dungeon) -> set:
+    """
+    Unexplored rooms bordering the explored area. The first call scans the
+    explored rooms (as whole arrays for packed grids with NumPy); after that
+    Dungeon.visit() keeps the set up to date.
+    """
+    if d.frontier is None:
+        rows, cols = d.rows, d.cols
+        if isinstance(d.grid, CompactGrid) and np is not None:
+            seen = np.frombuffer(bytes(d.grid.visited), dtype=np.uint8).reshape(rows, cols) != 0
+            near = np.zeros_like(seen)
+            near[1:] |= seen[:-1]
+            near[:-1] |= seen[1:]
+            near[:, 1:] |= seen[:, :-1]
+            near[:, :-1] |= seen[:, 1:]
+            d.frontier = set(np.flatnonzero(near & ~seen).tolist())
+        else:
+            explored = _explored_test(d)
+            d.frontier = {j for i in _explored_rooms(d) for j in _neighbours(i, rows, cols) if not explored(j)}
+    return d.frontier
+
+def _grow_frontier(d: Dungeon, i: int):
+    """Room i was just explored: it leaves the frontier and its unexplored neighbours join."""
+    explored = _explored_test(d)
+    d.frontier.discard(i)
+    d.frontier.update(j for j in _neighbours(i, d.rows, d.cols) if not explored(j))
+
+def _search(d: Dungeon, s: int, t: int, explored: Callable[[int], bool], any_frontier: bool = False,
+            bound: float = math.inf) -> Optional[Tuple[int, List[Tuple[int, int]]]]:
+    """
+    A* from room s towards room t over explored rooms, by Manhattan distance.
+    Unexplored rooms are never expanded; t may be one, entered as the last
+    step. With any_frontier, every unexplored room is a possible stop, costing
+    its walk plus its distance left to t, and ties go to the stop nearest t.
+    Returns (cost, rooms after s) for the cheapest stop under `bound`, or None.
+    """
+    cols = d.cols
+    rows = d.rows
+    tx, ty = divmod(t, cols)
+    x, y = divmod(s, cols)
+    h = abs(x - tx) + abs(y - ty)
+    if h >= bound:
+        return None
+    path = _straight(s, t, cols, explored, any_frontier)
+    if path is not None:
+        return len(path) + abs(path[-1][0] - tx) + abs(path[-1][1] - ty), path
+    g = {s: 0}
+    parent = {s: -1}
+    heap = [(h, h, s)]
+    while heap:
+        f, h, i = heapq.heappop(heap)
+        gi = f - h
+        if gi > g[i]:
+            continue  # stale entry
+        if i == t or (i != s and not explored(i)):
+            out = []
+            while i != s:
+                out.append(divmod(i, cols))
+                i = parent[i]
+            out.reverse()
+            return f, out
+        x, y = divmod(i, cols)
+        gj = gi + 1
+        for j, jx, jy in ((i - cols, x - 1, y), (i + cols, x + 1, y), (i - 1, x, y - 1), (i + 1, x, y + 1)):
+            if not (0 <= jx < rows and 0 <= jy < cols) or g.get(j, gj + 1) <= gj:
+                continue
+            if j != t and not any_frontier and not explored(j):
+                continue
+            hj = abs(jx - tx) + abs(jy - ty)
+            if gj + hj >= bound:
+                continue
+            g[j] = gj
+            parent[j] = i
+            heapq.heappush(heap, (gj + hj, hj, j))
+    return None
+
+def _straight(s: int, t: int, cols: int, explored: Callable[[int], bool],
+              any_frontier: bool) -> Optional[List[Tuple[int, int]]]:
+    """
+    Greedy walk from s that only ever steps closer to t, as _search() would
+    stop it. Nothing is shorter than such a walk, so when one gets through it
+    is a best route, found without a search; None when it runs into a wall.
+    """
+    x, y = divmod(s, cols)
+    tx, ty = divmod(t, cols)
+    out = []
+    while (x, y) != (tx, ty):
+        sx = (tx > x) - (tx < x)
+        sy = (ty > y) - (ty < y)
+        steps = [(x + sx, y), (x, y + sy)] if abs(tx - x) >= abs(ty - y) else [(x, y + sy), (x + sx, y)]
+        for nx, ny in steps:
+            if (nx, ny) != (x, y) and ((nx, ny) == (tx, ty) or explored(nx * cols + ny)):
+                break
+        else:
+            if not any_frontier:
+                return None
+            for nx, ny in steps:
+                if (nx, ny) != (x, y):
+                    break
+            out.append((nx, ny))
+            return out  # stepped into an unexplored room: a stop as good as any
+        x, y = nx, ny
+        out.append((x, y))
+    return out
+
+class PathField:
+    """
+    Breadth-first distances from one room over explored rooms, in flat arrays
+    (dist[i] < 0: not reached). parent[i] is the next room towards the source.
+    Unexplored rooms bordering the explored area are recorded in `frontier`
+    (nearest first) but never expanded, so a route only ever enters an
+    unresolved room as its last step.
+    """
+    __slots__ = ("source", "version", "cols", "dist", "parent", "frontier")
+
+    def __init__(self, d: Dungeon, source: Tuple[int, int]):
+        rows, cols = d.rows, d.cols
+        explored = _explored_test(d)
+        s = source[0] * cols + source[1]
+        dist = array.array("i", [-1]) * (rows * cols)
+        parent = array.array("i", [-1]) * (rows * cols)
+        dist[s] = 0
+        frontier: List[int] = []
+        queue = collections.deque([s])
+        pop, push = queue.popleft, queue.append
+        while queue:
+            i = pop()
+            nd = dist[i] + 1
+            x, y = divmod(i, cols)
+            for j in (i - cols if x > 0 else -1, i + cols if x < rows - 1 else -1,
+                      i - 1 if y > 0 else -1, i + 1 if y < cols - 1 else -1):
+                if j < 0 or dist[j] >= 0:
+                    continue
+                dist[j] = nd
+                parent[j] = i
+                if explored(j):
+                    push(j)
+                else:
+                    frontier.append(j)
+        self.source = source
+        self.version = d.version
+        self.cols = cols
+        self.dist = dist
+        self.parent = parent
+        self.frontier = frontier
+
+    def path_to(self, target: int) -> List[Tuple[int, int]]:
+        """Rooms from the source (exclusive) to target (inclusive)."""
+        out = []
+        while target != -1:
+            out.append(divmod(target, self.cols))
+            target = self.parent[target]
+        out.pop()
+        out.reverse()
+        return out
+
+def distance_field(d: Dungeon, source: Tuple[int, int]) -> PathField:
+    """Cached PathField from source; rebuilt only after the explored area changes."""
+    cache = d.path_cache
+    f = cache.get(source)
+    if f is None or f.version != d.version:
+        f = cache[source] = PathField(d, source)
+        if len(cache) > PATH_CACHE_SIZE:
+            cache.popitem(last=False)
+    else:
+        cache.move_to_end(source)
+    return f
+
+def route_to(d: Dungeon, target: Tuple[int, int]) -> Optional[List[Tuple[int, int]]]:
+    """
+    Shortest walk from the player to target over explored rooms. An unexplored
+    target is approached through the frontier room that leaves the least walk
+    plus distance to go, where the walk stops. None if nothing is reachable.
+    A* searches only the rooms between the two, however large the map.
+    """
+    explored = _explored_test(d)
+    s = d.player_pos[0] * d.cols + d.player_pos[1]
+    t = target[0] * d.cols + target[1]
+    if s == t:
+        return []
+    if explored(t) or t in frontier_rooms(d):
+        found = _search(d, s, t, explored)
+        if found is not None:
+            return found[1]
+    found = _search(d, s, t, explored, any_frontier=True)
+    return None if found is None else found[1]
+
+def route_back(d: Dungeon, target: Tuple[int, int]) -> Optional[List[Tuple[int, int]]]:
+    """Walk from the player to an explored target (entrance, boss); None if it can't be reached."""
+    s = d.player_pos[0] * d.cols + d.player_pos[1]
+    t = target[0] * d.cols + target[1]
+    if s == t:
+        return []
+    found = _search(d, s, t, _explored_test(d))
+    return None if found is None else found[1]
+
+def nearest_unexplored(d: Dungeon) -> Optional[List[Tuple[int, int]]]:
+    """
+    Walk to the closest unexplored room. Frontier rooms are tried in order of
+    Manhattan distance, which no walk can beat, so the search stops once the
+    best walk found is no longer than the next room's distance. Mazes that
+    defeat that bound fall back to one breadth-first field.
+    """
+    frontier = frontier_rooms(d)
+    if not frontier:
+        return None
+    explored = _explored_test(d)
+    px, py = d.player_pos
+    s = px * d.cols + py
+    cols = d.cols
+    candidates = [(abs(j // cols - px) + abs(j % cols - py), j) for j in frontier]
+    heapq.heapify(candidates)
+    best: Optional[Tuple[int, List[Tuple[int, int]]]] = None
+    for _ in range(NEAREST_TRIES):
+        if not candidates or (best is not None and candidates[0][0] >= best[0]):
+            return None if best is None else best[1]
+        _, j = heapq.heappop(candidates)
+        found = _search(d, s, j, explored, bound=math.inf if best is None else best[0])
+        if found is not None:
+            best = found
+    f = distance_field(d, d.player_pos)
+    return f.path_to(f.frontier[0]) if f.frontier else None
+
+def travel(d: Dungeon, path: Optional[List[Tuple[int, int]]]):
+    if path is None:
+        say("You can't find a way there.")
+    elif not path:
+        say("You are already there.")
+    else:
+        d.player_pos = path[-1]
+        say(f"You travel {len(path)} room{'s' if len(path) != 1 else ''} to {d.player_pos}.")
+
+def parse_dims(text: str) -> Tuple[int, int]:
+    """ "ROWSxCOLS" -> (rows, cols)."""
+    rows, _, cols = text.lower().partition("x")
+    dims = (int(rows), int(cols))
+    if min(dims) < 1:
+        raise ValueError(f"Bad size: {text!r}")
+    return dims
+
+def describe_room(room: Room):
+    if room.kind == "empty":
+        say("A dusty, silent chamber. Nothing stirs.")
+    elif room.kind == "monster":
+        say("You sense lurking danger — a monster had been here.")
+    elif room.kind == "trap":
+        say("You notice suspicious grooves and wires… a trap lies here.")
+    elif room.kind == "treasure":
+        say("A battered chest glints in the shadows.")
+    elif room.kind == "fountain":
+        say("An ancient fountain bubbles softly.")
+    elif room.kind == "boss":
+        say("A foreboding chamber reeks of dark magic…")
+
+def trigger_room(c: Character, d: Dungeon, room: Room, rng=random) -> Optional[Fight]:
+    """
+    Resolve a room on first entry. Returns the Fight to run if the room holds a foe.
+    """
+    if room.kind == "monster":
+        return start_fight(c, make_monster(floor_template(room.content["monster"], d.depth), rng))
+    elif room.kind == "trap":
+        resolve_trap(c, room.content, rng)
+    elif room.kind == "treasure":
+        # first-time sighting reveals chest existence (but not trap/lock details)
+        describe_chest(room.content, brief=True)
+    elif room.kind == "fountain":
+        resolve_fountain(c, room.content, rng)
+    elif room.kind == "boss":
+        say("The Evil Necromancer stands before you!")
+        return start_fight(c, make_monster(floor_template(NECROMANCER, d.depth), rng), boss=True)
+    return None
+
+def boss_defeated(c: Character, d: Dungeon):
+    if d.depth == 1:
+        say("\nWith a final cry, the Necromancer falls. Ravensburg is saved!")
+    else:
+        say(f"\nWith a final cry, the Necromancer of floor {d.depth} falls.")
+    add_to_hof(c)
+    d.cleared = True
+    say(f"Behind the throne, stairs lead down to floor {d.depth + 1}. DESCEND to take them, or RETURN TOWN.")
+
+def make_monster(template: Dict[str, Any], rng=random) -> Monster:
+    return Monster(
+        name=template["name"],
+        hp=roll(template["hp"], rng),
+        ac=template["ac"],
+        atk_bonus=template["atk_bonus"],
+        dmg=template["dmg"],
+        xp=template["xp"],
+        gold=roll(template["gold"], rng),
+    )
+
+def resolve_trap(c: Character, content: Dict[str, Any], rng=random):
+    dc = content["dc"]
+    dmg = content["dmg"]
+    say(f"A trap springs! Make a DEX save (d20 + DEX, {trap_save_chance(c, dc):.0%} to dodge).")
+    save = d20(rng) + c.mod("DEX")
+    say(f"Save: {save} vs DC {dc}")
+    if save >= dc:
+        say("You dodge the trap just in time.")
+    else:
+        harm = roll(dmg, rng)
+        c.hp = max(0, c.hp - harm)
+        say(f"Trap hits for {harm} damage! HP {c.hp}/{c.max_hp}")
+
+def resolve_fountain(c: Character, content: Dict[str, Any], rng=random):
+    kind = content["type"]
+    if kind == "heal":
+        gain = min(c.max_hp - c.hp, roll("1d8+4", rng))
+        c.hp += gain
+        say(f"The water heals you for {gain} HP. ({c.hp}/{c.max_hp})")
+    elif kind == "buff":
+        c.effects.ac_buff = 1
+        c.effects.ac_turns = 10
+        say("You feel protected. (+1 AC for a while)")
+    else:
+        harm = roll("1d6", rng)
+        c.hp = max(0, c.hp - harm)
+        say(f"The water was foul! You take {harm} damage. ({c.hp}/{c.max_hp})")
+
+# --------------------------
+# Chest system
+# --------------------------
+def describe_chest(chest: Dict[str, Any], brief: bool=False):
+    if chest["opened"]:
+        say("The chest here stands open and empty.")
         return
-    c.gold -= cost
-    c.attrs[choice] += 1
-    print(f"Training complete. {choice} is now {c.attrs[choice]}.")
+    locked = chest["locked"]
+    trap = chest["trap"]
+    if brief:
+        say("You spot a sturdy wooden chest here.")
+        return
+    # Detailed describe; trap details only if known
+    lock_txt = "locked" if locked else "unlocked"
+    trap_txt = "unknown" if not trap["known"] else ("disarmed" if trap["disarmed"] else "armed")
+    say(f"Chest: {lock_txt}. Trap status: {trap_txt}.")
+
+def chest_examine(c: Character, chest: Dict[str, Any], rng=random):
+    if chest["opened"]:
+        say("The chest is already open.")
+        return
+    check = d20(rng) + c.mod("PER")
+    dc = 10  # basic perception DC to notice mechanisms
+    say(f"You carefully examine the chest… Perception {check} vs DC {dc}")
+    if check >= dc:
+        chest["trap"]["known"] = True
+        status = "armed" if (chest["trap"]["armed"] and not chest["trap"]["disarmed"]) else ("disarmed" if chest["trap"]["disarmed"] else "not present")
+        say(f"You notice: trap status is {status}. The lock appears {'jammed' if chest['lock_jammed'] else ('present' if chest['locked'] else 'absent')}.")
+    else:
+        say("You don't notice anything unusual.")
+
+def chest_disarm(c: Character, chest: Dict[str, Any], rng=random):
+    trap = chest["trap"]
+    if chest["opened"]:
+        say("The chest is already open.")
+        return
+    if not trap["armed"] or trap["disarmed"]:
+        say("There is no active trap to disarm.")
+        return
+    dc = trap["dc"]
+    roll_total = d20(rng) + c.mod("DEX")
+    say(f"You attempt to disarm the trap… DEX check {roll_total} vs DC {dc}")
+    if roll_total >= dc:
+        trap["disarmed"] = True
+        say("You deftly disable the trap.")
+    elif roll_total <= dc - 5:
+        say("Your tools slip—trap triggers!")
+        _chest_trap_trigger(c, chest, rng)
+    else:
+        say("You fail to disarm the trap, but at least you didn't set it off.")
+
+def chest_pick_lock(c: Character, chest: Dict[str, Any], rng=random):
+    if chest["opened"]:
+        say("The chest is already open.")
+        return
+    if not chest["locked"]:
+        say("The chest is already unlocked.")
+        return
+    if chest["lock_jammed"]:
+        say("The lock is jammed—you'll have to pry it.")
+        return
+    dc = chest["lock_dc"]
+    roll_total = d20(rng) + c.mod("DEX")
+    say(f"You try to pick the lock… DEX check {roll_total} vs DC {dc}")
+    if roll_total >= dc:
+        chest["locked"] = False
+        say("You hear a soft click—the chest is unlocked.")
+    elif roll_total <= dc - 5:
+        chest["lock_jammed"] = True
+        say("Snap! Your pick jams the lock. You'll need to pry it.")
+    else:
+        say("The lock resists your efforts.")
+
+def chest_pry_lock(c: Character, chest: Dict[str, Any], rng=random):
+    if chest["opened"]:
+        say("The chest is already open.")
+        return
+    if not chest["locked"] and not chest["lock_jammed"]:
+        say("No need to pry—it's already unlocked.")
+        return
+    dc = chest["lock_dc"] + 2
+    roll_total = d20(rng) + c.mod("STR")
+    say(f"You wedge your blade and pry… STR check {roll_total} vs DC {dc}")
+    if roll_total >= dc:
+        chest["locked"] = False
+        chest["lock_jammed"] = False
+        say("With a crack, the lock gives way.")
+    else:
+        pain = roll("1d4", rng)
+        c.hp = max(0, c.hp - pain)
+        say(f"The chest shifts and bites back; you take {pain} damage. HP {c.hp}/{c.max_hp}")
+        # 25% chance a still-armed trap springs when prying fails
+        trap = chest["trap"]
+        if trap["armed"] and not trap["disarmed"] and rng.random() < 0.25:
+            say("As you pry, a mechanism snaps—trap triggers!")
+            _chest_trap_trigger(c, chest, rng)
+
+def chest_open(c: Character, chest: Dict[str, Any], rng=random):
+    if chest["opened"]:
+        say("The chest is already open.")
+        return
+    # Trap check
+    trap = chest["trap"]
+    if trap["armed"] and not trap["disarmed"]:
+        say("You lift the lid—something clicks!")
+        _chest_trap_trigger(c, chest, rng)
+        if c.hp <= 0:
+            return
+    # Lock check
+    if chest["locked"]:
+        say("The lock holds fast. You'll need to pick or pry it first.")
+        return
+    # Award loot
+    gold = chest["loot"]["gold"]
+    pot = chest["loot"]["potion"]
+    c.gold += gold
+    txt = f"You claim {gold} gold"
+    if pot:
+        c.add_potion(pot, 1)
+        txt += f" and a {pot}"
+    txt += "."
+    say(txt)
+    chest["opened"] = True
+
+def _chest_trap_trigger(c: Character, chest: Dict[str, Any], rng=random):
+    trap = chest["trap"]
+    dmg_roll = rng.choice(["1d8", "1d10", "2d4"])
+    dmg = roll(dmg_roll, rng)
+    c.hp = max(0, c.hp - dmg)
+    say(f"The trap strikes for {dmg} damage! ({dmg_roll}) HP {c.hp}/{c.max_hp}")
+    trap["armed"] = False
+    trap["disarmed"] = True  # once sprung, it's effectively neutralized
+
+# --------------------------
+# Command registry
+# --------------------------
+class CommandError(ValueError):
+    """A command line that doesn't resolve; the message is shown to the player."""
+
+@dataclass
+class Command:
+    name: str                                       # canonical phrase, lower-case words
+    handler: Callable[..., Any]
+    parse: Optional[Callable[[str], Any]] = None    # argument parser; None = takes no argument
+    usage: str = ""
+    aliases: Tuple[str, ...] = ()
+
+class _TrieNode:
+    __slots__ = ("children", "prefixes", "command")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.prefixes: Dict[str, Optional[str]] = {}  # abbreviation -> child word, None if ambiguous
+        self.command: Optional[Command] = None
+
+class CommandRegistry:
+    """
+    The commands of one game mode in a trie of words. resolve() walks the input a
+    word at a time, so lookup is O(length of the command) however many commands
+    are registered. A word may be cut to any prefix unique among its siblings;
+    the text after the longest matching phrase is the argument, checked by the
+    command's parser. Handlers are called by the owner (engine, combat, ...).
+    """
+    def __init__(self, commands=(), unknown: str = "Unknown command. Type HELP."):
+        self.root = _TrieNode()
+        self.unknown = unknown
+        self.commands: List[Command] = []
+        for command in commands:
+            self.add(command)
+
+    def add(self, command: Command):
+        for phrase in (command.name,) + tuple(command.aliases):
+            node = self.root
+            for word in phrase.split():
+                child = node.children.get(word)
+                if child is None:
+                    child = node.children[word] = _TrieNode()
+                    for k in range(1, len(word)):
+                        node.prefixes[word[:k]] = None if word[:k] in node.prefixes else word
+                node = child
+            if node.command is not None and node.command is not command:
+                raise ValueError(f"Duplicate command phrase: {phrase!r}")
+            node.command = command
+        self.commands.append(command)
+
+    def resolve(self, text: str) -> Tuple[Command, Any]:
+        """Match a command line; returns (command, parsed argument) or raises CommandError."""
+        words = text.split()
+        node, match, used = self.root, None, 0
+        for k, word in enumerate(words):
+            word = word.lower()
+            child = node.children.get(word)
+            if child is None and word in node.prefixes:
+                full = node.prefixes[word]
+                if full is None:
+                    if match is not None:
+                        break  # leave it to the matched command's argument
+                    options = sorted(w.upper() for w in node.children if w.startswith(word))
+                    raise CommandError(f"Ambiguous command {word.upper()!r}: {', '.join(options)}?")
+                child = node.children[full]
+            if child is None:
+                break
+            node = child
+            if node.command is not None:
+                match, used = node.command, k + 1
+        if match is None:
+            raise CommandError(self.unknown)
+        arg = " ".join(words[used:])
+        usage = f"Usage: {match.usage or match.name.upper()}"
+        if match.parse is None:
+            if arg:
+                raise CommandError(usage)
+            return match, None
+        try:
+            return match, match.parse(arg)
+        except ValueError as e:
+            raise CommandError(str(e) or usage) from None
+
+def arg_text(arg: str) -> str:
+    """Required free text (item, spell or potion name)."""
+    if not arg:
+        raise ValueError
+    return arg
+
+def arg_choice(*choices: str, default: Optional[str] = None) -> Callable[[str], str]:
+    """Parser accepting one of `choices` (or a unique prefix); `default` when omitted."""
+    def parse(arg: str) -> str:
+        if not arg and default is not None:
+            return default
+        hits = [c for c in choices if c.startswith(arg.lower())] if arg else []
+        if len(hits) != 1:
+            raise ValueError
+        return hits[0]
+    return parse
+
+# --------------------------
+# Combat
+# --------------------------
+def start_fight(c: Character, m: Monster, boss: bool = False) -> Fight:
+    say(f"\nA {m.name} appears! HP {m.hp}, AC {m.ac}")
+    c.effects.ac_turns = max(0, c.effects.ac_turns)
+    return Fight(m, boss)
+
+# typical foe for shop odds: the average dungeon monster
+ODDS_REFERENCE_AC = round(sum(t["ac"] for t in MONSTER_TEMPLATES) / len(MONSTER_TEMPLATES))
+ODDS_REFERENCE_ATTACK = round(sum(t["atk_bonus"] for t in MONSTER_TEMPLATES) / len(MONSTER_TEMPLATES))
+
+def weapon_odds(c: Character, weapon: str, ac: int, aim: str = "middle") -> Tuple[float, float]:
+    """(P(hit), expected damage per round) for player_attack with `weapon` against AC."""
+    w = WEAPONS.get(weapon, WEAPONS["Dagger"])
+    to_hit, dmg_bonus = AIM_MODS[aim]
+    p = hit_chance(c.attack_bonus(weapon) + to_hit, ac)
+    return p, p * damage_distribution(w["damage"], c.mod(w["attr"]), dmg_bonus).mean
+
+def attack_odds(c: Character, ac: int) -> Dict[str, Tuple[float, float]]:
+    """weapon_odds for the equipped weapon at every aim."""
+    return {aim: weapon_odds(c, c.weapon, ac, aim) for aim in AIM_MODS}
+
+def spell_odds(c: Character, spell: str, ac: int) -> Optional[Tuple[float, float]]:
+    """(P(it lands), mean damage or healing when it does) for cast_spell_in_combat; None for buffs."""
+    s = SPELLS[spell]
+    if s["type"] == "attack":
+        return hit_chance(2 + c.mod(s["attr"]), ac), damage_distribution(s["damage"], c.mod(s["attr"])).mean
+    if s["type"] == "attack_auto":
+        return 1.0, damage_distribution(s["damage"], max(0, c.mod(s["attr"]))).mean
+    if s["type"] == "heal":
+        return 1.0, damage_distribution(s["amount"], c.mod(s["attr"])).mean
+    return None
+
+def defense_odds(c: Character, m: Monster) -> Tuple[float, float]:
+    """(P(m hits c), expected damage per monster attack) at c's current AC."""
+    p = hit_chance(m.atk_bonus, c.calc_ac())
+    return p, p * dice_distribution(m.dmg).mean
+
+def trap_save_chance(c: Character, dc: int) -> float:
+    """P(resolve_trap's DEX save succeeds)."""
+    return hit_chance(c.mod("DEX"), dc)
+
+COMBAT_COMMANDS = "Actions: ATTACK HIGH/MIDDLE/LOW, DEFEND HIGH/MIDDLE/LOW, CAST <spell>, DRINK <potion>, RUN, MONSTER INFO, ODDS, HINT"
+
+def combat_action(c: Character, f: Fight, cmd: str, rng=random) -> Optional[str]:
+    """
+    Apply one player combat command. Returns "fled" if the player escaped, else None.
+    """
+    try:
+        command, arg = COMBAT_REGISTRY.resolve(cmd)
+    except CommandError as e:
+        say(str(e))
+        return None
+    return command.handler(c, f, arg, rng)
 
-def show_inventory(c: Character):
-    print("\n--- INVENTORY ---")
-    print(f"Gold: {c.gold}")
-    print(f"Weapon: {c.weapon}")
-    print(f"Armor : {c.armor}")
-    if c.potions:
-        for k, v in c.potions.items():
-            print(f"Potion: {k} x{v}")
-    if c.spells:
-        print("Spells: " + ", ".join(c.spells))
+def _combat_attack(c: Character, f: Fight, aim: str, rng=random):
+    player_attack(c, f.monster, aim, rng)
+    f.turn = "monster" if f.monster.hp > 0 else "player"
 
-def equip_weapon(c: Character, item: str):
-    item_title = item.title()
-    if item_title in WEAPONS:
-        print(f"You equip {item_title}.")
-        c.weapon = item_title
+def _combat_defend(c: Character, f: Fight, aim: str, rng=random):
+    c.effects.ac_buff += 2
+    c.effects.ac_turns = max(c.effects.ac_turns, 1)
+    say("You brace for impact (+2 AC for the next blow).")
+    f.turn = "monster"
+
+def _combat_cast(c: Character, f: Fight, spell: str, rng=random):
+    if cast_spell_in_combat(c, f.monster, spell.title(), rng):
+        f.turn = "monster" if f.monster.hp > 0 else "player"
+
+def _combat_drink(c: Character, f: Fight, name: str, rng=random):
+    if drink_potion(c, name.title()):
+        f.turn = "monster" if f.monster.hp > 0 else "player"
+
+def _combat_info(c: Character, f: Fight, arg, rng=random):
+    m = f.monster
+    say(f"{m.name} — AC {m.ac}, Attack +{m.atk_bonus}, Damage {m.dmg}")
+    say("  You: " + " | ".join(f"{aim.upper()} {p:.0%} hit, {dmg:.1f}/round"
+                              for aim, (p, dmg) in attack_odds(c, m.ac).items()))
+    for spell in c.spells:
+        odds = spell_odds(c, spell, m.ac)
+        if odds is not None and SPELLS[spell]["type"] != "heal":
+            say(f"  {spell}: {odds[0]:.0%} hit, {odds[0] * odds[1]:.1f}/cast")
+    p, dmg = defense_odds(c, m)
+    say(f"  {m.name}: {p:.0%} to hit you (AC {c.calc_ac()}), {dmg:.1f}/round")
+
+def _combat_run(c: Character, f: Fight, arg, rng=random) -> Optional[str]:
+    flee_dc = 10
+    chk = d20(rng) + c.mod("DEX")
+    if chk >= flee_dc:
+        say("You slip away into the shadows!")
+        return "fled"
+    say("You fail to escape!")
+    f.turn = "monster"
+    return None
+
+_AIM = arg_choice("high", "middle", "low", default="middle")
+
+COMBAT_REGISTRY = CommandRegistry([
+    Command("attack", _combat_attack, _AIM, "ATTACK [HIGH/MIDDLE/LOW]"),
+    Command("defend", _combat_defend, _AIM, "DEFEND [HIGH/MIDDLE/LOW]"),
+    Command("cast", _combat_cast, arg_text, "CAST <spell>"),
+    Command("drink", _combat_drink, arg_text, "DRINK <potion>"),
+    Command("monster info", _combat_info, aliases=("monster stats",)),
+    Command("run", _combat_run, aliases=("evade",)),
+    Command("odds", lambda c, f, arg, rng: show_fight_odds(c, f)),
+    Command("hint", lambda c, f, arg, rng: combat_hint(c, f)),
+    Command("profile", lambda c, f, arg, rng: show_profile()),
+    Command("help", lambda c, f, arg, rng: say(COMBAT_COMMANDS)),
+], unknown="Unrecognized combat action.")
+
+def advance_fight(c: Character, f: Fight, rng=random) -> bool:
+    """
+    Run monster turns and start-of-turn upkeep until the player must act.
+    Returns False once the fight is over.
+    """
+    m = f.monster
+    while c.hp > 0 and m.hp > 0:
+        if f.turn == "monster":
+            monster_attack(c, m, rng)
+            f.turn = "player"
+            continue
+        if c.effects.ac_turns > 0:
+            c.effects.ac_turns -= 1
+            if c.effects.ac_turns == 0:
+                c.effects.ac_buff = 0
+        say(f"\nYour HP {c.hp}/{c.max_hp}  |  {m.name} HP {m.hp}")
+        return True
+    return False
+
+def finish_fight(c: Character, f: Fight, rng=random) -> bool:
+    m = f.monster
+    if c.hp <= 0:
+        say("\nYou fall… Your adventure ends here.")
+        return False
     else:
-        print("That is not a valid weapon.")
+        say(f"\nYou defeated the {m.name}!")
+        c.gold += m.gold
+        c.xp += m.xp
+        say(f"Gained {m.xp} XP and {m.gold} gold.")
+        c.level_up_if_ready(rng)
+        return True
 
-def wear_armor(c: Character, item: str):
-    item_title = item.title()
-    if item_title in ARMORS:
-        print(f"You wear {item_title}.")
-        c.armor = item_title
+AIM_MODS = {"low": (+2, -1), "middle": (0, 0), "high": (-2, +1)}  # aim -> (to-hit, damage) modifiers
+
+def player_attack(c: Character, m: Monster, aim: str, rng=random):
+    aim_mod, dmg_bonus = AIM_MODS[aim]
+    atk_total = d20(rng) + c.attack_bonus() + aim_mod
+    say(f"You strike ({aim})! Attack roll = {atk_total} vs AC {m.ac}")
+    if atk_total >= m.ac:
+        dmg = max(1, c.damage_roll(rng) + dmg_bonus)
+        m.hp = max(0, m.hp - dmg)
+        say(f"Hit for {dmg} damage. {m.name} HP now {m.hp}.")
+    else:
+        say("You miss!")
+
+def monster_attack(c: Character, m: Monster, rng=random):
+    atk = d20(rng) + m.atk_bonus
+    ac = c.calc_ac()
+    say(f"{m.name} attacks! Roll {atk} vs AC {ac}")
+    if atk >= ac:
+        dmg = roll(m.dmg, rng)
+        c.hp = max(0, c.hp - dmg)
+        say(f"{m.name} hits you for {dmg}! HP {c.hp}/{c.max_hp}")
+    else:
+        say(f"{m.name} misses.")
+
+def cast_spell_in_combat(c: Character, m: Monster, spell: str, rng=random) -> bool:
+    if spell not in c.spells or spell not in SPELLS:
+        say("You don't know that spell.")
+        return False
+    s = SPELLS[spell]
+    if s["type"] == "attack":
+        atk = d20(rng) + 2 + c.mod(s["attr"])
+        say(f"You cast {spell}! Spell attack {atk} vs AC {m.ac}")
+        if atk >= m.ac:
+            dmg = max(1, roll(s["damage"], rng) + c.mod(s["attr"]))
+            m.hp = max(0, m.hp - dmg)
+            say(f"{spell} hits for {dmg}! {m.name} HP {m.hp}")
+        else:
+            say(f"{spell} misses.")
+        return True
+    elif s["type"] == "attack_auto":
+        dmg = max(1, roll(s["damage"], rng) + max(0, c.mod(s["attr"])))
+        m.hp = max(0, m.hp - dmg)
+        say(f"{spell} automatically strikes for {dmg}! {m.name} HP {m.hp}")
+        return True
+    elif s["type"] == "heal":
+        amt = max(1, roll(s["amount"], rng) + c.mod(s["attr"]))
+        c.hp = min(c.max_hp, c.hp + amt)
+        say(f"You cast {spell} and heal {amt}. HP {c.hp}/{c.max_hp}")
+        return True
+    elif s["type"] == "buff_ac":
+        c.effects.ac_buff += s["bonus"]
+        c.effects.ac_turns = max(c.effects.ac_turns, s["turns"])
+        say(f"{spell} grants +{s['bonus']} AC for {s['turns']} turns.")
+        return True
+    else:
+        say("Spell fizzles.")
+        return False
+
+def cast_spell_out_of_combat(c: Character, spell: str, rng=random):
+    if spell not in c.spells or spell not in SPELLS:
+        say("You don't know that spell.")
+        return
+    s = SPELLS[spell]
+    if s["type"] == "heal":
+        amt = max(1, roll(s["amount"], rng) + c.mod(s["attr"]))
+        c.hp = min(c.max_hp, c.hp + amt)
+        say(f"You cast {spell} and heal {amt}. HP {c.hp}/{c.max_hp}")
+    elif s["type"] == "buff_ac":
+        c.effects.ac_buff += s["bonus"]
+        c.effects.ac_turns = max(c.effects.ac_turns, s["turns"])
+        say(f"{spell} grants +{s['bonus']} AC for {s['turns']} turns.")
+    else:
+        say("That spell is best used in combat.")
+
+def drink_potion(c: Character, name: str) -> bool:
+    if name not in c.potions or c.potions[name] <= 0:
+        say("You don't have that potion.")
+        return False
+    c.potions[name] -= 1
+    heal = POTION_HEALS.get(POTIONS.get(name, {}).get("effect"))
+    if heal:
+        c.hp = min(c.max_hp, c.hp + heal)
+        say(f"You drink {name} and heal {heal}. HP {c.hp}/{c.max_hp}")
     else:
-        print("That is not a valid armor.")
+        say("It tastes… fine?")
+    return True
 
 # --------------------------
-# Dungeon exploration & combat
+# Fight solver
 # --------------------------
-def explore_loop(c: Character, d: Dungeon):
-    print("\nYou travel to the dungeon entrance… darkness beckons.")
-    while c.hp > 0:
-        x, y = d.player_pos
-        room = d.grid[x][y]
-        if not room.visited:
-            print(f"\nYou enter a new chamber at {d.player_pos}.")
-            room.visited = True
-            trigger_room(c, d, room)
-            if c.hp <= 0:
+@dataclass(frozen=True)
+class FightPolicy:
+    """
+    A fixed plan for a whole fight: `action` every turn ("attack", "defend" or
+    an attack/AC spell), except drink a healing potion at or below `drink_at`
+    HP and try to RUN at or below `run_at` HP (0 turns either rule off).
+    """
+    action: str = "attack"
+    aim: str = "middle"
+    drink_at: int = 0
+    run_at: int = 0
+
+    def describe(self) -> str:
+        text = f"ATTACK {self.aim.upper()}" if self.action == "attack" else self.action.upper()
+        if self.drink_at:
+            text += f", potion at {self.drink_at} HP"
+        if self.run_at:
+            text += f", run at {self.run_at} HP"
+        return text
+
+@dataclass(frozen=True)
+class FightOdds:
+    win: float
+    flee: float
+    die: float
+    hp: float               # expected HP when the fight ends, counting death as 0
+    stalemate: float = 0.0  # neither side can ever end the fight
+
+def _fight_move(c: Character, policy: FightPolicy, ac: int) -> tuple:
+    """The policy's every-turn action as ("hit", P(lands), dice, bonuses) or ("guard", AC, turns)."""
+    if policy.action == "attack":
+        w = WEAPONS.get(c.weapon, WEAPONS["Dagger"])
+        to_hit, dmg_bonus = AIM_MODS[policy.aim]
+        return ("hit", hit_chance(c.attack_bonus() + to_hit, ac), w["damage"], (c.mod(w["attr"]), dmg_bonus))
+    if policy.action == "defend":
+        return ("guard", 2, 1)
+    if policy.action not in c.spells or policy.action not in SPELLS:
+        raise ValueError(f"{c.name} doesn't know {policy.action}.")
+    s = SPELLS[policy.action]
+    if s["type"] == "attack":
+        return ("hit", hit_chance(2 + c.mod(s["attr"]), ac), s["damage"], (c.mod(s["attr"]),))
+    if s["type"] == "attack_auto":
+        return ("hit", 1.0, s["damage"], (max(0, c.mod(s["attr"])),))
+    if s["type"] == "buff_ac":
+        return ("guard", s["bonus"], s["turns"])
+    raise ValueError(f"{policy.action} can't be cast every turn of a fight.")
+
+def fight_odds(c: Character, foe, policy: FightPolicy = FightPolicy(), upkeep: bool = True) -> FightOdds:
+    """
+    Exact outcome of fighting `foe` (a Monster, or a template whose HP is not
+    rolled yet) with `policy`, from c's current HP, potions and AC buff. Pass
+    upkeep=False when it is already c's turn in a running fight.
+    """
+    if isinstance(foe, Monster):
+        ac, atk, dmg, hp = foe.ac, foe.atk_bonus, foe.dmg, foe.hp
+    else:
+        ac, atk, dmg, hp = foe["ac"], foe["atk_bonus"], foe["dmg"], foe["hp"]
+    potions = sorted((POTION_HEALS[POTIONS[name]["effect"]], n) for name, n in c.potions.items()
+                     if n > 0 and POTIONS.get(name, {}).get("effect") in POTION_HEALS)
+    return _solve_fight((
+        c.hp, c.max_hp, c.calc_ac() - c.effects.ac_buff, c.effects.ac_buff, c.effects.ac_turns,
+        _fight_move(c, policy, ac), tuple(h for h, _ in potions), tuple(n for _, n in potions),
+        hit_chance(c.mod("DEX"), 10), policy.drink_at, policy.run_at, atk, dmg, hp, upkeep,
+    ))
+
+@functools.lru_cache(maxsize=256)
+def _solve_fight(params: tuple) -> FightOdds:
+    """
+    Markov chain over (player HP, foe HP, AC buff, buff turns, potions) at the
+    player's turn, solved state by state with an explicit stack, each after the
+    states it leads to. Every step spends HP, potions or buff turns, except a
+    round where nothing changes: that self-loop is folded in by dividing by
+    1 - P(loop) instead of being iterated.
+    """
+    (hp, max_hp, base_ac, buff, turns, move, heals, potions,
+     p_run, drink_at, run_at, atk, dmg, foe_hp, upkeep) = params
+    cap = max(0, atk + 21 - base_ac)  # more AC than this and the foe can't hit anyway
+    p_struck = [hit_chance(atk, base_ac + b) for b in range(cap + 1)]
+    struck = dice_distribution(dmg).items()
+    if move[0] == "hit":
+        p_land, dealt = move[1], damage_distribution(move[2], *move[3]).items()
+    memo: Dict[tuple, tuple] = {}      # player's turn -> (win, flee, die, HP at the end, stalemate)
+    foe_memo: Dict[tuple, tuple] = {}  # state after the player acted -> foe_turn() result
+    plans: Dict[tuple, list] = {}      # plan() of player's turns waiting on their dependencies
+
+    def plan(key: tuple) -> list:
+        """
+        The player's action at `key`, in order: ("end", outcome) where the fight
+        stops on the spot, ("then", weight, state) where the foe's turn follows.
+        """
+        php, mhp, b, t, pots = key
+        if run_at and php <= run_at:
+            return [("end", (0.0, p_run, 0.0, p_run * php, 0.0)), ("then", 1 - p_run, key)]
+        if drink_at and php <= drink_at and any(pots):
+            # the smallest potion that covers the wound, else the biggest one left
+            held = [i for i, n in enumerate(pots) if n]
+            i = next((i for i in held if heals[i] >= max_hp - php), held[-1])
+            return [("then", 1.0, (min(max_hp, php + heals[i]), mhp, b, t, pots[:i] + (pots[i] - 1,) + pots[i + 1:]))]
+        if move[0] == "hit":
+            steps = [("then", 1 - p_land, key)] if p_land < 1 else []
+            for d, p in dealt:
+                if d >= mhp:
+                    steps.append(("end", (p_land * p, 0.0, 0.0, p_land * p * php, 0.0)))
+                else:
+                    steps.append(("then", p_land * p, (php, mhp - d, b, t, pots)))
+            return steps
+        return [("then", 1.0, (php, mhp, min(cap, b + move[1]), max(t, move[2]), pots))]
+
+    def after_upkeep(state: tuple) -> tuple:
+        """The player's next turn if the foe misses: its AC buff has one turn less."""
+        php, mhp, b, t, pots = state
+        if t:
+            t -= 1
+            b = b if t else 0
+        return php, mhp, b, t, pots
+
+    def foe_turn(state: tuple) -> tuple:
+        """
+        The foe's attack and upkeep once the player has acted: (outcome of the
+        rounds where it hits, P(it misses), the player's next turn after a miss).
+        """
+        php, mhp, b, t, pots = nxt = after_upkeep(state)
+        ph = p_struck[state[2]]
+        acc = [0.0] * 5
+        for d, p in struck:
+            if php <= d:
+                acc[2] += ph * p
+                continue
+            v = memo[(php - d, mhp, b, t, pots)]
+            w = ph * p
+            acc[0] += w * v[0]; acc[1] += w * v[1]; acc[2] += w * v[2]
+            acc[3] += w * v[3]; acc[4] += w * v[4]
+        return acc, 1 - ph, nxt
+
+    def value(key: tuple) -> tuple:
+        acc = [0.0] * 5  # win, flee, die, HP at the end, stalemate
+        loop = 0.0       # weight of rounds that come back to `key`
+        for step in plans.pop(key):
+            if step[0] == "end":
+                end = step[1]
+                acc[0] += end[0]; acc[1] += end[1]; acc[2] += end[2]
+                acc[3] += end[3]; acc[4] += end[4]
+                continue
+            w, state = step[1], step[2]
+            r = foe_memo.get(state)
+            if r is None:
+                r = foe_memo[state] = foe_turn(state)
+            hit, miss, nxt = r
+            acc[0] += w * hit[0]; acc[1] += w * hit[1]; acc[2] += w * hit[2]
+            acc[3] += w * hit[3]; acc[4] += w * hit[4]
+            if not miss:
+                continue
+            w *= miss
+            if nxt == key:
+                loop += w
+                continue
+            v = memo[nxt]
+            acc[0] += w * v[0]; acc[1] += w * v[1]; acc[2] += w * v[2]
+            acc[3] += w * v[3]; acc[4] += w * v[4]
+        if loop > 1 - 1e-12:
+            return (0.0, 0.0, 0.0, 0.0, 1.0)
+        return tuple(x / (1 - loop) for x in acc)
+
+    def needs(key: tuple) -> List[tuple]:
+        """Unsolved player's turns that `key` leads to, through the foe's turn after each action."""
+        out = []
+        steps = plans[key] = plan(key)
+        for step in steps:
+            if step[0] != "then":
+                continue
+            state = step[2]
+            php, mhp, b, t, pots = nxt = after_upkeep(state)
+            if state not in foe_memo:
+                out.extend(k for k in ((php - d, mhp, b, t, pots) for d, _ in struck if php > d) if k not in memo)
+            if nxt != key and nxt not in memo and p_struck[state[2]] < 1:
+                out.append(nxt)
+        return out
+
+    def solve(root: tuple) -> tuple:
+        stack = [(root, False)]
+        active = set()  # turns whose dependencies are being solved: meeting one again is a cycle
+        while stack:
+            key, ready = stack.pop()
+            if key in memo:
+                continue
+            if ready:
+                memo[key] = value(key)
+                active.discard(key)
+                continue
+            if key in active:
+                raise RuntimeError("Fight policy revisits a state; it can't be solved exactly.")
+            active.add(key)
+            stack.append((key, True))
+            stack.extend((dep, False) for dep in needs(key))
+        return memo[root]
+
+    if upkeep and turns:
+        turns -= 1
+        buff = buff if turns else 0
+    start = [(foe_hp, 1.0)] if isinstance(foe_hp, int) else dice_distribution(foe_hp).items()
+    total = [0.0] * 5
+    for mhp, p in start:
+        if hp <= 0:
+            v = (0.0, 0.0, 1.0, 0.0, 0.0)
+        elif mhp <= 0:
+            v = (1.0, 0.0, 0.0, float(hp), 0.0)
+        else:
+            v = solve((hp, mhp, min(cap, buff), turns, potions))
+        for i in range(5):
+            total[i] += p * v[i]
+    return FightOdds(*total)
+
+def fight_policies(c: Character) -> List[FightPolicy]:
+    """Policies worth comparing for c: every aim and attack spell, with a potion rule if c has any."""
+    drink_at = c.max_hp // 3 if any(n > 0 and POTIONS.get(p, {}).get("effect") in POTION_HEALS
+                                    for p, n in c.potions.items()) else 0
+    policies = [FightPolicy("attack", aim, drink_at) for aim in ("high", "middle", "low")]
+    policies += [FightPolicy(s, drink_at=drink_at) for s in c.spells
+                 if SPELLS.get(s, {}).get("type") in ("attack", "attack_auto")]
+    return policies
+
+def best_fight_odds(c: Character, foe, upkeep: bool = True) -> Tuple[FightPolicy, FightOdds]:
+    """The fight_policies entry with the best chance of winning (then the most HP left)."""
+    return max(((p, fight_odds(c, foe, p, upkeep)) for p in fight_policies(c)),
+               key=lambda po: (round(po[1].win, 9), po[1].hp))
+
+def show_fight_odds(c: Character, f: Optional[Fight] = None, depth: int = 1):
+    """ODDS: every policy against the current foe, or the best one against each monster of floor `depth`."""
+    if f is not None:
+        say(f"Odds against the {f.monster.name} (HP {f.monster.hp}) from here:")
+        for policy in fight_policies(c):
+            o = fight_odds(c, f.monster, policy, upkeep=False)
+            say(f"  {policy.describe().ljust(34)} win {o.win:6.1%}  die {o.die:6.1%}  HP left {o.hp:5.1f}")
+        say(f"  RUN now: {hit_chance(c.mod('DEX'), 10):.0%} to escape")
+        return
+    say(f"Odds of a fresh fight at HP {c.hp}/{c.max_hp} (best plan)" + (f" on floor {depth}:" if depth > 1 else ":"))
+    for template in MONSTER_TEMPLATES + [NECROMANCER]:
+        policy, o = best_fight_odds(c, floor_template(template, depth))
+        say(f"  {template['name'].ljust(17)} win {o.win:6.1%}  die {o.die:6.1%}  "
+            f"HP left {o.hp:5.1f}  ({policy.describe()})")
+
+# --------------------------
+# Combat AI
+# --------------------------
+AI_TIME_BUDGET = 0.0008  # seconds of search per decision; the node in progress when it runs out adds a little
+AI_NODE_BUDGET = 3000    # positions searched per decision
+AI_MAX_DEPTH = 8         # player turns looked ahead
+AI_TABLE_SIZE = 1 << 17  # transposition entries kept per character/foe pairing
+AI_MODELS = 16           # pairings kept
+AI_FLEE_VALUE = 0.3      # escaping alive, against 1 for a win and 0 for death
+AI_HP_WEIGHT = 0.1       # bonus for HP left when the fight ends
+AI_GUESS_DISCOUNT = 0.95  # a heuristic estimate is never worth a sure win
+
+class _SearchBudget(Exception):
+    """The decision's node or time budget ran out mid-search."""
+
+class _CombatModel:
+    """
+    One character build against one foe: each action's outcome distribution
+    and the foe's hit chance per AC buff, plus the transposition tables that
+    stay valid as long as those numbers do.
+    """
+    def __init__(self, c: Character, foe: Monster):
+        self.max_hp = c.max_hp
+        base_ac = c.calc_ac() - c.effects.ac_buff
+        self.cap = max(0, foe.atk_bonus + 21 - base_ac)
+        mean = dice_distribution(foe.dmg).mean
+        self.p_struck = [hit_chance(foe.atk_bonus, base_ac + b) for b in range(self.cap + 1)]
+        self.foe_rate = [p * mean for p in self.p_struck]
+        self.struck = dice_distribution(foe.dmg).items()
+        self.potions = [name for name, p in POTIONS.items() if p["effect"] in POTION_HEALS]
+        self.actions: List[tuple] = []  # (command, kind, *data)
+        for aim in ("high", "middle", "low"):
+            _, p, dice, bonuses = _fight_move(c, FightPolicy("attack", aim), foe.ac)
+            self.actions.append((f"attack {aim}", "hit", p, damage_distribution(dice, *bonuses).items()))
+        self.actions.append(("defend", "guard", 2, 1))
+        for spell in c.spells:
+            s = SPELLS.get(spell, {})
+            if s.get("type") == "heal":
+                self.actions.append((f"cast {spell.lower()}", "heal",
+                                     damage_distribution(s["amount"], c.mod(s["attr"])).items()))
+            elif s.get("type") in ("attack", "attack_auto", "buff_ac"):
+                move = _fight_move(c, FightPolicy(spell), foe.ac)
+                if move[0] == "hit":
+                    move = ("hit", move[1], damage_distribution(move[2], *move[3]).items())
+                self.actions.append((f"cast {spell.lower()}",) + move)
+        for i, name in enumerate(self.potions):
+            self.actions.append((f"drink {name.lower()}", "potion", i, POTION_HEALS[POTIONS[name]["effect"]]))
+        self.actions.append(("run", "run", hit_chance(c.mod("DEX"), 10)))
+        self.heals = [POTION_HEALS[POTIONS[name]["effect"]] for name in self.potions]
+        self.kill_rate = max([a[2] * sum(d * p for d, p in a[3]) for a in self.actions if a[1] == "hit"], default=0.0)
+        self.table: Dict[Any, tuple] = {}   # decision key (see pack) -> (depth, value, action index)
+        self.chance: Dict[Any, tuple] = {}  # after-action key -> (depth, value)
+
+    @staticmethod
+    def signature(c: Character, foe: Monster) -> tuple:
+        """Everything the model's numbers depend on."""
+        return (c.max_hp, c.calc_ac() - c.effects.ac_buff, c.level, c.weapon, tuple(c.attrs.items()),
+                tuple(c.spells), foe.ac, foe.atk_bonus, foe.dmg)
+
+    def state(self, c: Character, foe: Monster) -> tuple:
+        return (c.hp, foe.hp, min(self.cap, c.effects.ac_buff), c.effects.ac_turns,
+                tuple(c.potions.get(name, 0) for name in self.potions))
+
+    @staticmethod
+    def pack(php: int, mhp: int, b: int, t: int, pots: tuple) -> Any:
+        """
+        A combat state as one int: 10 bits per HP, 6 for buff and turns, 6 per
+        potion count. A state with a field too big for its bits (deep-floor HP,
+        a hoard of potions) is keyed by the tuple itself, so no two states share
+        a key.
+        """
+        if php >> 10 or mhp >> 10 or b >> 6 or t >> 6 or any(n >> 6 for n in pots):
+            return (php, mhp, b, t, pots)
+        key = (((php << 10 | mhp) << 6 | b) << 6) | t
+        for n in pots:
+            key = key << 6 | n
+        return key
+
+class CombatAI:
+    """
+    Expectimax over the combat dice: the player picks the action with the best
+    expected outcome, and every roll (to-hit, damage, the foe's attack, a RUN
+    check) is a chance node. Searches deepen a turn at a time until the node or
+    time budget runs out; positions already valued at that depth come from a
+    transposition table that persists across moves and fights.
+    """
+    def __init__(self, time_budget: float = AI_TIME_BUDGET, node_budget: int = AI_NODE_BUDGET,
+                 max_depth: int = AI_MAX_DEPTH):
+        self.time_budget = time_budget
+        self.node_budget = node_budget
+        self.max_depth = max_depth
+        self.models: "collections.OrderedDict[tuple, _CombatModel]" = collections.OrderedDict()
+        self.nodes = 0
+        self.depth = 0
+
+    def model(self, c: Character, foe: Monster) -> _CombatModel:
+        key = _CombatModel.signature(c, foe)
+        m = self.models.get(key)
+        if m is not None:
+            self.models.move_to_end(key)
+            return m
+        m = self.models[key] = _CombatModel(c, foe)
+        if len(self.models) > AI_MODELS:
+            self.models.popitem(last=False)
+        return m
+
+    def choose(self, c: Character, foe: Monster) -> str:
+        """The combat command to play now (e.g. "attack low", "drink healing potion")."""
+        return self.evaluate(c, foe)[0]
+
+    def evaluate(self, c: Character, foe: Monster) -> Tuple[str, float]:
+        """(best command, its expected value: ~1 a win, AI_FLEE_VALUE an escape, 0 death)."""
+        m = self.model(c, foe)
+        if len(m.table) + len(m.chance) > AI_TABLE_SIZE:
+            m.table.clear()
+            m.chance.clear()
+        s = m.state(c, foe)
+        deadline = time.perf_counter() + self.time_budget
+        self.nodes, self.depth = 0, 1
+        self._deadline = None
+        value, best = self._decide(m, s, 1)  # always finish one full turn of lookahead
+        self._deadline = deadline
+        for depth in range(2, self.max_depth + 1):
+            try:
+                value, best = self._decide(m, s, depth)
+            except _SearchBudget:
                 break
-        print(f"\nYou are at {d.player_pos}.")
-        print("Dungeon commands: WHERE AM I / LOOK, MAP, MOVE <N/E/S/W>, STATUS, INVENTORY, DRINK <potion>, CAST <spell>,")
-        print("                  EXAMINE CHEST FOR TRAPS, DISARM CHEST TRAP, PICK CHEST LOCK, PRY CHEST LOCK, OPEN CHEST,")
-        print("                  SAVE, LOAD, RETURN TOWN, HELP")
-        cmd = input("> ").strip()
+            self.depth = depth
+        return m.actions[best][0], value
+
+    def _decide(self, m: _CombatModel, s: tuple, depth: int) -> Tuple[float, int]:
+        php, mhp, b, t, pots = s
+        if depth == 0:
+            return self._guess(m, php, mhp, b, pots), 0
+        key = m.pack(*s)
+        hit = m.table.get(key)
+        if hit is not None and hit[0] >= depth:
+            return hit[1], hit[2]
+        self.nodes += 1
+        if self._deadline is not None and (self.nodes > self.node_budget or time.perf_counter() > self._deadline):
+            raise _SearchBudget
+        hp_bonus = AI_HP_WEIGHT * php / m.max_hp
+        best_value, best = -1.0, 0
+        for i, action in enumerate(m.actions):
+            kind = action[1]
+            v = 0.0
+            if kind == "hit":
+                p_land, dealt = action[2], action[3]
+                if p_land < 1:
+                    v += (1 - p_land) * self._foe_turn(m, php, mhp, b, t, pots, depth)
+                for d, p in dealt:
+                    if d >= mhp:
+                        v += p_land * p * (1 + hp_bonus)
+                    else:
+                        v += p_land * p * self._foe_turn(m, php, mhp - d, b, t, pots, depth)
+            elif kind == "guard":
+                v = self._foe_turn(m, php, mhp, min(m.cap, b + action[2]), max(t, action[3]), pots, depth)
+            elif kind == "heal":
+                if php >= m.max_hp:
+                    continue
+                for amt, p in action[2]:
+                    v += p * self._foe_turn(m, min(m.max_hp, php + amt), mhp, b, t, pots, depth)
+            elif kind == "potion":
+                k = action[2]
+                if not pots[k] or php >= m.max_hp:
+                    continue
+                left = pots[:k] + (pots[k] - 1,) + pots[k + 1:]
+                v = self._foe_turn(m, min(m.max_hp, php + action[3]), mhp, b, t, left, depth)
+            else:  # run
+                p_run = action[2]
+                v = p_run * (AI_FLEE_VALUE + hp_bonus)
+                if p_run < 1:
+                    v += (1 - p_run) * self._foe_turn(m, php, mhp, b, t, pots, depth)
+            if v > best_value + 1e-12:
+                best_value, best = v, i
+        m.table[key] = (depth, best_value, best)
+        return best_value, best
+
+    def _foe_turn(self, m: _CombatModel, php: int, mhp: int, b: int, t: int, pots: tuple, depth: int) -> float:
+        """Expected value once the player has acted: the foe's attack, upkeep, then depth-1 more turns."""
+        key = m.pack(php, mhp, b, t, pots)
+        hit = m.chance.get(key)
+        if hit is not None and hit[0] >= depth:
+            return hit[1]
+        ph = m.p_struck[b]
+        if t:
+            t -= 1
+            b = b if t else 0
+        v = (1 - ph) * self._decide(m, (php, mhp, b, t, pots), depth - 1)[0] if ph < 1 else 0.0
+        if ph > 0:
+            for d, p in m.struck:
+                if d < php:
+                    v += ph * p * self._decide(m, (php - d, mhp, b, t, pots), depth - 1)[0]
+        m.chance[key] = (depth, v)
+        return v
+
+    @staticmethod
+    def _guess(m: _CombatModel, php: int, mhp: int, b: int, pots: tuple) -> float:
+        """Heuristic at the search horizon: rounds we can last against rounds the foe can."""
+        if m.kill_rate <= 0:
+            return 0.0
+        kill = mhp / m.kill_rate
+        rate = m.foe_rate[b]
+        if rate <= 0:
+            share = 1.0
+        else:
+            last = (php + sum(n * h for n, h in zip(pots, m.heals))) / rate
+            share = last / (last + kill)
+        return AI_GUESS_DISCOUNT * share * (1 + AI_HP_WEIGHT * php / m.max_hp)
+
+_HINT_AI: Optional[CombatAI] = None
+
+def combat_hint(c: Character, f: Fight):
+    """HINT: the action the combat AI would take now."""
+    global _HINT_AI
+    if _HINT_AI is None:
+        _HINT_AI = CombatAI()
+    say(f"Hint: {_HINT_AI.choose(c, f.monster).upper()}")
+
+def simulate_fight(c: Character, m: Monster, ai: Optional[CombatAI] = None, rng=random,
+                   boss: bool = False, max_turns: int = 1000) -> str:
+    """
+    Play a whole fight with `ai` choosing every action and no output, for bots
+    and load tests. Rewards are applied as in a normal fight. Returns "won",
+    "fled", "died", or "stalemate" if max_turns pass first.
+    """
+    ai = ai or CombatAI()
+    token = _EVENT_SINK.set([])  # fight narration is never shown
+    try:
+        f = start_fight(c, m, boss)
+        for _ in range(max_turns):
+            if not advance_fight(c, f, rng):
+                return "won" if finish_fight(c, f, rng) else "died"
+            if combat_action(c, f, ai.choose(c, m), rng) == "fled":
+                return "fled"
+        return "stalemate"
+    finally:
+        _EVENT_SINK.reset(token)
+
+# --------------------------
+# Game engine (headless)
+# --------------------------
+TOWN_COMMANDS = "Commands: LIST, PURCHASE <item>, SELL <item>, REST, TRAIN, ENTER DUNGEON, SAVE, LOAD, HOF, STATUS, INVENTORY, EQUIP <weapon>, WEAR <armor>, ODDS, HELP, QUIT"
+
+DUNGEON_COMMANDS = (
+    "Dungeon commands: WHERE AM I / LOOK, MAP [OVERVIEW], MOVE <N/E/S/W>, GOTO <row,col|NEAREST|BOSS>, RETURN ENTRANCE,\n"
+    "                  DESCEND (from the lair, once the boss falls),\n"
+    "                  STATUS, INVENTORY, DRINK <potion>, CAST <spell>, ODDS,\n"
+    "                  EXAMINE CHEST FOR TRAPS, DISARM CHEST TRAP, PICK CHEST LOCK, PRY CHEST LOCK, OPEN CHEST,\n"
+    "                  SAVE, LOAD, RETURN TOWN, HELP"
+)
+
+CHEST_ACTIONS = {
+    "examine chest for traps": chest_examine,
+    "disarm chest trap": chest_disarm,
+    "pick chest lock": chest_pick_lock,
+    "pry chest lock": chest_pry_lock,
+    "open chest": chest_open,
+}
+
+class GameEngine:
+    """
+    One game session: a Character and Dungeon advanced a command at a time.
+    step() returns the Events a command produced instead of printing them, and
+    never blocks, so the REPL, a server or a bot can all drive the same game.
+    """
+    def __init__(self, c: Optional[Character] = None, d: Optional[Dungeon] = None,
+                 persist: bool = True, seed: Optional[int] = None,
+                 dungeon_size: Tuple[int, int] = (10, 10), grid_backend: str = "list",
+                 save_format: str = "json", map_size: Tuple[int, int] = MAP_VIEW,
+                 map_path: str = MMAP_DUNGEON_FILE, dungeon_seed: Optional[int] = None):
+        self.c = c
+        self.d = d
+        self.persist = persist  # False disables SAVE/LOAD (e.g. shared server processes)
+        self.dungeon_size = dungeon_size
+        self.grid_backend = grid_backend  # see GRID_BACKENDS
+        self.map_path = map_path  # mmap backend: this session's map file; deeper floors sit beside it
+        self.map_size = map_size  # MAP window, rows x cols
+        if save_format not in SAVE_FORMATS:
+            raise ValueError(f"Unknown save format: {save_format!r}")
+        self.save_format = save_format
+        self.journal = SaveJournal() if save_format == "journal" and persist else None
+        # every roll in this session comes from self.rng, so a seed replays the whole game
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.rng = random.Random(self.seed)
+        self.dungeon_seed = dungeon_seed  # generate_dungeon seed for new games (e.g. from --seed-batch)
+        self.fight: Optional[Fight] = None
+        # the floor below self.d, built in the background (and pre-serialized for journaled saves)
+        self.floors = FloorPrefetch(serialize=self.journal is not None)
+        self.mode = "menu" if c is None or d is None else "town"
+        self.prompt = "> "
+        self._draft: Dict[str, Any] = {}  # character being created
+        self._handlers = {
+            "menu": self._menu,
+            "create": self._create,
+            "town": self._town,
+            "train": self._train,
+            "dungeon": self._dungeon,
+            "combat": self._combat,
+            "quit": lambda cmd: None,
+        }
+
+    # ---- public API ----
+    def start(self) -> List[Event]:
+        """Events to show before the first command."""
+        return self._collect(self._start)
+
+    def step(self, command: str) -> List[Event]:
+        """Apply one command and return what happened."""
+        if self.mode in ("dungeon", "combat"):
+            self.c.turns += 1
+        if _PROFILER is None:
+            return self._collect(self._handlers[self.mode], command.strip())
+        key = _PROFILER.command_key(self.mode, command)
+        t0 = time.perf_counter()
+        try:
+            return self._collect(self._handlers[self.mode], command.strip())
+        finally:
+            _PROFILER.record(key, time.perf_counter() - t0)
+
+    async def step_async(self, command: str) -> List[Event]:
+        """
+        step() for an asyncio loop: a DESCEND whose floor is still being built
+        awaits it first, and a command that may query or record the Hall of Fame
+        runs on its worker thread, so the loop keeps serving other sessions meanwhile.
+        """
+        future = self._blocking_future(command)
+        if future is not None:
+            await asyncio.wrap_future(future)
+        if self._uses_hof(command):
+            return await asyncio.wrap_future(_hof_pool().submit(self.step, command))
+        return self.step(command)
+
+    def _uses_hof(self, command: str) -> bool:
+        """Whether `command` may touch the Hall of Fame database: HOF itself, or a blow at a boss."""
+        if self.mode == "combat":
+            return self.fight is not None and self.fight.boss
+        registry = _MODE_REGISTRIES.get(self.mode)
+        if registry is None:
+            return False
+        try:
+            cmd, _ = registry.resolve(command.strip())
+        except CommandError:
+            return False
+        return cmd is _HOF_COMMAND
+
+    def _blocking_future(self, command: str) -> Optional[concurrent.futures.Future]:
+        """The background work `command` would wait on inside step(), if any."""
+        if self.mode != "dungeon" or not self._at_open_stairs():
+            return None
+        try:
+            cmd, _ = DUNGEON_REGISTRY.resolve(command.strip())
+        except CommandError:
+            return None
+        return self.floors.pending(self.d) if cmd.handler is GameEngine._cmd_descend else None
+
+    @property
+    def finished(self) -> bool:
+        return self.mode == "quit"
+
+    def close(self):
+        """Flush anything pending (journaled saves) before the session goes away."""
+        self.floors.cancel()
+        if self.journal is not None:
+            self.journal.close()
+
+    def _collect(self, fn, *args) -> List[Event]:
+        events: List[Event] = []
+        token = _EVENT_SINK.set(events)
+        try:
+            fn(*args)
+        finally:
+            _EVENT_SINK.reset(token)
+        return events
+
+    def _set_mode(self, mode: str, prompt: str = "> "):
+        self.mode = mode
+        self.prompt = prompt
+        say(kind="mode", mode=mode)
+
+    def _start(self):
+        if self.mode == "menu":
+            say("Type NEW to start a new adventure, LOAD to continue, or HOF to view the Hall of Fame.")
+        else:
+            self._enter_town()
+
+    def _menu(self, cmd: str):
+        self._dispatch(MENU_REGISTRY, cmd)
+
+    def _dispatch(self, registry: CommandRegistry, cmd: str):
+        """Resolve cmd in registry and run it against this session."""
         if not cmd:
-            continue
-        low = cmd.lower()
-        if low in ("where am i", "look", "look around"):
-            describe_room(room)
-            if room.kind == "treasure":
-                describe_chest(room.content)
-        elif low == "map":
-            print(ascii_map(d))
-        elif low.startswith("move "):
-            dirc = low.split(" ", 1)[1].strip().upper()
-            move_player(d, dirc)
-        elif low in ("status", "character", "character stats", "character sheet"):
-            print_character(c)
-        elif low == "inventory":
-            show_inventory(c)
-        elif low.startswith("drink "):
-            name = cmd[6:].strip().title()
-            drink_potion(c, name)
-        elif low.startswith("cast "):
-            spell = cmd[5:].strip().title()
-            cast_spell_out_of_combat(c, spell)
-        elif low == "examine chest for traps":
-            if room.kind == "treasure":
-                chest_examine(c, room.content)
-            else:
-                print("There is no chest here.")
-        elif low == "disarm chest trap":
-            if room.kind == "treasure":
-                chest_disarm(c, room.content)
-            else:
-                print("There is no chest here.")
-        elif low == "pick chest lock":
-            if room.kind == "treasure":
-                chest_pick_lock(c, room.content)
-            else:
-                print("There is no chest here.")
-        elif low == "pry chest lock":
-            if room.kind == "treasure":
-                chest_pry_lock(c, room.content)
+            return
+        try:
+            command, arg = registry.resolve(cmd)
+        except CommandError as e:
+            say(str(e))
+            return
+        command.handler(self, arg)
+
+    def _cmd_menu_load(self, arg=None):
+        c, d, seed = self._read_save()
+        if c and d:
+            self.c, self.d = c, d
+            self._reseed(seed)
+            self._enter_town()
+        else:
+            say("Starting a new game instead.")
+            self._begin_create()
+
+    def _begin_create(self):
+        say("\n--- Welcome to Dungeon Adventure: Ravensburg ---")
+        self._draft = {"stage": "name"}
+        self._set_mode("create", "CALL ME (character name): ")
+
+    def _create(self, cmd: str):
+        draft = self._draft
+        stage = draft["stage"]
+        if stage == "name":
+            draft["name"] = cmd or "Hero"
+            say("Choose race: " + ", ".join(RACES.keys()))
+            draft["stage"] = "race"
+            self.prompt = "Race: "
+        elif stage == "race":
+            race = cmd.title().strip()
+            if race not in RACES:
+                return
+            draft["race"] = race
+            say("Choose class: " + ", ".join(CLASSES.keys()))
+            draft["stage"] = "class"
+            self.prompt = "Class: "
+        elif stage == "class":
+            char_class = cmd.title().strip()
+            if char_class not in CLASSES:
+                return
+            draft["class"] = char_class
+            attrs = apply_race_bonuses(generate_attributes(self.rng), draft["race"], self.rng)
+            draft["attrs"] = attrs
+            say("\nRolled attributes:")
+            for a in ATTRS:
+                say(f"  {a}: {attrs[a]}")
+            draft["stage"] = "swap"
+            self.prompt = "Do you want to swap two attributes once? (y/n): "
+        elif stage == "swap":
+            if cmd.lower().startswith("y"):
+                draft["stage"] = "swap_from"
+                self.prompt = "Swap FROM (e.g., STR): "
             else:
-                print("There is no chest here.")
-        elif low == "open chest":
-            if room.kind == "treasure":
-                chest_open(c, room.content)
+                self._finish_create()
+        elif stage == "swap_from":
+            draft["swap_from"] = cmd.upper().strip()
+            draft["stage"] = "swap_to"
+            self.prompt = "Swap TO (e.g., DEX): "
+        else:
+            a, b = draft["swap_from"], cmd.upper().strip()
+            attrs = draft["attrs"]
+            if a in ATTRS and b in ATTRS:
+                attrs[a], attrs[b] = attrs[b], attrs[a]
+                say("Swapped.")
             else:
-                print("There is no chest here.")
-        elif low == "save":
-            save_game(c, d)
-        elif low == "load":
-            cc, dd = load_game()
-            if cc and dd:
-                c.__dict__.update(cc.__dict__)
-                d.rows = dd.rows; d.cols = dd.cols; d.grid = dd.grid; d.player_pos = dd.player_pos; d.boss_pos = dd.boss_pos
-                print("(Loaded. You remain where the save placed you.)")
-        elif low in ("return town", "go back", "back to town"):
-            print("You carefully make your way back to Ravensburg.")
+                say("Invalid swap; keeping original values.")
+            self._finish_create()
+
+    def _finish_create(self):
+        draft = self._draft
+        self._draft = {}
+        self.c = create_character(draft["name"], draft["race"], draft["class"], draft["attrs"])
+        if self.journal is not None:
+            self.journal.reset()
+        say("\n--- CHARACTER CREATED ---")
+        print_character(self.c)
+        rows, cols = self.dungeon_size
+        seed = self.rng.getrandbits(32)  # drawn either way, so the dice after this replay the same
+        if self.dungeon_seed is not None:
+            seed = self.dungeon_seed
+        self.d = generate_dungeon(rows, cols, seed=seed, backend=self.grid_backend, path=self.map_path)
+        self._enter_town()
+
+    # ---- town ----
+    def _enter_town(self):
+        say(
+            "\nRavensburg needs your help! Monsters spill from the dungeon. "
+            "Prepare in town, then venture forth to find and slay the Evil Necromancer."
+        )
+        self._set_mode("town")
+        self._town_banner()
+
+    def _town_banner(self):
+        say("\n--- TOWN ---")
+        say(TOWN_COMMANDS)
+
+    def _town(self, cmd: str):
+        self._dispatch(TOWN_REGISTRY, cmd)
+
+    def _cmd_list(self, opts: Dict[str, Any]):
+        if opts.get("max_cost") == "gold":
+            opts = dict(opts, max_cost=self.c.gold)
+        list_shop(self.c, **opts)
+
+    def _cmd_train(self, arg=None):
+        if train(self.c):
+            self.mode = "train"
+            self.prompt = "Train which attribute (STR/DEX/INT/CON/WIS/CHA/PER)? "
+
+    def _cmd_quit(self, arg=None):
+        say("Farewell, hero.")
+        self._set_mode("quit", "")
+        say(kind="quit")
+
+    def _train(self, cmd: str):
+        train_attribute(self.c, cmd.upper().strip())
+        self.mode = "town"
+        self.prompt = "> "
+
+    def _no_persist(self) -> Tuple[None, None, None]:
+        say("Saving and loading are disabled in this session.")
+        return None, None, None
+
+    def _reseed(self, seed: Optional[int]):
+        if seed is not None:
+            self.seed = seed
+            self.rng.seed(seed)
+
+    def _save(self):
+        if not self.persist:
+            self._no_persist()
             return
-        elif low == "help":
-            print("""
-DUNGEON COMMANDS:
-  LOOK / WHERE AM I            – Describe current room
-  MAP                          – Show mini-map (10x10, fog of war)
-  MOVE N/E/S/W                 – Move to adjacent room (if possible)
-  STATUS / INVENTORY           – View character or inventory
-  DRINK <potion name>          – Drink a potion
-  CAST <spell name>            – Cast a non-combat spell (e.g., Heal)
-  EXAMINE CHEST FOR TRAPS      – Inspect the chest (treasure rooms)
-  DISARM CHEST TRAP            – Attempt to disable the trap
-  PICK CHEST LOCK              – Attempt to pick the lock
-  PRY CHEST LOCK               – Force the lock open
-  OPEN CHEST                   – Open (beware armed traps/locks)
-  SAVE / LOAD                  – Save or load game
-  RETURN TOWN                  – Exit to town
-            """)
+        # continue from a fresh recorded seed so a reload replays exactly what follows
+        self._reseed(self.rng.getrandbits(64))
+        if self.journal is not None:
+            self.journal.save(self.c, self.d, self.seed)
+        elif self.save_format == "binary":
+            save_game_binary(self.c, self.d, self.seed)
         else:
-            print("Unrecognized command.")
+            save_game(self.c, self.d, self.seed)
 
-def move_player(d: Dungeon, dirc: str):
-    x, y = d.player_pos
-    if dirc == "N" and x > 0:
-        d.player_pos = (x-1, y)
-    elif dirc == "S" and x < d.rows-1:
-        d.player_pos = (x+1, y)
-    elif dirc == "W" and y > 0:
-        d.player_pos = (x, y-1)
-    elif dirc == "E" and y < d.cols-1:
-        d.player_pos = (x, y+1)
-    else:
-        print("You cannot move that way.")
+    def _read_save(self) -> Tuple[Optional[Character], Optional[Dungeon], Optional[int]]:
+        if not self.persist:
+            return self._no_persist()
+        if self.journal is not None:
+            return self.journal.load()
+        if self.save_format == "binary":
+            return load_game_binary()
+        return load_game()
+
+    def _cmd_load(self, arg=None):
+        if self._load() and self.mode == "dungeon":
+            say("(Loaded. You remain where the save placed you.)")
+
+    def _load(self) -> bool:
+        cc, dd, seed = self._read_save()
+        if cc and dd:
+            self._reseed(seed)
+            self.c.replace_state(cc)
+            self.d.replace_state(dd)
+            return True
+        return False
+
+    # ---- dungeon ----
+    def _enter_dungeon(self):
+        say("\nYou travel to the dungeon entrance… darkness beckons.")
+        say(DUNGEON_COMMANDS)
+        self._set_mode("dungeon")
+        self.floors.start(self.d)
+        self._dungeon_tick()
+
+    def _dungeon_tick(self, moved: bool = False):
+        """
+        Resolve the room the player stands in, then show the dungeon prompt.
+        `moved`: the player just walked in, so a boss they fled from fights again.
+        """
+        c, d = self.c, self.d
+        if c.hp > 0:
+            x, y = d.player_pos
+            room = d.grid[x][y]
+            fight = None
+            if not room.visited:
+                say(f"\nYou enter a new chamber at {d.player_pos}.")
+                d.visit(x, y)
+                fight = trigger_room(c, d, room, self.rng)
+            elif moved and room.kind == "boss" and not d.cleared:
+                fight = trigger_room(c, d, room, self.rng)
+            if fight is not None:
+                self._begin_fight(fight)
+                return
+        if c.hp <= 0:
+            say("You limp back to town… or rather, are carried. (Game over if HP is 0.)")
+            say(kind="death")
+            self._set_mode("menu")
+            return
+        say(f"\nYou are at {d.player_pos}" + (f" on floor {d.depth}." if d.depth > 1 else "."))
+
+    def _dungeon(self, cmd: str):
+        d = self.d
+        pos = d.player_pos
+        self._dispatch(DUNGEON_REGISTRY, cmd)
+        if self.mode == "dungeon":
+            self._dungeon_tick(moved=self.d is not d or self.d.player_pos != pos)
+
+    def _cmd_look(self, arg=None):
+        x, y = self.d.player_pos
+        room = self.d.grid[x][y]
+        describe_room(room)
+        if room.kind == "treasure":
+            describe_chest(room.content)
+        if room.kind == "boss" and self.d.cleared:
+            say(f"Stairs lead down to floor {self.d.depth + 1}.")
+
+    def _at_open_stairs(self) -> bool:
+        d = self.d
+        return d.cleared and d.grid[d.player_pos[0]][d.player_pos[1]].kind == "boss"
+
+    def _cmd_descend(self, arg=None):
+        d = self.d
+        if d.grid[d.player_pos[0]][d.player_pos[1]].kind != "boss":
+            say("There are no stairs here.")
+            return
+        if not d.cleared:
+            say("The Necromancer still bars the stairs.")
+            return
+        self.d, snapshot = self.floors.take(d)
+        if isinstance(d.grid, MmapGrid):
+            d.grid.close()
+        if self.journal is not None:
+            self.journal.rebase(snapshot)  # next save: the pre-serialized floor plus what changed since
+        say(f"\nYou descend the stairs to floor {self.d.depth}. The air grows colder.")
+        self.floors.start(self.d)
+
+    def _cmd_map(self, arg: str):
+        if arg == "overview":
+            say(overview_map(self.d, self.map_size))
+            return
+        if arg:
+            self.map_size = parse_dims(arg)
+        say(ascii_map(self.d, self.map_size))
+
+    def _cmd_chest(self, action: Callable[..., Any]):
+        x, y = self.d.player_pos
+        room = self.d.grid[x][y]
+        if room.kind == "treasure":
+            action(self.c, room.content, self.rng)
+            self.d.mark_changed(x, y)
+        else:
+            say("There is no chest here.")
+
+    def _cmd_goto(self, goal):
+        d = self.d
+        if goal == "nearest":
+            path = nearest_unexplored(d)
+            if path is None:
+                say("Every room you can reach is explored.")
+                return
+        elif goal == "boss":
+            bx, by = d.boss_pos
+            if not d.grid[bx][by].visited:
+                say("You haven't found the Necromancer's lair yet.")
+                return
+            path = route_back(d, d.boss_pos)
+        elif goal == "entrance":
+            path = route_back(d, (0, 0))
+        else:
+            if not (0 <= goal[0] < d.rows and 0 <= goal[1] < d.cols):
+                say("There is no such room.")
+                return
+            path = route_to(d, goal)
+        travel(d, path)
+
+    def _cmd_return_town(self, arg=None):
+        say("You carefully make your way back to Ravensburg.")
+        self._set_mode("town")
+        self._town_banner()
+
+    # ---- combat ----
+    def _begin_fight(self, fight: Fight):
+        self.fight = fight
+        self._set_mode("combat")
+        say(kind="fight", monster=fight.monster.name, boss=fight.boss)
+        say(COMBAT_COMMANDS)
+        self._combat_turn()
+
+    def _combat(self, cmd: str):
+        if cmd and combat_action(self.c, self.fight, cmd, self.rng) == "fled":
+            self._end_fight("fled")
+            return
+        self._combat_turn()
+
+    def _combat_turn(self):
+        if not advance_fight(self.c, self.fight, self.rng):
+            won = finish_fight(self.c, self.fight, self.rng)
+            self._end_fight("won" if won else "died")
+
+    def _end_fight(self, result: str):
+        fight = self.fight
+        self.fight = None
+        say(kind="fight_end", monster=fight.monster.name, result=result)
+        if result == "won" and fight.boss:
+            boss_defeated(self.c, self.d)
+        self._set_mode("dungeon")
+        self._dungeon_tick()
+
+def _arg_map(arg: str) -> str:
+    if not arg or "overview".startswith(arg.lower()):
+        return "overview" if arg else ""
+    try:
+        parse_dims(arg)
+    except ValueError:
+        raise ValueError from None  # bare: the registry shows the usage line
+    return arg
+
+def _arg_goto(arg: str):
+    words = arg.lower().split()
+    if words and "boss".startswith(words[0]):
+        return "boss"
+    if words and ("nearest".startswith(words[0]) or "unexplored".startswith(words[0])):
+        return "nearest"
+    x, _, y = arg.replace(" ", ",").partition(",")
+    try:
+        return int(x), int(y.strip(","))
+    except ValueError:
+        raise ValueError from None  # bare: the registry shows the usage line
+
+# commands shared by the town and the dungeon
+_COMMON_COMMANDS = [
+    Command("status", lambda e, arg: print_character(e.c), aliases=("character", "character stats", "character sheet")),
+    Command("inventory", lambda e, arg: show_inventory(e.c)),
+    Command("save", lambda e, arg: e._save()),
+    Command("load", GameEngine._cmd_load),
+    Command("profile", lambda e, arg: show_profile()),
+]
 
-def ascii_map(d: Dungeon) -> str:
-    """Render a 10x10 mini-map with fog of war."""
-    rows, cols = d.rows, d.cols
-    lines = []
-    border = "+" + "-" * (cols) + "+"
-    lines.append(border)
-    for i in range(rows):
-        row_chars = []
-        for j in range(cols):
-            ch = " "
-            room = d.grid[i][j]
-            if (i, j) == d.player_pos:
-                ch = "@"
-            elif room.visited:
-                # reveal boss if discovered (visited)
-                if room.kind == "boss":
-                    ch = "B"
-                else:
-                    ch = "·"
-            row_chars.append(ch)
-        lines.append("|" + "".join(row_chars) + "|")
-    lines.append(border)
-    legend = "\nLegend: @=You  ·=Explored  space=Unexplored  B=Boss (discovered)"
-    return "\n".join(lines) + legend
+_HOF_COMMAND = Command("hof", lambda e, opts: show_hof(**opts), parse_hof_args,
+                       "HOF [page] [TOP n] [CLASS c] [RACE r]")
 
-def describe_room(room: Room):
-    if room.kind == "empty":
-        print("A dusty, silent chamber. Nothing stirs.")
-    elif room.kind == "monster":
-        print("You sense lurking danger — a monster had been here.")
-    elif room.kind == "trap":
-        print("You notice suspicious grooves and wires… a trap lies here.")
-    elif room.kind == "treasure":
-        print("A battered chest glints in the shadows.")
-    elif room.kind == "fountain":
-        print("An ancient fountain bubbles softly.")
-    elif room.kind == "boss":
-        print("A foreboding chamber reeks of dark magic…")
+MENU_REGISTRY = CommandRegistry([
+    Command("new", lambda e, arg: e._begin_create()),
+    Command("load", GameEngine._cmd_menu_load),
+    _HOF_COMMAND,
+    Command("profile", lambda e, arg: show_profile()),
+], unknown="Type NEW, LOAD, or HOF.")
 
-def trigger_room(c: Character, d: Dungeon, room: Room):
-    if room.kind == "monster":
-        start_fight(c, make_monster(room.content["monster"]))
-    elif room.kind == "trap":
-        resolve_trap(c, room.content)
-    elif room.kind == "treasure":
-        # first-time sighting reveals chest existence (but not trap/lock details)
-        describe_chest(room.content, brief=True)
-    elif room.kind == "fountain":
-        resolve_fountain(c, room.content)
-    elif room.kind == "boss":
-        print("The Evil Necromancer stands before you!")
-        win = start_fight(c, make_monster(NECROMANCER))
-        if win:
-            print("\nWith a final cry, the Necromancer falls. Ravensburg is saved!")
-            add_to_hof(c.name)
-            print("You return to town a hero.")
-            d.player_pos = (0,0)
-
-def make_monster(template: Dict[str, Any]) -> Monster:
-    return Monster(
-        name=template["name"],
-        hp=roll(template["hp"]),
-        ac=template["ac"],
-        atk_bonus=template["atk_bonus"],
-        dmg=template["dmg"],
-        xp=template["xp"],
-        gold=roll(template["gold"]),
-    )
+TOWN_REGISTRY = CommandRegistry(_COMMON_COMMANDS + [
+    Command("help", lambda e, arg: print_town_help()),
+    Command("list", GameEngine._cmd_list, parse_list_args, "LIST [WEAPONS|ARMORS|POTIONS|SPELLS] [<gold>|AFFORDABLE] [<attr>]"),
+    Command("purchase", lambda e, item: purchase(e.c, item), arg_text, "PURCHASE <item>", aliases=("buy",)),
+    Command("sell", lambda e, item: sell(e.c, item), arg_text, "SELL <item>"),
+    Command("rest", lambda e, arg: rest(e.c)),
+    Command("train", GameEngine._cmd_train),
+    Command("equip", lambda e, item: equip_weapon(e.c, item), arg_text, "EQUIP <weapon>"),
+    Command("wear", lambda e, item: wear_armor(e.c, item), arg_text, "WEAR <armor>"),
+    Command("enter dungeon", lambda e, arg: e._enter_dungeon()),
+    Command("odds", lambda e, arg: show_fight_odds(e.c, depth=e.d.depth)),
+    _HOF_COMMAND,
+    Command("quit", GameEngine._cmd_quit),
+])
 
-def resolve_trap(c: Character, content: Dict[str, Any]):
-    dc = content["dc"]
-    dmg = content["dmg"]
-    print("A trap springs! Make a DEX save (d20 + DEX).")
-    save = d20() + c.mod("DEX")
-    print(f"Save: {save} vs DC {dc}")
-    if save >= dc:
-        print("You dodge the trap just in time.")
-    else:
-        harm = roll(dmg)
-        c.hp = max(0, c.hp - harm)
-        print(f"Trap hits for {harm} damage! HP {c.hp}/{c.max_hp}")
+DUNGEON_REGISTRY = CommandRegistry(_COMMON_COMMANDS + [
+    Command("help", lambda e, arg: print_dungeon_help()),
+    Command("look", GameEngine._cmd_look, aliases=("where am i", "look around")),
+    Command("map", GameEngine._cmd_map, _arg_map, "MAP [OVERVIEW | <rows>x<cols>]"),
+    Command("move", lambda e, dirc: move_player(e.d, dirc[0].upper()), arg_choice("north", "east", "south", "west"),
+            "MOVE <N/E/S/W>"),
+    Command("drink", lambda e, name: drink_potion(e.c, name.title()), arg_text, "DRINK <potion>"),
+    Command("cast", lambda e, spell: cast_spell_out_of_combat(e.c, spell.title(), e.rng), arg_text, "CAST <spell>"),
+    Command("goto", GameEngine._cmd_goto, _arg_goto, "GOTO <row,col> | NEAREST UNEXPLORED | BOSS"),
+    Command("return entrance", lambda e, arg: e._cmd_goto("entrance")),
+    Command("descend", GameEngine._cmd_descend, aliases=("take stairs",)),
+    Command("odds", lambda e, arg: show_fight_odds(e.c, depth=e.d.depth)),
+    Command("return town", GameEngine._cmd_return_town, aliases=("go back", "back to town")),
+] + [Command(phrase, functools.partial(lambda e, arg, action: e._cmd_chest(action), action=action))
+     for phrase, action in CHEST_ACTIONS.items()], unknown="Unrecognized command.")
 
-def resolve_fountain(c: Character, content: Dict[str, Any]):
-    kind = content["type"]
-    if kind == "heal":
-        gain = min(c.max_hp - c.hp, roll("1d8+4"))
-        c.hp += gain
-        print(f"The water heals you for {gain} HP. ({c.hp}/{c.max_hp})")
-    elif kind == "buff":
-        c.effects.ac_buff = 1
-        c.effects.ac_turns = 10
-        print("You feel protected. (+1 AC for a while)")
-    else:
-        harm = roll("1d6")
-        c.hp = max(0, c.hp - harm)
-        print(f"The water was foul! You take {harm} damage. ({c.hp}/{c.max_hp})")
+_MODE_REGISTRIES = {"menu": MENU_REGISTRY, "town": TOWN_REGISTRY, "dungeon": DUNGEON_REGISTRY,
+                    "combat": COMBAT_REGISTRY}
 
 # --------------------------
-# Chest system
+# Multiplayer server
 # --------------------------
-def describe_chest(chest: Dict[str, Any], brief: bool=False):
-    if chest["opened"]:
-        print("The chest here stands open and empty.")
-        return
-    locked = chest["locked"]
-    trap = chest["trap"]
-    if brief:
-        print("You spot a sturdy wooden chest here.")
-        return
-    # Detailed describe; trap details only if known
-    lock_txt = "locked" if locked else "unlocked"
-    trap_txt = "unknown" if not trap["known"] else ("disarmed" if trap["disarmed"] else "armed")
-    print(f"Chest: {lock_txt}. Trap status: {trap_txt}.")
+SERVER_MAX_SESSIONS = 64
+SERVER_IDLE_TIMEOUT = 600.0   # seconds without a command before a session is dropped
+SERVER_WRITE_TIMEOUT = 15.0   # seconds a client may leave output unread before it is dropped
+SERVER_MAX_LINE = 1024
 
-def chest_examine(c: Character, chest: Dict[str, Any]):
-    if chest["opened"]:
-        print("The chest is already open.")
-        return
-    check = d20() + c.mod("PER")
-    dc = 10  # basic perception DC to notice mechanisms
-    print(f"You carefully examine the chest… Perception {check} vs DC {dc}")
-    if check >= dc:
-        chest["trap"]["known"] = True
-        status = "armed" if (chest["trap"]["armed"] and not chest["trap"]["disarmed"]) else ("disarmed" if chest["trap"]["disarmed"] else "not present")
-        print(f"You notice: trap status is {status}. The lock appears {'jammed' if chest['lock_jammed'] else ('present' if chest['locked'] else 'absent')}.")
-    else:
-        print("You don't notice anything unusual.")
+class GameServer:
+    """
+    Telnet-style line server: each TCP connection gets its own GameEngine.
+    A session reads its next command only after its output has drained, so a slow
+    reader throttles itself and, past the write timeout, is disconnected; the
+    event loop never waits on any one client.
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 4000,
+                 max_sessions: int = SERVER_MAX_SESSIONS,
+                 idle_timeout: float = SERVER_IDLE_TIMEOUT,
+                 write_timeout: float = SERVER_WRITE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.write_timeout = write_timeout
+        self.sessions: Dict[int, GameEngine] = {}
+        self._ids = itertools.count(1)
+        self._server: Optional[asyncio.AbstractServer] = None
 
-def chest_disarm(c: Character, chest: Dict[str, Any]):
-    trap = chest["trap"]
-    if chest["opened"]:
-        print("The chest is already open.")
-        return
-    if not trap["armed"] or trap["disarmed"]:
-        print("There is no active trap to disarm.")
-        return
-    dc = trap["dc"]
-    roll_total = d20() + c.mod("DEX")
-    print(f"You attempt to disarm the trap… DEX check {roll_total} vs DC {dc}")
-    if roll_total >= dc:
-        trap["disarmed"] = True
-        print("You deftly disable the trap.")
-    elif roll_total <= dc - 5:
-        print("Your tools slip—trap triggers!")
-        _chest_trap_trigger(c, chest)
-    else:
-        print("You fail to disarm the trap, but at least you didn't set it off.")
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=SERVER_MAX_LINE)
+        sock = self._server.sockets[0].getsockname()
+        self.port = sock[1]
+        say(f"[SERVER] Listening on {sock[0]}:{sock[1]} (max {self.max_sessions} sessions)")
 
-def chest_pick_lock(c: Character, chest: Dict[str, Any]):
-    if chest["opened"]:
-        print("The chest is already open.")
-        return
-    if not chest["locked"]:
-        print("The chest is already unlocked.")
-        return
-    if chest["lock_jammed"]:
-        print("The lock is jammed—you'll have to pry it.")
-        return
-    dc = chest["lock_dc"]
-    roll_total = d20() + c.mod("DEX")
-    print(f"You try to pick the lock… DEX check {roll_total} vs DC {dc}")
-    if roll_total >= dc:
-        chest["locked"] = False
-        print("You hear a soft click—the chest is unlocked.")
-    elif roll_total <= dc - 5:
-        chest["lock_jammed"] = True
-        print("Snap! Your pick jams the lock. You'll need to pry it.")
-    else:
-        print("The lock resists your efforts.")
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
 
-def chest_pry_lock(c: Character, chest: Dict[str, Any]):
-    if chest["opened"]:
-        print("The chest is already open.")
-        return
-    if not chest["locked"] and not chest["lock_jammed"]:
-        print("No need to pry—it's already unlocked.")
-        return
-    dc = chest["lock_dc"] + 2
-    roll_total = d20() + c.mod("STR")
-    print(f"You wedge your blade and pry… STR check {roll_total} vs DC {dc}")
-    if roll_total >= dc:
-        chest["locked"] = False
-        chest["lock_jammed"] = False
-        print("With a crack, the lock gives way.")
-    else:
-        pain = roll("1d4")
-        c.hp = max(0, c.hp - pain)
-        print(f"The chest shifts and bites back; you take {pain} damage. HP {c.hp}/{c.max_hp}")
-        # 25% chance a still-armed trap springs when prying fails
-        trap = chest["trap"]
-        if trap["armed"] and not trap["disarmed"] and random.random() < 0.25:
-            print("As you pry, a mechanism snaps—trap triggers!")
-            _chest_trap_trigger(c, chest)
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
 
-def chest_open(c: Character, chest: Dict[str, Any]):
-    if chest["opened"]:
-        print("The chest is already open.")
-        return
-    # Trap check
-    trap = chest["trap"]
-    if trap["armed"] and not trap["disarmed"]:
-        print("You lift the lid—something clicks!")
-        _chest_trap_trigger(c, chest)
-        if c.hp <= 0:
+    async def _send(self, writer: asyncio.StreamWriter, events: List[Event], prompt: str = ""):
+        lines = [ev.text for ev in events if ev.kind == "text"]
+        text = "".join(line + "\n" for line in lines).replace("\n", "\r\n") + prompt
+        writer.write(text.encode("utf-8"))
+        await asyncio.wait_for(writer.drain(), self.write_timeout)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if len(self.sessions) >= self.max_sessions:
+            try:
+                writer.write(b"Ravensburg is full. Try again later.\r\n")
+                await asyncio.wait_for(writer.drain(), self.write_timeout)
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+            writer.close()
             return
-    # Lock check
-    if chest["locked"]:
-        print("The lock holds fast. You'll need to pick or pry it first.")
-        return
-    # Award loot
-    gold = chest["loot"]["gold"]
-    pot = chest["loot"]["potion"]
-    c.gold += gold
-    txt = f"You claim {gold} gold"
-    if pot:
-        c.add_potion(pot, 1)
-        txt += f" and a {pot}"
-    txt += "."
-    print(txt)
-    chest["opened"] = True
+        sid = next(self._ids)
+        engine = GameEngine(persist=False)
+        self.sessions[sid] = engine
+        try:
+            await self._send(writer, engine.start(), engine.prompt)
+            while not engine.finished:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    await self._send(writer, [Event("text", "\nIdle too long. Farewell, hero.")])
+                    break
+                if not line:
+                    break
+                events = await engine.step_async(line.decode("utf-8", "replace"))
+                await self._send(writer, events, "" if engine.finished else engine.prompt)
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            # slow reader, dropped connection, or an over-long line
+            pass
+        finally:
+            del self.sessions[sid]
+            engine.close()  # drop its floor prefetch from the shared pool
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
 
-def _chest_trap_trigger(c: Character, chest: Dict[str, Any]):
-    trap = chest["trap"]
-    dmg_roll = random.choice(["1d8", "1d10", "2d4"])
-    dmg = roll(dmg_roll)
-    c.hp = max(0, c.hp - dmg)
-    print(f"The trap strikes for {dmg} damage! ({dmg_roll}) HP {c.hp}/{c.max_hp}")
-    trap["armed"] = False
-    trap["disarmed"] = True  # once sprung, it's effectively neutralized
+def serve(host: str = "127.0.0.1", port: int = 4000, **options):
+    try:
+        asyncio.run(GameServer(host, port, **options).serve_forever())
+    except KeyboardInterrupt:
+        say("[SERVER] Shutting down.")
 
 # --------------------------
-# Combat
+# Benchmarks
 # --------------------------
-def start_fight(c: Character, m: Monster) -> bool:
-    print(f"\nA {m.name} appears! HP {m.hp}, AC {m.ac}")
-    turn = "player"
-    c.effects.ac_turns = max(0, c.effects.ac_turns)
-    while c.hp > 0 and m.hp > 0:
-        if c.effects.ac_turns > 0 and turn == "player":
-            c.effects.ac_turns -= 1
-            if c.effects.ac_turns == 0:
-                c.effects.ac_buff = 0
+BENCH_SEED = 1234
+BENCH_THRESHOLD = 10.0  # percent slower than the baseline that fails --bench-compare
+BENCH_FORMAT = 1
 
-        if turn == "player":
-            print(f"\nYour HP {c.hp}/{c.max_hp}  |  {m.name} HP {m.hp}")
-            print("Actions: ATTACK HIGH/MIDDLE/LOW, DEFEND HIGH/MIDDLE/LOW, CAST <spell>, DRINK <potion>, RUN, MONSTER INFO")
-            cmd = input("> ").strip()
-            if not cmd:
-                continue
-            low = cmd.lower()
-            if low.startswith("attack"):
-                aim = "middle"
-                if "high" in low: aim = "high"
-                elif "low" in low: aim = "low"
-                player_attack(c, m, aim)
-                turn = "monster" if m.hp > 0 else "player"
-            elif low.startswith("defend"):
-                c.effects.ac_buff += 2
-                c.effects.ac_turns = max(c.effects.ac_turns, 1)
-                print("You brace for impact (+2 AC for the next blow).")
-                turn = "monster"
-            elif low.startswith("cast "):
-                spell = cmd[5:].strip().title()
-                cast_result = cast_spell_in_combat(c, m, spell)
-                if cast_result:
-                    turn = "monster" if m.hp > 0 else "player"
-            elif low.startswith("drink "):
-                name = cmd[6:].strip().title()
-                if drink_potion(c, name):
-                    turn = "monster" if m.hp > 0 else "player"
-            elif low in ("monster info", "monster stats"):
-                print(f"{m.name} — AC {m.ac}, Attack +{m.atk_bonus}, Damage {m.dmg}")
-            elif low in ("run", "evade"):
-                flee_dc = 10
-                chk = d20() + c.mod("DEX")
-                if chk >= flee_dc:
-                    print("You slip away into the shadows!")
-                    return False
-                else:
-                    print("You fail to escape!")
-                    turn = "monster"
-            else:
-                print("Unrecognized combat action.")
-        else:
-            monster_attack(c, m)
-            turn = "player"
+def _bench_roll(dice: str):
+    def setup(seed: int):
+        rng = random.Random(seed)
+        return lambda: [roll(dice, rng) for _ in range(10000)], 10000
+    return setup
 
-    if c.hp <= 0:
-        print("\nYou fall… Your adventure ends here.")
-        return False
-    else:
-        print(f"\nYou defeated the {m.name}!")
-        c.gold += m.gold
-        c.xp += m.xp
-        print(f"Gained {m.xp} XP and {m.gold} gold.")
-        c.level_up_if_ready()
-        return True
+def _bench_generate(rows: int, cols: int, backend: str = "list", calls: int = 1):
+    def setup(seed: int):
+        return lambda: [generate_dungeon(rows, cols, seed=seed, backend=backend) for _ in range(calls)], calls
+    return setup
 
-def player_attack(c: Character, m: Monster, aim: str):
-    aim_mod = {"low": +2, "middle": 0, "high": -2}[aim]
-    dmg_bonus = {"low": -1, "middle": 0, "high": +1}[aim]
-    atk_total = d20() + c.attack_bonus() + aim_mod
-    print(f"You strike ({aim})! Attack roll = {atk_total} vs AC {m.ac}")
-    if atk_total >= m.ac:
-        dmg = max(1, c.damage_roll() + dmg_bonus)
-        m.hp = max(0, m.hp - dmg)
-        print(f"Hit for {dmg} damage. {m.name} HP now {m.hp}.")
-    else:
-        print("You miss!")
+def _bench_save(binary: bool):
+    def setup(seed: int):
+        c = create_character("Bench", "Human", "Warrior", {a: 12 for a in ATTRS})
+        d = generate_dungeon(100, 100, seed=seed)
+        if binary:
+            return lambda: (save_game_binary(c, d, seed), load_game_binary()), 1
+        return lambda: (save_game(c, d, seed), load_game()), 1
+    return setup
 
-def monster_attack(c: Character, m: Monster):
-    atk = d20() + m.atk_bonus
-    ac = c.calc_ac()
-    print(f"{m.name} attacks! Roll {atk} vs AC {ac}")
-    if atk >= ac:
-        dmg = roll(m.dmg)
-        c.hp = max(0, c.hp - dmg)
-        print(f"{m.name} hits you for {dmg}! HP {c.hp}/{c.max_hp}")
-    else:
-        print(f"{m.name} misses.")
+def _bench_map(overview: bool):
+    def setup(seed: int):
+        d = generate_dungeon(100, 100, seed=seed)
+        for x in range(d.rows):
+            for y in range(d.cols):
+                d.visit(x, y)
+        d.player_pos = (d.rows // 2, d.cols // 2)
+        render = overview_map if overview else ascii_map
 
-def cast_spell_in_combat(c: Character, m: Monster, spell: str) -> bool:
-    if spell not in c.spells or spell not in SPELLS:
-        print("You don't know that spell.")
-        return False
-    s = SPELLS[spell]
-    if s["type"] == "attack":
-        atk = d20() + 2 + c.mod(s["attr"])
-        print(f"You cast {spell}! Spell attack {atk} vs AC {m.ac}")
-        if atk >= m.ac:
-            dmg = max(1, roll(s["damage"]) + c.mod(s["attr"]))
-            m.hp = max(0, m.hp - dmg)
-            print(f"{spell} hits for {dmg}! {m.name} HP {m.hp}")
-        else:
-            print(f"{spell} misses.")
-        return True
-    elif s["type"] == "attack_auto":
-        dmg = max(1, roll(s["damage"]) + max(0, c.mod(s["attr"])))
-        m.hp = max(0, m.hp - dmg)
-        print(f"{spell} automatically strikes for {dmg}! {m.name} HP {m.hp}")
-        return True
-    elif s["type"] == "heal":
-        amt = max(1, roll(s["amount"]) + c.mod(s["attr"]))
-        c.hp = min(c.max_hp, c.hp + amt)
-        print(f"You cast {spell} and heal {amt}. HP {c.hp}/{c.max_hp}")
-        return True
-    elif s["type"] == "buff_ac":
-        c.effects.ac_buff += s["bonus"]
-        c.effects.ac_turns = max(c.effects.ac_turns, s["turns"])
-        print(f"{spell} grants +{s['bonus']} AC for {s['turns']} turns.")
-        return True
-    else:
-        print("Spell fizzles.")
-        return False
+        def run():
+            for _ in range(20):
+                d.view_cache = None  # drop the render cache so every call really renders
+                render(d)
+        return run, 20
+    return setup
 
-def cast_spell_out_of_combat(c: Character, spell: str):
-    if spell not in c.spells or spell not in SPELLS:
-        print("You don't know that spell.")
+def _bench_character(seed: int):
+    c = create_character("Bench", "Human", "Wizard", {a: 12 for a in ATTRS})
+    c.potions = {"Healing Potion": 2, "Greater Healing": 1}
+    c.spells = list(SPELLS)
+    return lambda: [Character.from_dict(c.to_dict()) for _ in range(1000)], 1000
+
+def _bench_fights(seed: int):
+    c = create_character("Bench", "Human", "Warrior", {a: 12 for a in ATTRS})
+    template = next(t for t in MONSTER_TEMPLATES if t["name"] == "Bandit")
+
+    def run():
+        rng = random.Random(seed)
+        ai = CombatAI(time_budget=float("inf"))  # node budget only, so every run plays the same moves
+        for _ in range(100):
+            simulate_fight(Character.from_dict(c.to_dict()), make_monster(template, rng), ai, rng)
+    return run, 100
+
+BENCHMARKS: List[Tuple[str, Callable[[int], Tuple[Callable[[], Any], int]], int]] = [
+    # (name, setup(seed) -> (timed function, operations per call), timed repeats)
+    ("roll_2d6+3", _bench_roll("2d6+3"), 5),
+    ("roll_4d6kh3", _bench_roll("4d6kh3"), 5),
+    ("generate_10x10", _bench_generate(10, 10, calls=50), 5),
+    ("generate_100x100", _bench_generate(100, 100), 5),
+    ("generate_1000x1000", _bench_generate(1000, 1000, "compact"), 1),
+    ("save_load_json_100x100", _bench_save(False), 5),
+    ("save_load_binary_100x100", _bench_save(True), 5),
+    ("ascii_map", _bench_map(False), 5),
+    ("overview_map", _bench_map(True), 5),
+    ("character_roundtrip", _bench_character, 5),
+    ("simulated_fight", _bench_fights, 5),
+]
+
+def run_benchmarks(seed: int = BENCH_SEED, names: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+    """
+    Time each benchmark (best of its repeats) from a fixed seed, inside a
+    scratch directory so saves and mmap files never touch the real ones.
+    Returns {"results": {name: {"seconds": per operation, ...}}, ...} for JSON.
+    """
+    wanted = set(names) if names else None
+    results: Dict[str, Any] = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for name, setup, repeat in BENCHMARKS:
+                if wanted is not None and name not in wanted:
+                    continue
+                token = _EVENT_SINK.set([])  # no narration from saves and fights
+                try:
+                    fn, ops = setup(seed)
+                    best = math.inf
+                    for _ in range(repeat):
+                        gc.collect()
+                        gc.disable()  # as timeit does: collector pauses are noise here
+                        try:
+                            t0 = time.perf_counter()
+                            fn()
+                            best = min(best, time.perf_counter() - t0)
+                        finally:
+                            gc.enable()
+                finally:
+                    _EVENT_SINK.reset(token)
+                results[name] = {"seconds": best / ops, "ops_per_sec": round(ops / best, 1), "repeat": repeat}
+        finally:
+            os.chdir(cwd)
+    return {"format": BENCH_FORMAT, "seed": seed, "python": sys.version.split()[0],
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+
+def compare_benchmarks(baseline: Dict[str, Any], current: Dict[str, Any],
+                       threshold: float = BENCH_THRESHOLD) -> Tuple[List[str], List[str]]:
+    """
+    Report lines for every benchmark in both runs, and the names that got more
+    than `threshold` percent slower per operation than the baseline.
+    """
+    lines, regressed = [], []
+    base, cur = baseline.get("results", {}), current.get("results", {})
+    for name in cur:
+        if name not in base:
+            lines.append(f"{name:<26} {'new':>12}   {cur[name]['seconds'] * 1e3:12.4f} ms")
+            continue
+        before, after = base[name]["seconds"], cur[name]["seconds"]
+        change = (after - before) / before * 100 if before else 0.0
+        flag = ""
+        if change > threshold:
+            regressed.append(name)
+            flag = "  REGRESSION"
+        lines.append(f"{name:<26} {before * 1e3:12.4f} ms -> {after * 1e3:12.4f} ms  {change:+7.1f}%{flag}")
+    lines += [f"{name:<26} missing from this run" for name in base if name not in cur]
+    return lines, regressed
+
+# --------------------------
+# Profiling
+# --------------------------
+PROFILE_ENV = "RAVENSBURG_PROFILE"  # "1" or "-": report to stderr at exit; anything else: report file path
+PROFILED_FUNCTIONS = ("roll", "start_fight", "trigger_room", "save_game", "load_game", "generate_dungeon")
+PROFILE_BUCKETS = 28  # command latency histogram: bucket k counts commands under 2**k microseconds
+
+class Profiler:
+    """
+    Call counts and cumulative time for PROFILED_FUNCTIONS, and a latency
+    histogram per command. Functions are counted by swapping their module
+    globals for timing wrappers, so nothing is paid until profiling is on.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.functions: Dict[str, List[float]] = {}   # name -> [calls, seconds]
+        self.commands: Dict[str, List[float]] = {}    # "mode:command" -> [count, seconds, max seconds]
+        self.histograms: Dict[str, List[int]] = {}
+        self.originals: Dict[str, Callable[..., Any]] = {}
+
+    def install(self, names: Iterable[str] = PROFILED_FUNCTIONS):
+        module = globals()
+        for name in names:
+            fn = module[name]
+            stat = self.functions.setdefault(name, [0, 0.0])
+
+            @functools.wraps(fn)
+            def timed(*args, _fn=fn, _stat=stat, **kwargs):
+                t0 = time.perf_counter()
+                try:
+                    return _fn(*args, **kwargs)
+                finally:
+                    _stat[0] += 1
+                    _stat[1] += time.perf_counter() - t0
+            self.originals[name] = fn
+            module[name] = timed
+
+    def uninstall(self):
+        globals().update(self.originals)
+        self.originals.clear()
+
+    @staticmethod
+    def command_key(mode: str, cmd: str) -> str:
+        """Histogram key for a command line: its mode and resolved command name."""
+        registry = _MODE_REGISTRIES.get(mode)
+        if registry is None or not cmd.strip():
+            return mode
+        try:
+            return f"{mode}:{registry.resolve(cmd)[0].name}"
+        except CommandError:
+            return f"{mode}:?"
+
+    def record(self, key: str, seconds: float):
+        stat = self.commands.get(key)
+        if stat is None:
+            stat = self.commands[key] = [0, 0.0, 0.0]
+            self.histograms[key] = [0] * PROFILE_BUCKETS
+        stat[0] += 1
+        stat[1] += seconds
+        stat[2] = max(stat[2], seconds)
+        self.histograms[key][min(int(seconds * 1e6).bit_length(), PROFILE_BUCKETS - 1)] += 1
+
+    def _percentile(self, key: str, q: float) -> int:
+        """Upper bound in microseconds of the bucket holding the q-th quantile."""
+        hist = self.histograms[key]
+        need, seen = q * sum(hist), 0
+        for k, n in enumerate(hist):
+            seen += n
+            if seen >= need and n:
+                return 1 << k
+        return 1 << (PROFILE_BUCKETS - 1)
+
+    def report(self) -> str:
+        lines = [f"Profile after {time.perf_counter() - self.started:.1f} s",
+                 f"  {'function':<26}{'calls':>10}{'total ms':>12}{'mean us':>10}"]
+        for name, (calls, secs) in sorted(self.functions.items(), key=lambda kv: -kv[1][1]):
+            mean = secs / calls * 1e6 if calls else 0.0
+            lines.append(f"  {name:<26}{calls:>10}{secs * 1e3:>12.2f}{mean:>10.1f}")
+        if self.commands:
+            total = sum(stat[0] for stat in self.commands.values())
+            secs = sum(stat[1] for stat in self.commands.values())
+            lines.append(f"  {'command dispatch':<26}{total:>10}{secs * 1e3:>12.2f}{secs / total * 1e6:>10.1f}")
+            lines.append(f"  {'command':<26}{'count':>10}{'mean us':>12}{'p50<':>8}{'p90<':>8}{'p99<':>8}{'max us':>10}")
+            for key, (count, secs, worst) in sorted(self.commands.items(), key=lambda kv: -kv[1][1]):
+                lines.append(f"  {key:<26}{count:>10}{secs / count * 1e6:>12.1f}"
+                             + "".join(f"{self._percentile(key, q):>8}" for q in (0.5, 0.9, 0.99))
+                             + f"{worst * 1e6:>10.0f}")
+        return "\n".join(lines)
+
+_PROFILER: Optional[Profiler] = None
+
+def enable_profiling(report_to: Optional[str] = "-") -> Profiler:
+    """
+    Start counting (idempotent). At exit the report goes to stderr when
+    report_to is "-", to that file otherwise, or nowhere when it is None.
+    """
+    global _PROFILER
+    if _PROFILER is None:
+        _PROFILER = Profiler()
+        _PROFILER.install()
+        if report_to is not None:
+            atexit.register(_write_profile, report_to)
+    return _PROFILER
+
+def disable_profiling():
+    global _PROFILER
+    if _PROFILER is not None:
+        _PROFILER.uninstall()
+        _PROFILER = None
+
+def _write_profile(report_to: str):
+    if _PROFILER is None:
         return
-    s = SPELLS[spell]
-    if s["type"] == "heal":
-        amt = max(1, roll(s["amount"]) + c.mod(s["attr"]))
-        c.hp = min(c.max_hp, c.hp + amt)
-        print(f"You cast {spell} and heal {amt}. HP {c.hp}/{c.max_hp}")
-    elif s["type"] == "buff_ac":
-        c.effects.ac_buff += s["bonus"]
-        c.effects.ac_turns = max(c.effects.ac_turns, s["turns"])
-        print(f"{spell} grants +{s['bonus']} AC for {s['turns']} turns.")
+    if report_to == "-":
+        print(_PROFILER.report(), file=sys.stderr)
     else:
-        print("That spell is best used in combat.")
+        with open(report_to, "w", encoding="utf-8") as f:
+            f.write(_PROFILER.report() + "\n")
 
-def drink_potion(c: Character, name: str) -> bool:
-    if name not in c.potions or c.potions[name] <= 0:
-        print("You don't have that potion.")
-        return False
-    c.potions[name] -= 1
-    effect = POTIONS.get(name, {}).get("effect")
-    if effect == "heal_10":
-        heal = 10
-        c.hp = min(c.max_hp, c.hp + heal)
-        print(f"You drink {name} and heal {heal}. HP {c.hp}/{c.max_hp}")
-    elif effect == "heal_25":
-        heal = 25
-        c.hp = min(c.max_hp, c.hp + heal)
-        print(f"You drink {name} and heal {heal}. HP {c.hp}/{c.max_hp}")
+def show_profile():
+    """PROFILE: the counters so far."""
+    if _PROFILER is None:
+        say(f"Profiling is off. Start the game with --profile or {PROFILE_ENV}=1.")
     else:
-        print("It tastes… fine?")
-    return True
+        say(_PROFILER.report())
 
 # --------------------------
 # Main
 # --------------------------
-def main():
-    print("Type NEW to start a new adventure, LOAD to continue, or HOF to view the Hall of Fame.")
-    while True:
-        choice = input("> ").strip().lower()
-        if choice == "new":
-            c = new_character()
-            d = generate_dungeon(rows=10, cols=10)
-            town_menu(c, d)
-        elif choice == "load":
-            c, d = load_game()
-            if c and d:
-                town_menu(c, d)
-            else:
-                print("Starting a new game instead.")
-                c = new_character()
-                d = generate_dungeon(rows=10, cols=10)
-                town_menu(c, d)
-        elif choice == "hof":
-            show_hof()
+def print_events(events: List[Event]):
+    for ev in events:
+        if ev.kind == "text":
+            print(ev.text)
+
+# --------------------------
+# Scripted runs
+# --------------------------
+def run_script(commands: Iterable[str], seed: Optional[int] = None, out: Optional[TextIO] = None,
+               persist: bool = False, **engine_options) -> Dict[str, Any]:
+    """
+    Play a command script (one command per line; blank lines and # comments are
+    skipped) in a fresh GameEngine and return a summary of the final state.
+    Game text goes to `out` in one write per command, or is never formatted at
+    all when out is None. Each call has its own engine and RNG, so any number of
+    scripts can run in one process.
+    """
+    engine = GameEngine(seed=seed, persist=persist, **engine_options)
+    kinds: Dict[str, int] = collections.Counter()
+    fights: Dict[str, int] = collections.Counter()
+
+    def emit(events: List[Event]):
+        for ev in events:
+            kinds[ev.kind] += 1
+            if ev.kind == "fight_end":
+                fights[ev.data["result"]] += 1
+        if out is not None:
+            text = [ev.text for ev in events if ev.kind == "text"]
+            if text:
+                out.write("\n".join(text) + "\n")
+
+    start = time.perf_counter()
+    emit(engine.start())
+    n = 0
+    for line in commands:
+        cmd = line.strip()
+        if not cmd or cmd.startswith("#"):
+            continue
+        if engine.finished:
+            break
+        if out is not None:
+            out.write(f"{engine.prompt}{cmd}\n")
+        emit(engine.step(cmd))
+        n += 1
+    engine.close()
+    elapsed = time.perf_counter() - start
+    c, d = engine.c, engine.d
+    return {
+        "seed": engine.seed,
+        "commands": n,
+        "seconds": round(elapsed, 6),
+        "commands_per_sec": round(n / elapsed) if elapsed else None,
+        "mode": engine.mode,
+        "character": c.to_dict() if c is not None else None,
+        "dungeon": None if d is None else {
+            "rows": d.rows,
+            "cols": d.cols,
+            "player_pos": list(d.player_pos),
+            "explored": d.explored_count(),
+            "generator": d.generator,
+        },
+        "fights": dict(fights),
+        "events": dict(kinds),
+    }
+
+# --------------------------
+# Seed batches
+# --------------------------
+SEED_BATCH_CHUNK = 256  # seeds per worker task; large enough that pickling is noise
+
+@dataclass(frozen=True)
+class SeedCriteria:
+    """
+    What a pre-generated dungeon must satisfy. boss_distance is the boss's
+    distance from the entrance as a fraction of the farthest room's; treasure
+    and monster limits are fractions of all rooms.
+    """
+    min_boss_distance: float = 0.7
+    min_treasure: float = 0.15
+    min_monsters: float = 0.25
+    max_monsters: float = 0.45
+
+def score_dungeon(d: Dungeon) -> Dict[str, Any]:
+    """
+    Numbers a seed is judged on: boss distance from the entrance, room-kind
+    histogram, gold lying in chests, and the gold and XP its monsters (boss
+    included) are expected to drop on this floor.
+    """
+    hist: Dict[str, int] = collections.Counter()
+    monsters: Dict[str, int] = collections.Counter()
+    templates: Dict[str, Dict[str, Any]] = {}
+    chest_gold = 0
+    grid = d.grid
+    if isinstance(grid, CompactGrid):
+        # an MmapGrid's fields are strided memoryviews: no count(), and np.frombuffer refuses them
+        codes = memoryview(grid.kinds).tobytes()
+        for code, kind in enumerate(ROOM_KINDS):
+            hist[kind] = codes.count(code)
+        if np is not None:
+            kinds = np.asarray(grid.kinds)
+            chest_gold = int(np.asarray(grid.gold)[kinds == _KIND_CODE["treasure"]].sum())
+            counts = np.bincount(np.asarray(grid.aux)[kinds == _KIND_CODE["monster"]])
+            by_index = {i: int(n) for i, n in enumerate(counts) if n}
+        else:
+            treasure, monster = _KIND_CODE["treasure"], _KIND_CODE["monster"]
+            chest_gold = sum(g for k, g in zip(grid.kinds, grid.gold) if k == treasure)
+            by_index = collections.Counter(a for k, a in zip(grid.kinds, grid.aux) if k == monster)
+        for i, n in by_index.items():
+            template = MONSTER_TEMPLATES[i]
+            templates[template["name"]] = template
+            monsters[template["name"]] += n
+        rooms = grid.other.values()
+    else:
+        rooms = (room for row in grid for room in row)
+    for room in rooms:
+        hist[room.kind] += 1
+        if room.kind in ("monster", "boss"):
+            template = room.content["monster"]
+            templates[template["name"]] = template
+            monsters[template["name"]] += 1
+        elif room.kind == "treasure":
+            chest_gold += room.content["loot"]["gold"]
+    if isinstance(grid, CompactGrid):
+        for i in grid.bosses:
+            templates[NECROMANCER["name"]] = NECROMANCER
+            monsters[NECROMANCER["name"]] += 1
+    xp = gold = 0.0
+    for name, n in monsters.items():
+        template = floor_template(templates[name], d.depth)
+        xp += n * template["xp"]
+        gold += n * dice_distribution(template["gold"]).mean
+    bx, by = d.boss_pos
+    farthest = (d.rows - 1) + (d.cols - 1)
+    return {
+        "boss_distance": round((bx + by) / farthest, 4) if farthest else 0.0,
+        "rooms": {kind: hist[kind] for kind in ROOM_KINDS if hist[kind]},
+        "chest_gold": chest_gold,
+        "monster_gold": round(gold, 2),
+        "xp": xp,
+    }
+
+def check_seed(score: Dict[str, Any], criteria: SeedCriteria) -> List[str]:
+    """Reasons a scored dungeon fails `criteria` (empty if it passes)."""
+    total = sum(score["rooms"].values())
+    treasure = score["rooms"].get("treasure", 0) / total
+    monsters = score["rooms"].get("monster", 0) / total
+    reasons = []
+    if score["boss_distance"] < criteria.min_boss_distance:
+        reasons.append("boss_close")
+    if treasure < criteria.min_treasure:
+        reasons.append("treasure_scarce")
+    if not criteria.min_monsters <= monsters <= criteria.max_monsters:
+        reasons.append("monster_density")
+    return reasons
+
+def _seed_worker_init(content: Optional[List[str]]):
+    if content:
+        load_content(content, cache_path=None)
+
+def _score_seed_range(start: int, stop: int, rows: int, cols: int, backend: str,
+                      criteria: SeedCriteria) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """Generate and judge seeds start..stop-1: accepted records plus rejection counts."""
+    accepted = []
+    rejected: Dict[str, int] = collections.Counter()
+    for seed in range(start, stop):
+        d = generate_dungeon(rows, cols, seed=seed, backend=backend)
+        score = score_dungeon(d)
+        reasons = check_seed(score, criteria)
+        if reasons:
+            rejected.update(reasons)
+        else:
+            accepted.append({"seed": seed, "generator": d.generator, **score})
+    return accepted, dict(rejected)
+
+def batch_seeds(start: int, count: int, out: TextIO, rows: int = 10, cols: int = 10, backend: str = "list",
+                criteria: SeedCriteria = SeedCriteria(), workers: Optional[int] = None,
+                chunk: int = SEED_BATCH_CHUNK, content: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Generate dungeons for seeds start..start+count-1 across a process pool and
+    write each one meeting `criteria` to `out` as a JSON line, in seed order, as
+    its chunk finishes. Workers only send back accepted seeds and rejection
+    counts, so throughput grows with the number of cores. list, compact and mmap
+    grids lay out a seed identically, so those are scored as compact grids.
+    `content` names the packs each worker loads first. Play an accepted seed
+    with --dungeon-seed and the same --size/--grid on a host whose
+    dungeon_generator() matches the record's "generator".
+    Returns a summary of the run.
+    """
+    if backend not in GRID_BACKENDS:
+        raise ValueError(f"Unknown grid backend: {backend!r}")
+    score_backend = "lazy" if backend == "lazy" else "compact"
+    workers = workers or os.cpu_count() or 1
+    ranges = [(s, min(s + chunk, start + count)) for s in range(start, start + count, chunk)]
+    accepted = 0
+    rejected: Dict[str, int] = collections.Counter()
+    t0 = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_seed_worker_init,
+                                                initargs=(content,)) as pool:
+        futures = [pool.submit(_score_seed_range, a, b, rows, cols, score_backend, criteria) for a, b in ranges]
+        for future in futures:
+            records, reasons = future.result()
+            for record in records:
+                out.write(json.dumps(record, separators=(",", ":")) + "\n")
+            out.flush()
+            accepted += len(records)
+            rejected.update(reasons)
+    elapsed = time.perf_counter() - t0
+    return {
+        "seeds": count,
+        "accepted": accepted,
+        "rejected": dict(rejected),
+        "workers": workers,
+        "generator": dungeon_generator(score_backend),
+        "seconds": round(elapsed, 3),
+        "seeds_per_sec": round(count / elapsed) if elapsed else None,
+    }
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Dungeon Adventure: Ravensburg")
+    parser.add_argument("--serve", metavar="[HOST:]PORT", help="host many players over TCP instead of playing locally")
+    parser.add_argument("--seed", type=int, help="seed the game's dice for a reproducible run")
+    parser.add_argument("--dungeon-seed", type=int, metavar="SEED",
+                        help="lay out new games' first floor from this dungeon seed (e.g. one from --seed-batch)")
+    parser.add_argument("--size", default="10x10", metavar="ROWSxCOLS", help="dungeon size for new games")
+    parser.add_argument("--grid", choices=GRID_BACKENDS, default="list",
+                        help="dungeon storage for large maps: lazy (rooms made on demand), compact (packed arrays) "
+                             "or mmap (packed records in a memory-mapped file)")
+    parser.add_argument("--save-format", choices=SAVE_FORMATS, default="json",
+                        help="journal: append only what changed on each SAVE; binary: compact packed file")
+    parser.add_argument("--map-file", default=MMAP_DUNGEON_FILE, metavar="FILE",
+                        help="with --grid mmap: this game's map file; deeper floors are written beside it")
+    parser.add_argument("--view", default="%dx%d" % MAP_VIEW, metavar="ROWSxCOLS", help="MAP window size")
+    parser.add_argument("--bench-saves", metavar="ROWSxCOLS", help="compare JSON and binary save speed/size, then exit")
+    parser.add_argument("--bench", metavar="FILE", help="run the benchmark suite and write its JSON results ('-' for stdout)")
+    parser.add_argument("--bench-compare", metavar="BASELINE",
+                        help="run the benchmark suite and fail if any benchmark is slower than BASELINE by the threshold")
+    parser.add_argument("--bench-threshold", type=float, default=BENCH_THRESHOLD, metavar="PCT",
+                        help="with --bench-compare: allowed slowdown in percent (default %(default)s)")
+    parser.add_argument("--bench-only", action="append", metavar="NAME", help="run just this benchmark; repeatable")
+    parser.add_argument("--script", action="append", metavar="FILE",
+                        help="play a command file ('-' for stdin) and print a JSON summary; repeatable")
+    parser.add_argument("--quiet", action="store_true", help="with --script: suppress game text, print only the summary")
+    parser.add_argument("--allow-saves", action="store_true", help="with --script: let SAVE/LOAD touch save files")
+    parser.add_argument("--profile", nargs="?", const="-", metavar="FILE",
+                        help=f"count hot functions and time commands; report at exit to FILE or stderr "
+                             f"(also {PROFILE_ENV}=1); PROFILE shows it in game")
+    parser.add_argument("--content", action="append", metavar="PATH",
+                        help="load a content pack (JSON file, or a directory of them); repeatable")
+    parser.add_argument("--seed-batch", metavar="START:COUNT",
+                        help="generate COUNT dungeons (of --size/--grid) from seed START on all cores, "
+                             "write the ones passing the --min/--max limits as JSON lines, then exit")
+    parser.add_argument("--seed-out", default="-", metavar="FILE", help="with --seed-batch: accepted seeds ('-' for stdout)")
+    parser.add_argument("--workers", type=int, metavar="N", help="with --seed-batch: worker processes (default: all cores)")
+    defaults = SeedCriteria()
+    parser.add_argument("--min-boss-distance", type=float, default=defaults.min_boss_distance, metavar="FRAC",
+                        help="boss distance from the entrance, as a fraction of the farthest room's (default %(default)s)")
+    parser.add_argument("--min-treasure", type=float, default=defaults.min_treasure, metavar="FRAC",
+                        help="least fraction of treasure rooms (default %(default)s)")
+    parser.add_argument("--min-monsters", type=float, default=defaults.min_monsters, metavar="FRAC",
+                        help="least fraction of monster rooms (default %(default)s)")
+    parser.add_argument("--max-monsters", type=float, default=defaults.max_monsters, metavar="FRAC",
+                        help="most fraction of monster rooms (default %(default)s)")
+    parser.add_argument("--max-sessions", type=int, default=SERVER_MAX_SESSIONS)
+    parser.add_argument("--idle-timeout", type=float, default=SERVER_IDLE_TIMEOUT)
+    args = parser.parse_args(argv)
+    if args.profile:
+        enable_profiling(args.profile)
+    if args.content:
+        try:
+            load_content(args.content)
+        except (OSError, ContentError) as e:
+            parser.error(str(e))
+    if args.bench_saves:
+        print(json.dumps(bench_save_formats(*parse_dims(args.bench_saves)), indent=2))
+        return
+    if args.seed_batch:
+        first, _, count = args.seed_batch.partition(":")
+        rows, cols = parse_dims(args.size)
+        criteria = SeedCriteria(args.min_boss_distance, args.min_treasure, args.min_monsters, args.max_monsters)
+        options = dict(rows=rows, cols=cols, backend=args.grid, criteria=criteria,
+                       workers=args.workers, content=args.content)
+        if args.seed_out == "-":
+            summary = batch_seeds(int(first), int(count), sys.stdout, **options)
         else:
-            print("Type NEW, LOAD, or HOF.")
+            with open(args.seed_out, "w", encoding="utf-8") as f:
+                summary = batch_seeds(int(first), int(count), f, **options)
+        print(json.dumps(summary), file=sys.stderr)
+        return
+    if args.bench or args.bench_compare:
+        if args.bench_compare:
+            with open(args.bench_compare, "r", encoding="utf-8") as f:
+                baseline = json.load(f)
+            if args.bench_only:
+                baseline["results"] = {k: v for k, v in baseline.get("results", {}).items() if k in args.bench_only}
+        results = run_benchmarks(BENCH_SEED if args.seed is None else args.seed, args.bench_only)
+        if args.bench == "-":
+            print(json.dumps(results, indent=2))
+        elif args.bench:
+            _atomic_write_json(args.bench, results)
+        if args.bench_compare:
+            lines, regressed = compare_benchmarks(baseline, results, args.bench_threshold)
+            print("\n".join(lines))
+            if regressed:
+                print(f"{len(regressed)} benchmark(s) regressed by more than {args.bench_threshold:g}%: "
+                      + ", ".join(regressed))
+                sys.exit(1)
+        return
+    if args.serve:
+        host, _, port = args.serve.rpartition(":")
+        serve(host or "127.0.0.1", int(port), max_sessions=args.max_sessions, idle_timeout=args.idle_timeout)
+        return
+
+    options = dict(dungeon_size=parse_dims(args.size), grid_backend=args.grid,
+                   save_format=args.save_format, map_size=parse_dims(args.view), map_path=args.map_file,
+                   dungeon_seed=args.dungeon_seed)
+    if args.script:
+        out = None if args.quiet else sys.stdout
+        for path in args.script:
+            if path == "-":
+                summary = run_script(sys.stdin, args.seed, out, args.allow_saves, **options)
+            else:
+                with open(path, "r", encoding="utf-8") as f:
+                    summary = run_script(f, args.seed, out, args.allow_saves, **options)
+            summary["script"] = path
+            print(json.dumps(summary, ensure_ascii=False))
+        return
+
+    engine = GameEngine(seed=args.seed, **options)
+    print_events(engine.start())
+    while not engine.finished:
+        try:
+            cmd = input(engine.prompt)
+        except EOFError:
+            break
+        print_events(engine.step(cmd))
+    engine.close()
+
+if os.environ.get(PROFILE_ENV):
+    enable_profiling(os.environ[PROFILE_ENV] if os.environ[PROFILE_ENV] not in ("1", "-") else "-")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import DUNGEON  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Run every test in its own folder, so saves, maps and the Hall of Fame never touch the repo."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(DUNGEON, "_HOF_STORES", {})
+    return tmp_path
@@ -0,0 +1,1275 @@
+import asyncio
+import collections
+import copy
+import itertools
+import json
+import random
+import sys
+
+import pytest
+
+import DUNGEON as D
+
+
+def make_character(name="Tester", race="Human", char_class="Warrior"):
+    return D.create_character(name, race, char_class, {a: 10 for a in D.ATTRS})
+
+
+def new_game(engine):
+    engine.start()
+    for cmd in ("new", "Tester", "human", "warrior", "n"):
+        engine.step(cmd)
+    assert engine.mode == "town"
+    return engine
+
+
+def open_grid(rows, cols):
+    """A Dungeon of empty rooms, entrance at (0, 0), nothing explored."""
+    grid = [[D.Room() for _ in range(cols)] for _ in range(rows)]
+    return D.Dungeon(rows, cols, grid, (0, 0), (rows - 1, cols - 1))
+
+
+def grid_rooms(d):
+    return [[d.grid[x][y].to_dict() for y in range(d.cols)] for x in range(d.rows)]
+
+
+# --------------------------
+# Dice
+# --------------------------
+EXPRESSIONS = ["1d8+2", "2d6-1", "d20", "3", "4d6kh3", "4d6dl1", "3d6kl2", "5d4dh2",
+               "1d8+1d4+2", "2d6-1d4", "2d20kh1+3", "2d20kl1-1"]
+
+
+@pytest.mark.parametrize("expr", EXPRESSIONS)
+def test_dice_bounds_and_rolls(expr):
+    dice = D.compile_dice(expr)
+    rng = random.Random(1)
+    rolls = [dice.roll(rng) for _ in range(2000)]
+    assert dice.min <= min(rolls) and max(rolls) <= dice.max
+    assert sum(rolls) / len(rolls) == pytest.approx(dice.mean, abs=0.5)
+
+
+@pytest.mark.parametrize("n,sides,keep", [(4, 6, 3), (2, 20, 1), (5, 8, 2), (3, 4, 3)])
+def test_keep_mean_matches_brute_force(n, sides, keep):
+    for highest in (True, False):
+        total = 0
+        for faces in itertools.product(range(1, sides + 1), repeat=n):
+            total += sum(sorted(faces, reverse=highest)[:keep])
+        assert D._keep_mean(n, sides, keep, highest) == pytest.approx(total / sides ** n)
+
+
+def test_keep_mean_large_pool():
+    # best of 12d20: E[max] = sum over v of P(max >= v)
+    expected = sum(1 - ((v - 1) / 20) ** 12 for v in range(1, 21))
+    assert D.compile_dice("12d20kh1").mean == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("expr", ["", "abc", "0d6", "4d6kh5", "4d6dl4", "1d0"])
+def test_bad_dice_rejected(expr):
+    with pytest.raises(ValueError):
+        D.compile_dice(expr)
+
+
+def test_compiled_dice_are_shared():
+    assert D.compile_dice("2d6+3") is D.compile_dice("2d6+3")
+    a, b = random.Random(3), random.Random(3)
+    assert [D.roll("1d20+1d4", a) for _ in range(50)] == [D.roll(D.compile_dice("1d20+1d4"), b) for _ in range(50)]
+
+
+# --------------------------
+# Multiplayer server
+# --------------------------
+class StalledWriter:
+    """A StreamWriter whose client never reads, so drain() never finishes."""
+    def __init__(self):
+        self.data = b""
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        await asyncio.sleep(3600)
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+
+def run_server(body, **options):
+    async def main():
+        server = D.GameServer(port=0, **options)
+        await server.start()
+        try:
+            return await asyncio.wait_for(body(server), 10)
+        finally:
+            await server.close()
+    return asyncio.run(main())
+
+
+async def connect(server):
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+    return reader, writer
+
+
+def test_server_plays_a_session():
+    async def body(server):
+        reader, writer = await connect(server)
+        greeting = await reader.readuntil(b"> ")
+        assert b"Type NEW" in greeting
+        assert len(server.sessions) == 1
+        writer.write(b"new\r\n")
+        reply = await reader.readuntil(b": ")
+        writer.close()
+        await reader.read()
+        await asyncio.sleep(0.05)
+        return reply, len(server.sessions)
+
+    reply, left = run_server(body)
+    assert b"\r\n" in reply
+    assert left == 0
+
+
+def test_server_turns_away_sessions_past_the_limit():
+    async def body(server):
+        first = await connect(server)
+        await first[0].readuntil(b"> ")
+        second = await connect(server)
+        refused = await second[0].read()
+        first[1].close()
+        return refused, len(server.sessions)
+
+    refused, sessions = run_server(body, max_sessions=1)
+    assert refused == b"Ravensburg is full. Try again later.\r\n"
+    assert sessions == 1
+
+
+def test_server_drops_idle_sessions():
+    async def body(server):
+        reader, writer = await connect(server)
+        await reader.readuntil(b"> ")
+        rest = await reader.read()  # EOF once the server gives up on us
+        writer.close()
+        await asyncio.sleep(0.05)
+        return rest, len(server.sessions)
+
+    rest, sessions = run_server(body, idle_timeout=0.2)
+    assert b"Idle too long" in rest
+    assert sessions == 0
+
+
+def test_server_drops_slow_readers():
+    async def main():
+        server = D.GameServer(write_timeout=0.1)
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"new\n")
+        writer = StalledWriter()
+        await asyncio.wait_for(server._handle(reader, writer), 5)
+        return server, writer
+
+    server, writer = asyncio.run(main())
+    assert writer.closed
+    assert b"Type NEW" in writer.data
+    assert server.sessions == {}
+
+
+# --------------------------
+# Seeded sessions
+# --------------------------
+SCRIPT = ["new", "Tester", "human", "warrior", "n", "enter dungeon",
+          "east", "south", "east", "south", "map", "return town", "status"]
+
+
+def transcript(seed, **options):
+    e = D.GameEngine(persist=False, seed=seed, **options)
+    events = e.start()
+    for cmd in SCRIPT:
+        events += e.step(cmd)
+    e.close()
+    return [(ev.kind, ev.text, ev.data) for ev in events]
+
+
+def test_same_seed_same_game():
+    assert transcript(77) == transcript(77)
+    assert transcript(77) != transcript(78)
+
+
+def test_same_seed_same_dungeon():
+    a = D.generate_dungeon(12, 9, seed=1234)
+    b = D.generate_dungeon(12, 9, seed=1234)
+    assert grid_rooms(a) == grid_rooms(b) and a.boss_pos == b.boss_pos
+    assert grid_rooms(a) != grid_rooms(D.generate_dungeon(12, 9, seed=4321))
+    unseeded = D.generate_dungeon(8, 8)
+    assert grid_rooms(D.generate_dungeon(8, 8, seed=unseeded.seed)) == grid_rooms(unseeded)
+
+
+# --------------------------
+# Saves
+# --------------------------
+def played_state(backend):
+    c = make_character()
+    c.gold, c.xp, c.turns = 123, 40, 17
+    c.add_potion("Healing", 2)
+    c.effects.ac_buff, c.effects.ac_turns = 2, 3
+    d = D.generate_dungeon(6, 7, seed=11, backend=backend, path="save_test.map")
+    for x, y in [(0, 0), (0, 1), (1, 1), (2, 1), (5, 6)]:
+        d.visit(x, y)
+    d.player_pos = (2, 1)
+    return c, d
+
+
+@pytest.mark.parametrize("backend", D.GRID_BACKENDS)
+def test_json_save_round_trip(backend):
+    c, d = played_state(backend)
+    D.save_game(c, d, seed=99)
+    c2, d2, seed = D.load_game()
+    assert seed == 99
+    assert c2 == c
+    assert d2.to_dict() == d.to_dict()
+    assert grid_rooms(d2) == grid_rooms(d)
+
+
+def test_load_without_save():
+    assert D.load_game() == (None, None, None)
+
+
+@pytest.mark.parametrize("backend", ["list", "compact", "lazy"])
+def test_journal_save_round_trip(backend):
+    c, d = played_state(backend)
+    journal = D.SaveJournal("rpg_save.json", compact_every=3)
+    for step in range(7):
+        c.gold += 5
+        d.visit(3, step % d.cols)
+        journal.save(c, d, seed=5)
+    journal.close()
+    reader = D.SaveJournal("rpg_save.json")
+    c2, d2, seed = reader.load()
+    reader.close()
+    assert seed == 5
+    assert c2 == c
+    assert grid_rooms(d2) == grid_rooms(d)
+    assert d2.player_pos == d.player_pos
+
+
+def test_journal_ignores_a_torn_last_line(workdir):
+    c, d = played_state("list")
+    journal = D.SaveJournal("rpg_save.json")
+    journal.save(c, d, seed=1)
+    c.gold = 500
+    journal.save(c, d, seed=1)
+    journal.close()
+    segment = max(workdir.glob("rpg_save.json.journal.*"))
+    with open(segment, "a", encoding="utf-8") as f:
+        f.write('{"seq": 99, "character": {"gold"')  # crash mid-write
+    reader = D.SaveJournal("rpg_save.json")
+    c2, _, _ = reader.load()
+    reader.close()
+    assert c2.gold == 500
+
+
+@pytest.mark.parametrize("backend", D.GRID_BACKENDS)
+def test_binary_save_round_trip(backend):
+    c, d = played_state(backend)
+    for compress in (True, False):
+        c2, d2, seed = D.decode_save(D.encode_save(c, d, seed=2 ** 40, compress=compress))
+        assert seed == 2 ** 40
+        assert c2 == c
+        assert grid_rooms(d2) == grid_rooms(d)
+        assert (d2.player_pos, d2.boss_pos, d2.seed, d2.generator) == (d.player_pos, d.boss_pos, d.seed, d.generator)
+    D.save_game_binary(c, d, seed=None)
+    c3, d3, seed = D.load_game_binary()
+    assert seed is None and c3 == c and grid_rooms(d3) == grid_rooms(d)
+
+
+def test_binary_save_rejects_damage():
+    c, d = played_state("list")
+    blob = bytearray(D.encode_save(c, d))
+    blob[-1] ^= 0xFF
+    with pytest.raises(ValueError):
+        D.decode_save(bytes(blob))
+    with pytest.raises(ValueError):
+        D.decode_save(b"RVSB")
+
+
+def old_save(version):
+    """A current save taken back to `version`: fields added since are dropped, chests are pre-v3."""
+    c, d = make_character(), open_grid(2, 2)
+    d.grid[1][0] = D.Room(kind="treasure", content={"gold": 15, "potion": "Healing"})
+    data = {"version": version, "character": c.to_dict(), "dungeon": d.to_dict()}
+    added = {4: ("seed",), 5: ("depth", "cleared"), 6: ("generator",)}
+    for since, keys in added.items():
+        if version < since:
+            for key in keys:
+                data["dungeon"].pop(key)
+    return data
+
+
+@pytest.mark.parametrize("version", range(1, D.SAVE_VERSION))
+def test_migrate_old_saves(version):
+    data = D.migrate_save(old_save(version))
+    assert data["version"] == D.SAVE_VERSION
+    dg = data["dungeon"]
+    assert (dg["depth"], dg["cleared"], dg["generator"]) == (1, False, None)
+    assert dg["seed"] is None and data.get("seed") is None
+    c, d, seed = D._state_from_save(old_save(version))
+    assert (d.depth, d.cleared, d.generator, seed) == (1, False, None, None)
+    chest = d.grid[1][0].content
+    if version < 3:
+        assert chest["loot"] == {"gold": 15, "potion": "Healing"}
+        assert chest["locked"] is False and chest["opened"] is False
+
+
+def test_migrate_rejects_newer_save():
+    with pytest.raises(ValueError):
+        D.migrate_save(old_save(D.SAVE_VERSION + 1))
+
+
+@pytest.mark.parametrize("fmt", D.SAVE_FORMATS)
+def test_engine_save_and_load(fmt):
+    e = new_game(D.GameEngine(seed=4, save_format=fmt, dungeon_size=(5, 5)))
+    e.step("save")
+    gold = e.c.gold
+    e.c.gold = 0
+    e.step("load")
+    assert e.c.gold == gold
+    e.close()
+
+
+# --------------------------
+# Packed grids and map files
+# --------------------------
+def chest(gold=10, potion=None, lock_dc=14, trap_dc=12):
+    return D.make_chest(gold, potion, True, True, trap_dc, lock_dc)
+
+
+PACKED_ROOMS = [
+    D.Room(),
+    D.Room(True, "monster", {"monster": D.MONSTER_TEMPLATES[0]}),
+    D.Room(False, "trap", {"dc": 14, "dmg": D.TRAP_DAMAGE}),
+    D.Room(False, "fountain", {"type": "buff"}),
+    D.Room(True, "treasure", chest(potion=D.CHEST_POTIONS[1])),
+    D.Room(False, "boss", {"monster": D.NECROMANCER}),
+]
+
+
+def packed_grid(backend, rows, cols):
+    if backend == "mmap":
+        return D.MmapGrid.create("packed.map", rows, cols)
+    return D.CompactGrid(rows, cols)
+
+
+@pytest.mark.parametrize("backend", ["compact", "mmap"])
+def test_packed_rooms_round_trip(backend):
+    grid = packed_grid(backend, 1, len(PACKED_ROOMS))
+    for y, room in enumerate(PACKED_ROOMS):
+        grid.set_room(0, y, room)
+    assert [grid[0][y].to_dict() for y in range(len(PACKED_ROOMS))] == [r.to_dict() for r in PACKED_ROOMS]
+    assert grid.other == {} and grid.bosses == {len(PACKED_ROOMS) - 1}
+    assert grid.visited_count == 2
+
+
+MISFITS = [
+    D.Room(False, "treasure", chest(gold=300)),
+    D.Room(False, "treasure", chest(potion="Elixir of Nonsense")),
+    D.Room(False, "treasure", chest(lock_dc=-1)),
+    D.Room(False, "trap", {"dc": 999, "dmg": D.TRAP_DAMAGE}),
+    D.Room(False, "monster", {"monster": dict(D.MONSTER_TEMPLATES[0], hp="50d10")}),
+    D.Room(False, "fountain", None),
+]
+
+
+@pytest.mark.parametrize("room", MISFITS)
+def test_mmap_rejects_misfits_without_writing(room):
+    grid = packed_grid("mmap", 1, 2)
+    grid.set_room(0, 0, D.Room(False, "boss", {"monster": D.NECROMANCER}))
+    grid.set_room(0, 1, D.Room(False, "treasure", chest(gold=7)))
+    before = bytes(grid.mm)
+    for y in range(2):
+        with pytest.raises(ValueError):
+            grid.set_room(0, y, room)
+    assert bytes(grid.mm) == before
+    assert grid.bosses == {0}
+    assert grid[0][1].content["loot"]["gold"] == 7
+
+
+@pytest.mark.parametrize("room", MISFITS)
+def test_compact_keeps_misfits_aside(room):
+    grid = packed_grid("compact", 1, 1)
+    grid.set_room(0, 0, D.Room(False, "boss", {"monster": D.NECROMANCER}))
+    arrays = [bytes(getattr(grid, name)) for name in D.CompactGrid.FIELDS[2:]]
+    grid.set_room(0, 0, room)
+    assert grid[0][0] == room and grid.bosses == set()
+    assert [bytes(getattr(grid, name)) for name in D.CompactGrid.FIELDS[2:]] == arrays
+    grid.set_room(0, 0, D.Room(False, "boss", {"monster": D.NECROMANCER}))
+    assert grid.other == {} and grid.bosses == {0}
+
+
+def test_content_packs_are_capped_at_the_monster_byte(workdir):
+    monster = {"hp": "1d6", "ac": 10, "atk_bonus": 1, "dmg": "1d4", "xp": 5, "gold": "1d4"}
+    extra = D.MAX_MONSTERS - len(D.MONSTER_TEMPLATES) + 1
+    pack = workdir / "horde.json"
+    pack.write_text(json.dumps({"monsters": [dict(monster, name=f"Imp {k}") for k in range(extra)]}))
+    templates = list(D.MONSTER_TEMPLATES)
+    with pytest.raises(D.ContentError, match="at most 256"):
+        D.load_content([str(pack)], cache_path=None)
+    assert D.MONSTER_TEMPLATES == templates
+
+
+# --------------------------
+# Hall of Fame
+# --------------------------
+@pytest.fixture
+def hof(workdir):
+    store = D.HallOfFame(str(workdir / "hof.db"), legacy_json=None)
+    yield store
+    store.close()
+
+
+def fill_hof(store):
+    classes, races = list(D.CLASSES), list(D.RACES)
+    for i in range(25):
+        c = make_character(f"Hero{i}", races[i % len(races)], classes[i % len(classes)])
+        c.level, c.gold, c.turns = 1 + i % 7, i * 10, 100 - i
+        store.add(c)
+
+
+def rank(entry):
+    return (-entry["level"], -entry["gold"], entry["turns"])
+
+
+def test_hof_pages_in_rank_order(hof):
+    fill_hof(hof)
+    pages = [hof.page(n, size=10) for n in (1, 2, 3, 4)]
+    assert [len(p) for p in pages] == [10, 10, 5, 0]
+    entries = [e for p in pages for e in p]
+    assert entries == sorted(entries, key=rank)
+    assert len({e["name"] for e in entries}) == 25
+    assert hof.top(3) == pages[0][:3]
+    assert hof.top(3, offset=10) == pages[1][:3]
+
+
+def test_hof_filters_and_counts(hof):
+    fill_hof(hof)
+    assert hof.count() == 25
+    for cls in D.CLASSES:
+        rows = hof.top(100, char_class=cls)
+        assert {r["char_class"] for r in rows} == {cls}
+        assert hof.count(char_class=cls) == len(rows)
+    wizards = hof.top(100, char_class="Wizard", race="Elf")
+    assert all(r["race"] == "Elf" for r in wizards)
+    assert hof.count("Wizard", "Elf") == len(wizards)
+    assert hof.count("Bard") == 0
+    assert hof.page(1, size=2, char_class="Rogue") == hof.top(2, char_class="Rogue")
+
+
+def test_hof_counts_survive_reopen_and_delete(workdir, hof):
+    fill_hof(hof)
+    hof.conn.execute("DELETE FROM hof WHERE char_class = 'Cleric'")
+    again = D.HallOfFame(str(workdir / "hof.db"), legacy_json=None)
+    assert again.count() == hof.count() == 25 - len([i for i in range(25) if i % 4 == 3])
+    assert again.count("Cleric") == 0
+    again.close()
+
+
+def test_hof_imports_legacy_json_once(workdir):
+    legacy = workdir / "old.json"
+    legacy.write_text(json.dumps([{"name": "Old", "race": "Elf", "char_class": "Rogue", "level": 9, "gold": 1}]))
+    path = str(workdir / "legacy.db")
+    store = D.HallOfFame(path, str(legacy))
+    assert store.count() == 1 and store.count("Rogue", "Elf") == 1
+    store.close()
+    store = D.HallOfFame(path, str(legacy))
+    assert store.count() == 1
+    store.close()
+
+
+def test_parse_hof_args():
+    assert D.parse_hof_args("") == {}
+    assert D.parse_hof_args("2 class wizard race elf") == {"page": 2, "char_class": "Wizard", "race": "Elf"}
+    assert D.parse_hof_args("TOP 5") == {"top": 5}
+    with pytest.raises(ValueError):
+        D.parse_hof_args("sideways")
+
+
+def test_hof_command():
+    fill_hof(D.hall_of_fame())
+    e = D.GameEngine(persist=False, seed=1)
+    e.start()
+    text = "\n".join(ev.text for ev in e.step("hof class wizard"))
+    assert "Hero2" in text and "Hero0 " not in text
+
+
+def test_hof_runs_off_the_event_loop():
+    fill_hof(D.hall_of_fame())
+    e = D.GameEngine(persist=False, seed=1)
+    e.start()
+    assert e._uses_hof("hof 2") and not e._uses_hof("new")
+    events = asyncio.run(e.step_async("hof"))
+    assert "Hero6" in "\n".join(ev.text for ev in events)
+
+
+# --------------------------
+# Command registry
+# --------------------------
+@pytest.fixture
+def registry():
+    return D.CommandRegistry([
+        D.Command("look", "look"),
+        D.Command("load", "load"),
+        D.Command("buy", "buy", D.arg_text, "BUY <item>"),
+        D.Command("go", "go", D.arg_choice("north", "south")),
+        D.Command("return town", "town", aliases=("back",)),
+        D.Command("return entrance", "entrance"),
+    ], unknown="Huh?")
+
+
+def test_registry_resolves_prefixes(registry):
+    assert registry.resolve("look")[0].handler == "look"
+    assert registry.resolve("LOO")[0].handler == "look"
+    assert registry.resolve("ret tow")[0].handler == "town"
+    assert registry.resolve("r e")[0].handler == "entrance"
+    assert registry.resolve("back")[0].handler == "town"
+    assert registry.resolve("bu Short Sword") == (registry.commands[2], "Short Sword")
+    assert registry.resolve("go s") == (registry.commands[3], "south")
+
+
+def test_registry_errors(registry):
+    with pytest.raises(D.CommandError, match="Ambiguous command 'LO': LOAD, LOOK"):
+        registry.resolve("lo")
+    with pytest.raises(D.CommandError, match="Huh"):
+        registry.resolve("dance")
+    with pytest.raises(D.CommandError, match="Huh"):
+        registry.resolve("")
+    with pytest.raises(D.CommandError, match="Usage: LOOK"):
+        registry.resolve("look around")
+    with pytest.raises(D.CommandError, match="Usage: BUY <item>"):
+        registry.resolve("buy")
+    with pytest.raises(D.CommandError, match="Usage: GO"):
+        registry.resolve("go up")
+    with pytest.raises(ValueError):
+        registry.add(D.Command("look", "again"))
+
+
+def test_mode_registries_dispatch():
+    e = D.GameEngine(make_character(), open_grid(4, 4), persist=False, seed=2)
+    inv = "\n".join(ev.text for ev in e.step("inv"))
+    assert "Longsword" in inv
+    assert "Unknown command" in "\n".join(ev.text for ev in e.step("xyzzy"))
+    e.step("enter dungeon")
+    assert e.mode == "dungeon"
+    e.step("ret town")
+    assert e.mode == "town"
+
+
+# --------------------------
+# GOTO routing
+# --------------------------
+def bfs(d, start, goal_test, through):
+    """Steps from start to the first room passing goal_test, walking only rooms passing through."""
+    seen = {start}
+    queue = collections.deque([(start, 0)])
+    while queue:
+        (x, y), n = queue.popleft()
+        for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+            if 0 <= nx < d.rows and 0 <= ny < d.cols and (nx, ny) not in seen:
+                if goal_test((nx, ny)):
+                    return n + 1
+                seen.add((nx, ny))
+                if through((nx, ny)):
+                    queue.append(((nx, ny), n + 1))
+    return None
+
+
+def check_walk(d, path):
+    pos = d.player_pos
+    for i, (x, y) in enumerate(path):
+        assert abs(x - pos[0]) + abs(y - pos[1]) == 1
+        assert d.grid[x][y].visited or i == len(path) - 1
+        pos = (x, y)
+
+
+def serpentine(d, rows=None):
+    """Explore a winding corridor: rows 0, 2, 4... fully, joined at alternating ends."""
+    rows = d.rows if rows is None else rows
+    for x in range(0, rows, 2):
+        for y in range(d.cols):
+            d.visit(x, y)
+        if x + 1 < rows:
+            d.visit(x + 1, d.cols - 1 if x % 4 == 0 else 0)
+
+
+def test_route_back_follows_explored_corridor():
+    d = open_grid(7, 6)
+    serpentine(d)
+    d.player_pos = (6, 0)
+    path = D.route_back(d, (0, 0))
+    assert path[-1] == (0, 0)
+    check_walk(d, path)
+    explored = lambda p: d.grid[p[0]][p[1]].visited
+    assert len(path) == bfs(d, d.player_pos, lambda p: p == (0, 0), explored)
+    assert D.route_back(d, d.player_pos) == []
+    cut = open_grid(7, 6)
+    serpentine(cut, 5)
+    for y in range(6):
+        cut.visit(6, y)
+    cut.player_pos = (6, 3)
+    assert D.route_back(cut, (0, 0)) is None  # row 6 was reached some other way
+
+
+def test_route_to_unexplored_target_stops_at_frontier():
+    d = open_grid(10, 6)
+    serpentine(d, 5)
+    d.player_pos = (0, 0)
+    path = D.route_to(d, (9, 1))
+    check_walk(d, path)
+    end = path[-1]
+    assert not d.grid[end[0]][end[1]].visited
+    # the stop costs no more than walking to any other frontier room and going on from there
+    explored = lambda p: d.grid[p[0]][p[1]].visited
+    cost = len(path) + abs(end[0] - 9) + abs(end[1] - 1)
+    for j in D.frontier_rooms(d):
+        f = divmod(j, d.cols)
+        walk = bfs(d, d.player_pos, lambda p, f=f: p == f, explored)
+        assert cost <= walk + abs(f[0] - 9) + abs(f[1] - 1)
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_nearest_unexplored_matches_bfs(seed):
+    rng = random.Random(seed)
+    d = open_grid(rng.randint(2, 12), rng.randint(2, 12))
+    pos = (0, 0)
+    d.visit(*pos)
+    for _ in range(d.rows * d.cols):  # random walk leaves a ragged explored area
+        x, y = pos
+        pos = rng.choice([(nx, ny) for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1))
+                          if 0 <= nx < d.rows and 0 <= ny < d.cols])
+        d.visit(*pos)
+        D.frontier_rooms(d)  # built early, then kept current by visit()
+    d.player_pos = pos
+    explored = lambda p: d.grid[p[0]][p[1]].visited
+    expected = {j for j in range(d.rows * d.cols) if not explored(divmod(j, d.cols))
+                and any(explored(divmod(k, d.cols)) for k in D._neighbours(j, d.rows, d.cols))}
+    assert D.frontier_rooms(d) == expected
+    path = D.nearest_unexplored(d)
+    want = bfs(d, pos, lambda p: not explored(p), explored)
+    if want is None:
+        assert path is None
+    else:
+        check_walk(d, path)
+        assert len(path) == want
+
+
+def test_compact_frontier_matches_list():
+    d = D.generate_dungeon(9, 11, seed=3)
+    c = D.generate_dungeon(9, 11, seed=3, backend="compact")
+    for x, y in [(0, 0), (0, 1), (1, 1), (4, 4), (8, 10)]:
+        d.visit(x, y)
+        c.visit(x, y)
+    assert D.frontier_rooms(c) == D.frontier_rooms(d)
+
+
+def test_goto_command_moves_player():
+    e = D.GameEngine(make_character(), open_grid(6, 6), persist=False, seed=6)
+    e.step("enter dungeon")
+    assert e.mode == "dungeon"
+    d = e.d
+    serpentine(d)
+    d.player_pos = (4, 5)
+    e.step("return entrance")
+    assert d.player_pos == (0, 0)
+    e.step("goto 2,3")
+    assert d.player_pos == (2, 3)
+    assert "no such room" in "\n".join(ev.text for ev in e.step("goto 9 9"))
+    unexplored = {divmod(j, d.cols) for j in D.frontier_rooms(d)}
+    explored = d.explored_count()
+    e.step("goto nearest")
+    assert d.player_pos in unexplored
+    assert d.explored_count() == explored + 1  # arriving explores it
+
+
+# --------------------------
+# Dice distributions and odds
+# --------------------------
+@pytest.mark.parametrize("expr", EXPRESSIONS)
+def test_distribution_matches_compiled_dice(expr):
+    dice = D.compile_dice(expr)
+    dist = D.dice_distribution(expr)
+    assert (dist.lo, dist.hi) == (dice.min, dice.max)
+    assert dist.mean == pytest.approx(dice.mean)
+    assert sum(p for _, p in dist.items()) == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize("n,sides,keep", [(4, 6, 3), (2, 20, 1), (5, 8, 2), (3, 4, 3)])
+def test_keep_distribution_matches_brute_force(n, sides, keep):
+    for highest in (True, False):
+        counts = collections.Counter()
+        for faces in itertools.product(range(1, sides + 1), repeat=n):
+            counts[sum(sorted(faces, reverse=highest)[:keep])] += 1
+        dist = D._keep_distribution(n, sides, keep, highest)
+        assert dist.total == sides ** n
+        assert {v: p for v, p in dist.items()} == pytest.approx({v: k / sides ** n for v, k in counts.items()})
+
+
+def test_distribution_queries():
+    two = D.dice_distribution("2d6")
+    assert two.prob(7) == pytest.approx(6 / 36)
+    assert two.prob(1) == 0.0
+    assert two.at_least(11) == pytest.approx(3 / 36)
+    assert two.at_least(-5) == 1.0 and two.at_least(13) == 0.0
+    assert D.hit_chance(5, 15) == pytest.approx(11 / 20)
+    assert D.hit_chance(0, 25) == 0.0
+    assert D.damage_distribution("1d4", -3).items() == [(1, 1.0)]
+
+
+def test_weapon_odds_match_a_sampled_attack():
+    c = make_character()
+    p, per_round = D.weapon_odds(c, c.weapon, 13)
+    assert p == D.hit_chance(c.attack_bonus(), 13)
+    w = D.WEAPONS[c.weapon]
+    assert per_round == pytest.approx(p * D.damage_distribution(w["damage"], c.mod(w["attr"]), 0).mean)
+    rng = random.Random(5)
+    hits = [max(1, c.damage_roll(rng)) if rng.randint(1, 20) + c.attack_bonus() >= 13 else 0 for _ in range(20000)]
+    assert sum(hits) / len(hits) == pytest.approx(per_round, rel=0.05)
+
+
+# --------------------------
+# Fight solver
+# --------------------------
+def monster(name="Dummy", hp=10, ac=12, atk_bonus=2, dmg="1d6"):
+    return D.Monster(name, hp, ac, atk_bonus, dmg, 5, 3)
+
+
+def outcome_total(o):
+    return o.win + o.flee + o.die + o.stalemate
+
+
+@pytest.mark.parametrize("template", D.MONSTER_TEMPLATES + [D.NECROMANCER], ids=lambda t: t["name"])
+def test_fight_odds_are_a_distribution(template):
+    c = make_character()
+    c.add_potion("Healing Potion", 2)
+    for policy in D.fight_policies(c) + [D.FightPolicy(run_at=4), D.FightPolicy("defend")]:
+        o = D.fight_odds(c, template, policy)
+        assert outcome_total(o) == pytest.approx(1.0)
+        assert 0 <= o.hp <= c.max_hp
+
+
+def test_fight_odds_edge_cases():
+    c = make_character()
+    harmless = D.fight_odds(c, monster(atk_bonus=-100))
+    assert (harmless.win, harmless.hp) == (pytest.approx(1.0), pytest.approx(c.hp))
+    deadlock = D.fight_odds(c, monster(ac=100, atk_bonus=-100))
+    assert deadlock.stalemate == pytest.approx(1.0)
+    c.hp = 1
+    doomed = D.fight_odds(c, monster(hp=500, atk_bonus=100, dmg="5"))
+    assert doomed.die == pytest.approx(1.0)
+
+
+def test_long_fights_need_no_deep_recursion():
+    c = make_character()
+    c.max_hp = c.hp = 80
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(150)  # far fewer frames than the fight has turns
+    try:
+        o = D.fight_odds(c, monster(hp=200, dmg="1d2"), D.FightPolicy("attack", "high"))
+    finally:
+        sys.setrecursionlimit(limit)
+    assert outcome_total(o) == pytest.approx(1.0)
+
+
+def test_fight_odds_match_played_fights():
+    rng = random.Random(11)
+    template = D.MONSTER_TEMPLATES[3]  # Bandit
+    odds = D.fight_odds(make_character(), template)
+    wins, n = 0, 4000
+    token = D._EVENT_SINK.set([])
+    try:
+        for _ in range(n):
+            c = make_character()
+            f = D.start_fight(c, D.make_monster(template, rng))
+            while D.advance_fight(c, f, rng):
+                D.combat_action(c, f, "attack middle", rng)
+            wins += c.hp > 0
+    finally:
+        D._EVENT_SINK.reset(token)
+    assert wins / n == pytest.approx(odds.win, abs=0.03)
+
+
+def test_odds_command_lists_every_monster():
+    e = D.GameEngine(make_character(), open_grid(2, 2), persist=False, seed=1)
+    text = "\n".join(ev.text for ev in e.step("odds"))
+    for template in D.MONSTER_TEMPLATES + [D.NECROMANCER]:
+        assert template["name"] in text
+
+
+# --------------------------
+# Combat AI
+# --------------------------
+def test_combat_state_keys_never_collide():
+    pack = D._CombatModel.pack
+    states = [(php, mhp, b, t, pots) for php in (1, 1023, 1024, 2049) for mhp in (0, 1, 1024, 1025)
+              for b in (0, 1, 64) for t in (0, 63, 64) for pots in ((), (0, 63), (0, 64), (64, 0))]
+    keys = [pack(*state) for state in states]
+    assert len(set(keys)) == len(states)
+    assert isinstance(pack(1023, 1023, 63, 63, (63,)), int)
+
+
+def test_ai_plays_deep_floor_foes():
+    c = make_character()
+    c.max_hp = c.hp = 1500
+    foe = monster(hp=1100, ac=10, atk_bonus=0, dmg="1d2")  # HP past the packed key's 10 bits
+    ai = D.CombatAI(time_budget=float("inf"), node_budget=500)
+    command, value = ai.evaluate(c, foe)
+    assert command.startswith("attack") and 0 < value <= 1 + D.AI_HP_WEIGHT
+
+
+def test_ai_takes_the_obvious_move():
+    ai = D.CombatAI(time_budget=float("inf"))
+    c = make_character()
+    assert ai.choose(c, monster(hp=1)) == "attack low"  # any hit kills, so aim for the surest one
+    c.hp = 2
+    command, value = ai.evaluate(c, monster(hp=40, ac=14, atk_bonus=6, dmg="2d6+3"))
+    assert command == "run" and value < D.AI_FLEE_VALUE
+
+
+def test_simulated_fights_repeat_with_a_seed():
+    def play(seed):
+        c = make_character()
+        c.add_potion("Healing Potion", 1)
+        rng = random.Random(seed)
+        ai = D.CombatAI(time_budget=float("inf"), node_budget=300)
+        result = D.simulate_fight(c, D.make_monster(D.MONSTER_TEMPLATES[1], rng), ai, rng)
+        return result, c.to_dict()
+
+    results = {play(seed)[0] for seed in range(20)}
+    assert results <= {"won", "fled", "died"} and "won" in results
+    assert play(3) == play(3)
+    result, c = play(4)
+    if result == "won":
+        assert c["xp"] == D.MONSTER_TEMPLATES[1]["xp"]
+
+
+def test_hint_command():
+    e = D.GameEngine(make_character(), open_grid(2, 2), persist=False, seed=1)
+    e._collect(e._begin_fight, D.Fight(monster(hp=1)))
+    assert e.mode == "combat"
+    assert "Hint: ATTACK LOW" in [ev.text for ev in e.step("hint")]
+
+
+# --------------------------
+# Benchmarks
+# --------------------------
+def bench_run(**seconds):
+    return {"results": {name: {"seconds": s} for name, s in seconds.items()}}
+
+
+def test_compare_benchmarks_flags_slowdowns():
+    baseline = bench_run(roll=1.0, generate=2.0, fight=1.0, gone=1.0)
+    current = bench_run(roll=1.05, generate=2.5, fight=0.5, new=1.0)
+    lines, regressed = D.compare_benchmarks(baseline, current, threshold=10.0)
+    assert regressed == ["generate"]
+    assert len(lines) == 5
+    assert "REGRESSION" in lines[1] and "+25.0%" in lines[1]
+    assert "-50.0%" in lines[2] and "REGRESSION" not in lines[2]
+    assert " new " in lines[3] and "missing from this run" in lines[4]
+    assert D.compare_benchmarks(baseline, current, threshold=30.0)[1] == []
+
+
+def test_run_benchmarks_subset(tmp_path):
+    results = D.run_benchmarks(names=["roll_2d6+3"])
+    assert results["format"] == D.BENCH_FORMAT and results["seed"] == D.BENCH_SEED
+    assert list(results["results"]) == ["roll_2d6+3"]
+    assert results["results"]["roll_2d6+3"]["seconds"] > 0
+    assert list(tmp_path.iterdir()) == []  # ran in a scratch directory
+
+
+def test_bench_compare_exit_status(tmp_path, capsys):
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps(bench_run(**{"roll_2d6+3": 1e-12, "ascii_map": 1.0})))
+    with pytest.raises(SystemExit) as exit_info:
+        D.main(["--bench-compare", str(baseline), "--bench-only", "roll_2d6+3"])
+    assert exit_info.value.code == 1
+    out = capsys.readouterr().out
+    assert "REGRESSION" in out and "ascii_map" not in out  # --bench-only trims the baseline too
+    baseline.write_text(json.dumps(bench_run(**{"roll_2d6+3": 1e3})))
+    D.main(["--bench-compare", str(baseline), "--bench-only", "roll_2d6+3"])
+    assert "regressed" not in capsys.readouterr().out
+
+
+# --------------------------
+# Profiling
+# --------------------------
+@pytest.fixture
+def profiler():
+    original = D.roll
+    prof = D.enable_profiling(report_to=None)
+    yield prof
+    D.disable_profiling()
+    assert D.roll is original
+
+
+def test_profiler_counts_wrapped_functions(profiler):
+    assert D.enable_profiling(report_to=None) is profiler  # idempotent
+    original = profiler.originals["roll"]
+    assert D.roll is not original
+    rng = random.Random(1)
+    for _ in range(5):
+        D.roll("1d6", rng)
+    calls, seconds = profiler.functions["roll"]
+    assert calls == 5 and seconds > 0
+    D.disable_profiling()
+    assert D._PROFILER is None and D.roll is original
+    D.roll("1d6", rng)
+    assert profiler.functions["roll"][0] == 5
+
+
+def test_profiler_latency_histogram():
+    prof = D.Profiler()
+    for us in (1, 3, 3, 100):
+        prof.record("town:look", us / 1e6)
+    count, seconds, worst = prof.commands["town:look"]
+    assert count == 4 and worst == pytest.approx(100e-6)
+    assert sum(prof.histograms["town:look"]) == 4
+    assert prof._percentile("town:look", 0.5) == 4    # 3 us lands under 2**2
+    assert prof._percentile("town:look", 0.99) == 128
+    assert "town:look" in prof.report()
+
+
+def test_profile_command(profiler):
+    e = D.GameEngine(make_character(), open_grid(2, 2), persist=False, seed=1)
+    e.step("inv")
+    e.step("xyzzy")
+    assert {"town:inventory", "town:?"} <= set(profiler.commands)
+    text = "\n".join(ev.text for ev in e.step("profile"))
+    assert "town:inventory" in text and "command dispatch" in text
+
+
+def test_profile_command_when_off(tmp_path):
+    e = D.GameEngine(make_character(), open_grid(2, 2), persist=False, seed=1)
+    text = "\n".join(ev.text for ev in e.step("profile"))
+    assert "Profiling is off" in text and D.PROFILE_ENV in text
+
+
+def test_profile_report_file(profiler, tmp_path):
+    D.roll("1d6", random.Random(1))
+    report = tmp_path / "profile.txt"
+    D._write_profile(str(report))
+    assert "roll" in report.read_text()
+
+
+# --------------------------
+# Content packs
+# --------------------------
+@pytest.fixture
+def tables():
+    """Put the game tables and the CONTENT index back as they were after each test."""
+    saved = {kind: dict(table) for kind, table in D.CONTENT_TABLES.items()}
+    templates = list(D.MONSTER_TEMPLATES)
+    yield
+    for kind, table in D.CONTENT_TABLES.items():
+        table.clear()
+        table.update(saved[kind])
+    D.MONSTER_TEMPLATES[:] = templates
+    D.CONTENT.load_index(D.ContentRegistry.build_index())
+
+
+def write_pack(path, **pack):
+    path.write_text(json.dumps(pack))
+    return str(path)
+
+
+TROLL = {"name": "Bridge Troll", "hp": "6d10", "ac": 15, "atk_bonus": 6, "dmg": "2d8+4", "xp": 95, "gold": "4d10"}
+HALBERD = {"cost": 40, "damage": "1d10", "attr": "STR"}
+
+
+@pytest.mark.parametrize("pack, problem", [
+    ("{not json", "not valid JSON"),
+    ("[]", "a pack is an object of tables"),
+    ({"dragons": {}}, "unknown tables dragons"),
+    ({"weapons": []}, "weapons must map names to entries"),
+    ({"weapons": {"Halberd": dict(HALBERD, damage="1d")}}, "weapons 'Halberd': bad 'damage'"),
+    ({"armors": {"Robe": {"cost": 1, "base_ac": 10}}}, "armors 'Robe': missing 'dex_cap'"),
+    ({"potions": {"Ale": {"cost": 1, "effect": "drunk"}}}, "unknown effect 'drunk'"),
+    ({"spells": {"Zap": {"cost": 1, "type": "lightning", "desc": "zap"}}}, "type must be one of"),
+    ({"classes": {"Pikeman": {"hp_die": 10, "fav": "STR",
+                              "start": {"weapon": "Pike", "armor": "Leather", "gold": 5}}}},
+     "start weapon/armor must exist"),
+    ({"monsters": {"Bridge Troll": TROLL}}, "monsters must be a list"),
+    ({"monsters": [dict(TROLL, ac="high")]}, "monsters 'Bridge Troll': bad 'ac'"),
+])
+def test_bad_content_packs(tables, workdir, pack, problem):
+    path = workdir / "pack.json"
+    path.write_text(pack if isinstance(pack, str) else json.dumps(pack))
+    weapons = dict(D.WEAPONS)
+    with pytest.raises(D.ContentError) as error:
+        D.load_content([str(path)], cache_path=None)
+    assert str(error.value).startswith(f"{path}: ") and problem in str(error.value)
+    assert D.WEAPONS == weapons and not (workdir / D.CONTENT_CACHE_FILE).exists()
+
+
+def test_content_pack_merges_and_reindexes(tables, workdir):
+    knight = dict(D.CLASSES["Warrior"], start={"weapon": "Halberd", "armor": "Leather", "gold": 5})
+    packs = workdir / "packs"
+    packs.mkdir()
+    write_pack(packs / "a.json", weapons={"Halberd": HALBERD}, classes={"Knight": knight})
+    write_pack(packs / "b.json", monsters=[TROLL], weapons={"Halberd": dict(HALBERD, cost=45)})
+    count = len(D.MONSTER_TEMPLATES)
+    assert D.load_content([str(packs)], cache_path=None) == 3
+    assert D.WEAPONS["Halberd"]["cost"] == 45  # later packs win
+    assert D.MONSTER_TEMPLATES[count] == TROLL and D.CONTENT.monster_index(TROLL) == count
+    assert D.CONTENT.find("halb") == [("weapons", "Halberd")]
+    assert "Halberd" in D.CONTENT.by_cost("weapons", 45, 45)
+    assert TROLL in D.CONTENT.monsters_in_tier(D.monster_tier(TROLL))
+
+
+def test_content_index_cache(tables, workdir, monkeypatch):
+    pack = write_pack(workdir / "troll.json", monsters=[TROLL])
+    cache = str(workdir / "index.json")
+    baseline = {kind: dict(table) for kind, table in D.CONTENT_TABLES.items()}, list(D.MONSTER_TEMPLATES)
+    reads = []
+    read_pack = D._read_pack
+    monkeypatch.setattr(D, "_read_pack", lambda *args: reads.append(args[0]) or read_pack(*args))
+
+    def reload():
+        for kind, table in D.CONTENT_TABLES.items():
+            table.clear()
+            table.update(baseline[0][kind])
+        D.MONSTER_TEMPLATES[:] = baseline[1]
+        return D.load_content([pack], cache_path=cache)
+
+    assert reload() == 1 and reads == [pack]
+    assert reload() == 1 and reads == [pack]  # unchanged packs load from the cache
+    assert D.CONTENT.find("bridge troll") == [("monsters", "Bridge Troll")]
+    write_pack(workdir / "troll.json", monsters=[dict(TROLL, xp=100)])
+    assert reload() == 1 and reads == [pack, pack]
+    assert D.MONSTER_TEMPLATES[-1]["xp"] == 100
+    (workdir / "index.json").write_text("{torn")
+    assert reload() == 1 and len(reads) == 3  # a broken cache is rebuilt, not fatal
+    assert json.loads((workdir / "index.json").read_text())["key"]
+
+
+# --------------------------
+# Dungeon generators
+# --------------------------
+def strip_timing(summary):
+    return {k: v for k, v in summary.items() if k not in ("seconds", "commands_per_sec")}
+
+
+@pytest.mark.parametrize("backend", D.GRID_BACKENDS)
+def test_every_backend_repeats_its_dungeon(backend):
+    a = D.generate_dungeon(12, 9, seed=1234, backend=backend, path="a.map")
+    b = D.generate_dungeon(12, 9, seed=1234, backend=backend, path="b.map")
+    other = D.generate_dungeon(12, 9, seed=4321, backend=backend, path="c.map")
+    assert grid_rooms(a) == grid_rooms(b) and a.boss_pos == b.boss_pos
+    assert grid_rooms(a) != grid_rooms(other)
+    assert a.generator == D.dungeon_generator(backend)
+
+
+@pytest.mark.parametrize("backend", ["list", "lazy", "compact"])
+def test_run_script_repeats(backend):
+    first = D.run_script(SCRIPT, seed=77, grid_backend=backend)
+    again = D.run_script(SCRIPT, seed=77, grid_backend=backend)
+    assert strip_timing(first) == strip_timing(again)
+    assert first["dungeon"]["generator"] == D.dungeon_generator(backend)
+    assert transcript(77, grid_backend=backend) == transcript(77, grid_backend=backend)
+
+
+def test_dungeon_seed_fixes_layout():
+    a = new_game(D.GameEngine(persist=False, seed=1, dungeon_seed=555, dungeon_size=(7, 7)))
+    b = new_game(D.GameEngine(persist=False, seed=2, dungeon_seed=555, dungeon_size=(7, 7)))
+    layout = [[r["kind"] for r in row] for row in grid_rooms(D.generate_dungeon(7, 7, seed=555))]
+    for e in (a, b):
+        assert e.d.seed == 555
+        assert [[r["kind"] for r in row] for row in grid_rooms(e.d)] == layout
+
+
+# --------------------------
+# Floors
+# --------------------------
+def test_floor_seeds_and_map_paths():
+    assert D.floor_seed(7, 2) == D.floor_seed(7, 2)
+    assert len({D.floor_seed(7, depth) for depth in range(1, 20)}) == 19
+    assert D.floor_seed(None, 2) == D.floor_seed(0, 2)
+    assert D.floor_map_path("run.map", 1) == "run.map"
+    assert D.floor_map_path("run.map", 3) == "run.floor3.map"
+    assert D.floor_map_path("run.floor3.map", 4) == "run.floor4.map"
+    assert D.floor_map_path("run.floor3.map", 1) == "run.map"
+
+
+def test_floor_prefetch():
+    d = D.generate_dungeon(6, 6, seed=9)
+    floors = D.FloorPrefetch(serialize=True)
+    floors.start(d)
+    future = floors.future
+    floors.start(d)
+    assert floors.future is future  # already under way
+    future.result()
+    assert floors.pending(d) is None
+    below, snapshot = floors.take(d)
+    assert floors.future is None
+    assert (below.depth, below.seed, below.rows) == (2, D.floor_seed(9, 2), 6)
+    assert grid_rooms(below) == grid_rooms(D.generate_floor(2, 6, 6, D.floor_seed(9, 2)))
+    assert json.loads(snapshot) == below.to_dict()
+    floors.start(below)
+    floors.cancel()
+    assert floors.key is None and floors.future is None
+
+
+def test_floor_prefetch_follows_the_current_floor():
+    floors = D.FloorPrefetch()
+    a, b = D.generate_dungeon(5, 5, seed=1), D.generate_dungeon(5, 5, seed=2)
+    floors.start(a)
+    below, snapshot = floors.take(b)  # e.g. after LOAD: the floor below a is no use
+    assert below.seed == D.floor_seed(2, 2) and snapshot is None
+
+
+def test_descend():
+    d = open_grid(3, 3)
+    d.seed = 5
+    d.grid[2][2] = D.Room(True, "boss", {"monster": D.NECROMANCER})
+    e = D.GameEngine(make_character(), d, persist=False, seed=1)
+    e.step("enter dungeon")
+    assert "no stairs here" in "\n".join(ev.text for ev in e.step("descend"))
+    d.player_pos = (2, 2)
+    assert "still bars the stairs" in "\n".join(ev.text for ev in e.step("descend"))
+    assert e._blocking_future("descend") is None
+    d.cleared = True
+    assert e._at_open_stairs()
+    text = "\n".join(ev.text for ev in e.step("descend"))
+    assert "descend the stairs to floor 2" in text
+    assert (e.d.depth, e.d.seed, e.d.rows) == (2, D.floor_seed(5, 2), 3)
+    assert e.d is not d and e.floors.key[1] == 3  # already building floor 3
+    e.close()
+    assert e.floors.future is None
+
+
+def test_server_closes_each_engine(monkeypatch):
+    closed = []
+    close = D.GameEngine.close
+    monkeypatch.setattr(D.GameEngine, "close", lambda self: closed.append(self) or close(self))
+
+    async def main():
+        server = D.GameServer()
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"new\n")
+        reader.feed_eof()
+        writer = StalledWriter()
+        writer.drain = lambda: asyncio.sleep(0)  # a client that keeps up
+        await asyncio.wait_for(server._handle(reader, writer), 5)
+        return server
+
+    server = asyncio.run(main())
+    assert len(closed) == 1 and server.sessions == {}
+
+
+# --------------------------
+# Seed batches
+# --------------------------
+def test_score_dungeon_by_hand():
+    d = open_grid(3, 3)
+    d.boss_pos = (2, 1)
+    d.grid[0][1] = D.Room(False, "treasure", chest(gold=9))
+    d.grid[1][1] = D.Room(False, "monster", {"monster": D.MONSTER_TEMPLATES[0]})
+    d.grid[2][1] = D.Room(False, "boss", {"monster": D.NECROMANCER})
+    score = D.score_dungeon(d)
+    goblin, boss = D.MONSTER_TEMPLATES[0], D.NECROMANCER
+    assert score["boss_distance"] == 0.75
+    assert score["rooms"] == {"empty": 6, "treasure": 1, "monster": 1, "boss": 1}
+    assert score["chest_gold"] == 9
+    assert score["xp"] == goblin["xp"] + boss["xp"]
+    assert score["monster_gold"] == pytest.approx(D.dice_distribution(goblin["gold"]).mean
+                                                  + D.dice_distribution(boss["gold"]).mean, abs=0.01)
+
+
+@pytest.mark.parametrize("seed", [3, 8])
+def test_packed_grids_score_like_lists(seed, monkeypatch):
+    dungeons = [D.generate_dungeon(9, 11, seed=seed, backend=backend, path="score.map")
+                for backend in ("list", "compact", "mmap")]
+    scores = [D.score_dungeon(d) for d in dungeons]
+    assert scores[0] == scores[1] == scores[2]
+    monkeypatch.setattr(D, "np", None)
+    assert [D.score_dungeon(d) for d in dungeons] == scores
+
+
+def test_check_seed():
+    score = {"boss_distance": 0.5, "rooms": {"treasure": 1, "monster": 6, "empty": 3}}
+    assert D.check_seed(score, D.SeedCriteria()) == ["boss_close", "treasure_scarce", "monster_density"]
+    lenient = D.SeedCriteria(min_boss_distance=0.5, min_treasure=0.1, min_monsters=0.0, max_monsters=0.6)
+    assert D.check_seed(score, lenient) == []
+
+
+def test_batch_seeds(tmp_path):
+    criteria = D.SeedCriteria(min_boss_distance=0.5, min_treasure=0.1, min_monsters=0.2, max_monsters=0.5)
+    out = tmp_path / "seeds.jsonl"
+    with open(out, "w") as f:
+        summary = D.batch_seeds(100, 20, f, rows=6, cols=6, criteria=criteria, workers=2, chunk=8)
+    records = [json.loads(line) for line in out.read_text().splitlines()]
+    seeds = [r["seed"] for r in records]
+    assert seeds == sorted(seeds) and all(100 <= s < 120 for s in seeds)
+    assert summary["seeds"] == 20 and summary["accepted"] == len(records)
+    assert summary["generator"] == D.dungeon_generator("compact")
+    assert 0 < len(records) < 20 and sum(summary["rejected"].values()) >= 20 - len(records)
+    for r in records:
+        d = D.generate_dungeon(6, 6, seed=r["seed"])
+        assert {"seed": r["seed"], "generator": d.generator, **D.score_dungeon(d)} == r
+    with pytest.raises(ValueError):
+        D.batch_seeds(0, 1, f, backend="paper")
+
+
+# --------------------------
+# Dataclass codecs
+# --------------------------
+def test_character_codec_round_trip():
+    c = make_character("Ada", "Gnome", "Wizard")
+    c.add_potion("Healing", 3)
+    c.learn_spell("Shield")
+    c.effects = D.Effects(2, 4)
+    data = c.to_dict()
+    assert data["effects"] == {"ac_buff": 2, "ac_turns": 4}
+    back = D.Character.from_dict(json.loads(json.dumps(data)))
+    assert back == c
+    assert back.potions is not c.potions and back.spells is not c.spells
+
+
+def test_codec_defaults_and_coercion():
+    c = D.Character.from_dict({"name": "Bo", "race": "Elf", "char_class": "Rogue",
+                               "attrs": {"STR": "12"}, "gold": "7", "potions": {"Healing": 2.0}})
+    assert c.attrs == {"STR": 12} and c.gold == 7 and c.potions == {"Healing": 2}
+    assert (c.level, c.weapon, c.spells, c.effects) == (1, "Dagger", [], D.Effects())
+    assert D.Effects.from_dict(None) == D.Effects()
+    assert D.Room.from_dict({"visited": 1}) == D.Room(visited=True)
+    with pytest.raises(KeyError):
+        D.Character.from_dict({"name": "Bo"})
+    # defaults are not shared between decoded objects
+    a, b = (D.Character.from_dict({"name": "X", "race": "Elf", "char_class": "Rogue", "attrs": {}}) for _ in "ab")
+    a.spells.append("Heal")
+    a.potions["Healing"] = 1
+    assert b.spells == [] and b.potions == {}
+
+
+def test_room_and_monster_codecs():
+    rooms = [D.Room(), D.Room(True, "monster", {"name": "Goblin"}), D.Room(False, "fountain", {"used": False})]
+    assert D.Room.from_dicts(D.Room.to_dicts(rooms)) == rooms
+    assert D.Room.to_dicts(rooms) == [r.to_dict() for r in rooms]
+    m = D.Monster("Orc", 15, 13, 5, "1d12+3", 100, 20)
+    assert D.Monster.from_dict(m.to_dict()) == m
+
+
+def test_replace_state_keeps_identity():
+    c = make_character()
+    other = make_character("Other", "Dwarf", "Cleric")
+    other.gold = 999
+    effects = c.effects
+    snapshot = copy.deepcopy(other)
+    c.replace_state(other)
+    assert c == snapshot
+    assert c.effects is other.effects and c.effects is not effects
+    d = open_grid(3, 3)
+    d.visit(0, 0)
+    D.frontier_rooms(d)
+    loaded = D.generate_dungeon(4, 5, seed=8)
+    d.replace_state(loaded)
+    assert (d.rows, d.cols, d.seed) == (4, 5, 8)
+    assert d.frontier is None and not d.path_cache
+    assert D.frontier_rooms(d) == set()